@@ -0,0 +1,223 @@
+import asyncio
+import logging
+import math
+import random
+from collections import Counter, OrderedDict, deque
+
+from instrumentation import REGISTRY
+
+logger = logging.getLogger('discord')
+
+WAIT_SECONDS = REGISTRY.histogram(
+    'folium_ai_queue_wait_seconds',
+    'Time AI requests spent queued before being dispatched.',
+    ('scheduler',),
+    buckets=(0.01, 0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0),
+)
+REJECTED = REGISTRY.counter('folium_ai_requests_rejected_total', 'AI requests rejected before reaching the upstream API.', ('scheduler', 'reason'))
+RETRIES = REGISTRY.counter('folium_ai_request_retries_total', 'AI requests retried after a rate-limit error.', ('scheduler',))
+
+
+class SchedulerRejected(Exception):
+    pass
+
+
+class QueueFull(SchedulerRejected):
+    pass
+
+
+class DeadlineExceeded(SchedulerRejected):
+    pass
+
+
+class _Ticket:
+    __slots__ = ('key', 'user', 'future', 'enqueued_at')
+
+    def __init__(self, key, user, future, enqueued_at):
+        self.key = key
+        self.user = user
+        self.future = future
+        self.enqueued_at = enqueued_at
+
+
+# /ask や /imagine の上流API呼び出しを制御するスケジューラー
+# - 全体の同時実行数、キー(ギルド/ユーザー)ごとの同時実行数、キーの中のユーザーごとの同時実行数を制限する
+# - 待ち行列はキーごとに持ち、ラウンドロビンで取り出す(1つのギルドが全枠を占有しない)
+# - 同じキーの中では、同時実行数に空きのあるユーザーのリクエストから順に取り出す(1人のユーザーがギルドの枠を占有しない)
+# - 期限内に終わらない見込みのリクエストは待たせずに拒否する
+# - レート制限エラーはジッター付き指数バックオフで再試行する
+class AIRequestScheduler:
+    def __init__(
+        self,
+        name: str = 'ai',
+        max_concurrency: int = 4,
+        per_key_concurrency: int = 3,
+        per_user_concurrency: int = 1,
+        max_queue: int = 100,
+        max_retries: int = 3,
+        base_delay: float = 1.0,
+        max_delay: float = 30.0,
+        retry_on: tuple[type[BaseException], ...] = (),
+        expected_service_time: float = 10.0,
+    ):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.per_key_concurrency = per_key_concurrency
+        self.per_user_concurrency = per_user_concurrency
+        self.max_queue = max_queue
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_on = retry_on
+        # 1リクエストあたりの処理時間の指数移動平均。待ち時間の見積もりに使う
+        self.service_time = expected_service_time
+
+        self._queues: OrderedDict[object, deque[_Ticket]] = OrderedDict()
+        self._active: Counter = Counter()
+        self._active_users: Counter = Counter() # (キー, ユーザー) -> 実行中の数
+        self._running = 0
+        self._queued = 0
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queued
+
+    @property
+    def in_flight(self) -> int:
+        return self._running
+
+    def estimate_wait(self) -> float:
+        if self._running < self.max_concurrency and self._queued == 0:
+            return 0.0
+        waves = math.ceil((self._queued + 1) / self.max_concurrency)
+        return waves * self.service_time
+
+    def check_admission(self, deadline: float | None = None):
+        # deferする前に呼び出して、受け付けられないリクエストをすぐに断れるようにする
+        if self._queued >= self.max_queue:
+            REJECTED.inc(scheduler=self.name, reason='queue_full')
+            raise QueueFull(f"{self.name} queue is full ({self._queued} waiting)")
+        if deadline is not None:
+            remaining = deadline - asyncio.get_running_loop().time()
+            if self.estimate_wait() + self.service_time > remaining:
+                REJECTED.inc(scheduler=self.name, reason='deadline')
+                raise DeadlineExceeded(f"{self.name} cannot finish within {remaining:.0f}s")
+
+    async def submit(self, key, factory, *, user=None, deadline: float | None = None, retry_if=None):
+        # user を指定すると、同じキーの中でそのユーザーの同時実行数を per_user_concurrency に制限する
+        loop = asyncio.get_running_loop()
+        self.check_admission(deadline)
+
+        ticket = _Ticket(key, user, loop.create_future(), loop.time())
+        self._queues.setdefault(key, deque()).append(ticket)
+        self._queued += 1
+        self._dispatch()
+
+        timeout = None if deadline is None else max(0.0, deadline - loop.time() - self.service_time)
+        try:
+            await asyncio.wait_for(ticket.future, timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if ticket.future.done() and not ticket.future.cancelled():
+                # 諦めたのと同時に枠が割り当てられた場合は返却する
+                self._release(ticket)
+            else:
+                self._discard(ticket)
+            if isinstance(e, asyncio.TimeoutError):
+                REJECTED.inc(scheduler=self.name, reason='deadline')
+                raise DeadlineExceeded(f"{self.name} request waited too long in the queue") from None
+            raise
+
+        WAIT_SECONDS.observe(loop.time() - ticket.enqueued_at, scheduler=self.name)
+        try:
+            return await self._run_with_retry(factory, deadline, retry_if)
+        finally:
+            self._release(ticket)
+
+    async def _run_with_retry(self, factory, deadline, retry_if):
+        loop = asyncio.get_running_loop()
+        attempt = 0
+        while True:
+            started = loop.time()
+            try:
+                result = await factory()
+            except self.retry_on as e:
+                if attempt >= self.max_retries or (retry_if is not None and not retry_if(e)):
+                    raise
+                # full jitter: 0〜上限の一様乱数だけ待つ
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                if deadline is not None and loop.time() + delay + self.service_time > deadline:
+                    raise
+                attempt += 1
+                RETRIES.inc(scheduler=self.name)
+                logger.warning(f"{self.name} request rate limited ({e}); retry {attempt}/{self.max_retries} in {delay:.2f}s")
+                await asyncio.sleep(delay)
+                continue
+            self.service_time = 0.8 * self.service_time + 0.2 * (loop.time() - started)
+            return result
+
+    def _dispatch(self):
+        while self._running < self.max_concurrency and self._queues:
+            for key in list(self._queues):
+                if self._active[key] >= self.per_key_concurrency:
+                    continue
+                ticket = self._take(key)
+                if ticket is None:
+                    continue
+                if ticket.future.done():
+                    # 待機側がすでにキャンセル済み
+                    break
+                self._active[key] += 1
+                if ticket.user is not None:
+                    self._active_users[(key, ticket.user)] += 1
+                self._running += 1
+                ticket.future.set_result(None)
+                break
+            else:
+                break
+
+    def _take(self, key) -> _Ticket | None:
+        # キーの待ち行列から、同時実行数に空きのあるユーザーの最も古いリクエストを取り出す
+        queue = self._queues[key]
+        for index, ticket in enumerate(queue):
+            if ticket.future.done() or ticket.user is None or self._active_users[(key, ticket.user)] < self.per_user_concurrency:
+                break
+        else:
+            return None
+        del queue[index]
+        self._queued -= 1
+        if queue:
+            # 取り出したキーは列の最後に回す(ラウンドロビン)
+            self._queues.move_to_end(key)
+        else:
+            del self._queues[key]
+        return ticket
+
+    def _discard(self, ticket: _Ticket):
+        queue = self._queues.get(ticket.key)
+        if queue is None:
+            return
+        try:
+            queue.remove(ticket)
+        except ValueError:
+            return
+        self._queued -= 1
+        if not queue:
+            del self._queues[ticket.key]
+
+    def _release(self, ticket: _Ticket):
+        self._running -= 1
+        self._active[ticket.key] -= 1
+        if self._active[ticket.key] <= 0:
+            del self._active[ticket.key]
+        if ticket.user is not None:
+            user_key = (ticket.key, ticket.user)
+            self._active_users[user_key] -= 1
+            if self._active_users[user_key] <= 0:
+                del self._active_users[user_key]
+        self._dispatch()
+
+    def collect(self):
+        labels = {'scheduler': self.name}
+        yield 'folium_ai_queue_depth', 'gauge', 'AI requests waiting for a concurrency slot.', [(labels, self._queued)]
+        yield 'folium_ai_in_flight', 'gauge', 'AI requests currently running upstream.', [(labels, self._running)]
+        yield 'folium_ai_service_time_seconds', 'gauge', 'Moving average of upstream AI request duration.', [(labels, self.service_time)]
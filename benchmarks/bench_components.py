@@ -0,0 +1,125 @@
+# 送信済みのボタン付きメッセージが大量にあるときのメモリ使用量を比較する
+# - per-message: 以前の方式。メッセージごとにView(180秒のタイムアウト付き)を作ってConnectionStateに登録する
+# - router: custom_idに状態を入れ、ロケールごとに1つのstop()済みViewを使い回す(ComponentRouterで振り分ける)
+# あわせて、クリック1回をハンドラーまで振り分ける時間も計測する
+# リポジトリのルートで `python -m benchmarks.bench_components` として実行する
+import argparse
+import asyncio
+import gc
+import time
+import tracemalloc
+
+import discord
+from discord.ui.view import ViewStore
+
+from component_router import ComponentRouter, make_custom_id
+from config_service import SETTINGS
+from cogs.interactive_ui import BUTTON_ROUTE, button_view
+
+LOCALES = (discord.Locale.american_english, discord.Locale.japanese, discord.Locale.korean, discord.Locale.russian, discord.Locale.thai)
+
+
+# 以前の ButtonView と同じ構成(メッセージごとに翻訳テーブルとタイムアウトのタスクを持つ)
+class PerMessageButtonView(discord.ui.View):
+    def __init__(self, locale):
+        super().__init__(timeout=180)
+        self.messages = SETTINGS.catalog[locale]
+
+    @discord.ui.button(custom_id="my_button", emoji="👋", style=discord.ButtonStyle.primary)
+    async def button_callback(self, interaction: discord.Interaction, button: discord.ui.Button):
+        pass
+
+
+class _Interaction:
+    # ComponentRouter.dispatch が参照する属性だけを持つ
+    __slots__ = ('type', 'data')
+
+    def __init__(self, custom_id: str):
+        self.type = discord.InteractionType.component
+        self.data = {'custom_id': custom_id, 'component_type': 2}
+
+
+def _measure(build, count: int) -> tuple[dict, object]:
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    tasks_before = len(asyncio.all_tasks())
+    start = time.perf_counter()
+    keep = build(count)
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    result = {
+        'bytes': after - before,
+        'tasks': len(asyncio.all_tasks()) - tasks_before,
+        'seconds': elapsed,
+    }
+    return result, keep
+
+
+async def per_message(count: int) -> dict:
+    store = ViewStore(state=None)
+
+    def build(n):
+        views = []
+        for message_id in range(1, n + 1):
+            view = PerMessageButtonView(LOCALES[message_id % len(LOCALES)])
+            view.to_components()
+            store.add_view(view, message_id)
+            views.append(view)
+        return views
+
+    result, views = _measure(build, count)
+    # 計測用に持っていた参照の分は差し引かない(ViewStoreも同じViewを保持しているため)
+    for view in views:
+        view.stop()
+    await asyncio.sleep(0)
+    return result
+
+
+async def router(count: int) -> dict:
+    def build(n):
+        # メッセージを送っても何も保持しない。ペイロードの組み立てだけを行う
+        for message_id in range(1, n + 1):
+            button_view(SETTINGS.catalog[LOCALES[message_id % len(LOCALES)]]).to_components()
+        return None
+
+    return _measure(build, count)[0]
+
+
+async def dispatch_seconds(clicks: int) -> float:
+    components = ComponentRouter()
+
+    async def handler(interaction, locale):
+        pass
+
+    components.add(BUTTON_ROUTE, handler)
+    interactions = [_Interaction(make_custom_id(BUTTON_ROUTE, locale.value)) for locale in LOCALES]
+    start = time.perf_counter()
+    for index in range(clicks):
+        await components.dispatch(interactions[index % len(interactions)])
+    return (time.perf_counter() - start) / clicks
+
+
+async def run(count: int, clicks: int):
+    print(f"{count} live button messages")
+    for name, bench in (('per-message', per_message), ('router', router)):
+        result = await bench(count)
+        print(
+            f"  {name:<12} {result['bytes'] / 2**20:>8.1f} MiB ({result['bytes'] / count:>7.1f} B/message)"
+            f"  timeout tasks {result['tasks']:>7}  build {result['seconds']:.2f}s"
+        )
+    print(f"router dispatch: {await dispatch_seconds(clicks) * 1e6:.2f} us/click")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=100_000)
+    parser.add_argument('--clicks', type=int, default=200_000)
+    args = parser.parse_args()
+    asyncio.run(run(args.messages, args.clicks))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+# ギルド設定の同時読み書きスループットを、従来のエンジン設定と調整後の設定で比較する
+# あわせて、1件ずつのコミットとWriteBehindQueueによる一括upsertの書き込みスループットも比較する
+# リポジトリのルートで `python -m benchmarks.bench_database` として実行する
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+
+from sqlalchemy import select
+
+from database import DEFAULT_SQLITE_PRAGMAS, Database, WriteBehindQueue
+from models import Guild
+
+
+async def populate(db: Database, guilds: int):
+    await db.init_db()
+    async with db.get_session() as session:
+        session.add_all(Guild(guild_id=guild_id, prefix="!") for guild_id in range(guilds))
+        await session.commit()
+
+
+async def read_prefix(db: Database, guild_id: int, read_only: bool):
+    session_factory = db.read_session if read_only else db.get_session
+    async with session_factory() as session:
+        result = await session.execute(select(Guild.prefix).where(Guild.guild_id == guild_id))
+        return result.scalar_one_or_none()
+
+
+async def write_prefix(db: Database, guild_id: int):
+    async with db.get_session() as session:
+        result = await session.execute(select(Guild).where(Guild.guild_id == guild_id))
+        guild = result.scalar_one()
+        guild.prefix = random.choice("!?$%&")
+        await session.commit()
+
+
+async def run_workload(db: Database, guilds: int, concurrency: int, operations: int, write_ratio: float, read_only: bool):
+    errors = 0
+
+    async def worker(count: int):
+        nonlocal errors
+        for _ in range(count):
+            guild_id = random.randrange(guilds)
+            try:
+                if random.random() < write_ratio:
+                    await write_prefix(db, guild_id)
+                else:
+                    await read_prefix(db, guild_id, read_only)
+            except Exception:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(operations // concurrency) for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    return operations / elapsed, errors
+
+
+async def bench(name: str, make_db, args, read_only: bool):
+    with tempfile.TemporaryDirectory() as tmp:
+        db = make_db(f"sqlite+aiosqlite:///{os.path.join(tmp, 'bench.db')}")
+        await populate(db, args.guilds)
+        for write_ratio in (0.0, 0.1, 0.5):
+            throughput, errors = await run_workload(db, args.guilds, args.concurrency, args.operations, write_ratio, read_only)
+            print(f"{name:<10} writes={write_ratio:>4.0%}  {throughput:>9.0f} ops/s  errors={errors}")
+        await db.close()
+
+
+async def bench_writes(args):
+    # 一部のギルドに更新が集中する(一括変更スクリプトや荒らし対応を想定)
+    hot = max(1, args.guilds // 100)
+    updates = [(random.randrange(hot), random.choice("!?$%&")) for _ in range(args.operations)]
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(f"sqlite+aiosqlite:///{os.path.join(tmp, 'bench.db')}", pool_size=8, max_overflow=8, sqlite_pragmas=DEFAULT_SQLITE_PRAGMAS)
+        await populate(db, args.guilds)
+
+        semaphore = asyncio.Semaphore(args.concurrency)
+
+        async def direct(guild_id: int):
+            async with semaphore:
+                await write_prefix(db, guild_id)
+
+        start = time.perf_counter()
+        results = await asyncio.gather(*(direct(guild_id) for guild_id, _ in updates), return_exceptions=True)
+        elapsed = time.perf_counter() - start
+        errors = sum(1 for result in results if isinstance(result, Exception))
+        print(f"{'per-call':<10} {len(updates) / elapsed:>9.0f} writes/s  errors={errors}")
+
+        writer = WriteBehindQueue(db, Guild, key='guild_id', max_batch=500, flush_interval=0.05)
+        writer.start()
+        start = time.perf_counter()
+        for guild_id, prefix in updates:
+            await writer.submit(guild_id, prefix=prefix)
+        await writer.close()
+        elapsed = time.perf_counter() - start
+        print(f"{'batched':<10} {len(updates) / elapsed:>9.0f} writes/s  (including final flush)")
+        await db.close()
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--guilds', type=int, default=10000)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--operations', type=int, default=5000)
+    args = parser.parse_args()
+
+    random.seed(0)
+    await bench("default", lambda url: Database(url), args, read_only=False)
+    await bench("tuned", lambda url: Database(url, pool_size=8, max_overflow=8, sqlite_pragmas=DEFAULT_SQLITE_PRAGMAS, query_cache_size=1000), args, read_only=True)
+    await bench_writes(args)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,137 @@
+# guildsテーブルの主キーを、以前の構成(連番のid + 文字列のguild_id UNIQUE)と整数のguild_id主キーで比較する
+# - 1件ずつの読み込み(GuildConfigCacheがキャッシュにないギルドを読むときと同じクエリ)
+# - WriteBehindQueueと同じ一括upsert(既存のギルドの更新と新しいギルドの追加を半分ずつ)
+# - データベースファイルの大きさと、以前の構成から移行するマイグレーションの時間
+# リポジトリのルートで `python -m benchmarks.bench_guild_keys` として実行する
+import argparse
+import asyncio
+import os
+import random
+import sqlite3
+import tempfile
+import time
+
+from sqlalchemy import Column, Integer, String, select
+from sqlalchemy.orm import declarative_base
+
+from database import DEFAULT_SQLITE_PRAGMAS, Database
+from migrations import migrate
+from models import Guild
+
+# snowflakeに近い大きさのID
+FIRST_GUILD_ID = 10**17
+
+LegacyBase = declarative_base()
+
+
+# マイグレーション前の構成
+class LegacyGuild(LegacyBase):
+    __tablename__ = 'guilds'
+
+    id = Column(Integer, primary_key=True)
+    guild_id = Column(String, unique=True, nullable=False)
+    prefix = Column(String, default="!")
+
+
+def populate(path: str, guilds: int, legacy: bool):
+    # 100万行をSQLAlchemy経由で入れると時間がかかるため、sqlite3で直接作る
+    conn = sqlite3.connect(path)
+    if legacy:
+        conn.execute("CREATE TABLE guilds (id INTEGER NOT NULL, guild_id VARCHAR NOT NULL, prefix VARCHAR, PRIMARY KEY (id), UNIQUE (guild_id))")
+        rows = ((str(FIRST_GUILD_ID + i * 4096), "!") for i in range(guilds))
+    else:
+        conn.execute("CREATE TABLE guilds (guild_id INTEGER NOT NULL, prefix VARCHAR, PRIMARY KEY (guild_id))")
+        rows = ((FIRST_GUILD_ID + i * 4096, "!") for i in range(guilds))
+    conn.executemany("INSERT INTO guilds (guild_id, prefix) VALUES (?, ?)", rows)
+    conn.commit()
+    conn.execute("VACUUM")
+    conn.close()
+
+
+def guild_key(index: int, legacy: bool):
+    guild_id = FIRST_GUILD_ID + index * 4096
+    return str(guild_id) if legacy else guild_id
+
+
+async def lookups(db: Database, model, guilds: int, operations: int, concurrency: int, legacy: bool) -> float:
+    keys = [guild_key(random.randrange(guilds), legacy) for _ in range(operations)]
+
+    async def worker(chunk):
+        for key in chunk:
+            async with db.read_session() as session:
+                result = await session.execute(select(model.prefix).where(model.guild_id == key))
+                result.scalar_one_or_none()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(keys[i::concurrency]) for i in range(concurrency)))
+    return operations / (time.perf_counter() - start)
+
+
+def raw_lookups(path: str, guilds: int, operations: int, legacy: bool) -> float:
+    # SQLAlchemyとaiosqliteを通さない、SQLite自体の検索の速さ
+    conn = sqlite3.connect(path)
+    keys = [guild_key(random.randrange(guilds), legacy) for _ in range(operations)]
+    start = time.perf_counter()
+    for key in keys:
+        conn.execute("SELECT prefix FROM guilds WHERE guild_id = ?", (key,)).fetchone()
+    elapsed = time.perf_counter() - start
+    conn.close()
+    return operations / elapsed
+
+
+async def upserts(db: Database, model, guilds: int, operations: int, batch: int, legacy: bool) -> float:
+    rows = []
+    for n in range(operations):
+        # 半分は既存のギルドの更新、半分は新しいギルド
+        index = random.randrange(guilds) if n % 2 else guilds + n
+        rows.append({'guild_id': guild_key(index, legacy), 'prefix': random.choice("!?$%&")})
+    start = time.perf_counter()
+    for i in range(0, len(rows), batch):
+        await db.bulk_upsert(model, rows[i:i + batch], ['guild_id'])
+    return operations / (time.perf_counter() - start)
+
+
+async def bench(name: str, model, args, legacy: bool):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.db')
+        start = time.perf_counter()
+        populate(path, args.guilds, legacy)
+        populate_seconds = time.perf_counter() - start
+        size = os.path.getsize(path)
+
+        raw = raw_lookups(path, args.guilds, args.operations, legacy)
+        db = Database(f"sqlite+aiosqlite:///{path}", pool_size=8, max_overflow=8, sqlite_pragmas=DEFAULT_SQLITE_PRAGMAS, query_cache_size=1000)
+        read = await lookups(db, model, args.guilds, args.operations, args.concurrency, legacy)
+        write = await upserts(db, model, args.guilds, args.operations, args.batch, legacy)
+        print(
+            f"{name:<8} file {size / 2**20:>7.1f} MiB  lookups {read:>8.0f}/s (sqlite3 {raw:>8.0f}/s)"
+            f"  upserts {write:>8.0f} rows/s  (populate {populate_seconds:.1f}s)"
+        )
+
+        if legacy:
+            start = time.perf_counter()
+            applied = await migrate(db.engine)
+            elapsed = time.perf_counter() - start
+            await db.close()
+            print(f"{'':<8} migration {[m.name for m in applied]} took {elapsed:.1f}s, file {os.path.getsize(path) / 2**20:.1f} MiB afterwards (before VACUUM)")
+        else:
+            await db.close()
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--guilds', type=int, default=1_000_000)
+    parser.add_argument('--operations', type=int, default=20000)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--batch', type=int, default=500, help='rows per upsert (database.write_behind.max_batch)')
+    args = parser.parse_args()
+
+    print(f"{args.guilds} guilds, {args.operations} operations")
+    random.seed(0)
+    await bench("string", LegacyGuild, args, legacy=True)
+    random.seed(0)
+    await bench("integer", Guild, args, legacy=False)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
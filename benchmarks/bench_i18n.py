@@ -0,0 +1,40 @@
+# ロケール解決のマイクロベンチマーク
+# リポジトリのルートで `python -m benchmarks.bench_i18n` として実行する
+import timeit
+
+import discord
+
+from i18n import MessageCatalog, load_translations
+
+TRANSLATIONS = load_translations()
+CATALOG = MessageCatalog(TRANSLATIONS)
+
+LOCALES = [discord.Locale.japanese, discord.Locale.american_english, discord.Locale.korean, discord.Locale.french]
+NUMBER = 200_000
+
+
+def legacy_lookup(locale):
+    # 従来のコマンドハンドラーと同じ手順
+    # (discord.Localeと文字列キーを比較するため、in の判定は常に偽になる)
+    locale = locale if locale in TRANSLATIONS else discord.Locale.american_english
+    messages = TRANSLATIONS.get(str(locale).replace('_', '-'), TRANSLATIONS['en-US'])
+    return messages["setprefix_response_success"].format(prefix="!")
+
+
+def catalog_lookup(locale):
+    return CATALOG[locale].format("setprefix_response_success", prefix="!")
+
+
+def catalog_constant_lookup(locale):
+    return CATALOG[locale]["setprefix_response_guild_only"]
+
+
+def main():
+    for name, func in (("legacy", legacy_lookup), ("catalog", catalog_lookup), ("catalog (no args)", catalog_constant_lookup)):
+        for locale in LOCALES:
+            elapsed = min(timeit.repeat(lambda: func(locale), number=NUMBER, repeat=5))
+            print(f"{name:<18} {locale.value:<6} {elapsed / NUMBER * 1e9:8.1f} ns/op  -> {func(locale)!r}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+# 起動時間を計測する。モジュールごとの(コールドな)import時間と、
+# setup_hook相当の処理(DB初期化・Cog読み込み・コマンドツリーのハッシュ計算)が終わるまでの時間を表示する
+# Discordへは接続しないため、tree.sync()自体の時間は含まない
+# リポジトリのルートで `python -m benchmarks.bench_startup` として実行する
+import argparse
+import asyncio
+import statistics
+import subprocess
+import sys
+import time
+
+MODULES = ('i18n', 'config_service', 'database', 'instrumentation', 'cogs.ai_commands', 'main')
+
+
+def cold_import_seconds(module: str, repeat: int) -> list[float]:
+    # 毎回新しいインタプリタで読み込み、先に読み込まれたモジュールの影響を受けないようにする
+    code = f"import time; start = time.perf_counter(); import {module}; print(time.perf_counter() - start)"
+    samples = []
+    for _ in range(repeat):
+        result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True)
+        if result.returncode != 0:
+            raise RuntimeError(f"import {module} failed: {result.stderr.strip().splitlines()[-1]}")
+        samples.append(float(result.stdout.strip().splitlines()[-1]))
+    return samples
+
+
+async def time_to_ready(lazy: bool) -> dict:
+    import main
+
+    main.SETTINGS.apply_overrides({
+        'database': {'type': 'sqlite', 'path': ':memory:'},
+        'startup': {'lazy_imports': lazy},
+        'metrics': {'exporter': {'enabled': False}},
+        'reload': {'enabled': False},
+    })
+
+    timings = {}
+    start = time.perf_counter()
+    bot = main.MyBot()
+    timings['construct'] = time.perf_counter() - start
+
+    # login()の代わりに、ループ周りの初期化だけを行う非同期コンテキストの中で計測する
+    async with bot:
+        phase = time.perf_counter()
+        await bot.start_services()
+        timings['services'] = time.perf_counter() - phase
+
+        phase = time.perf_counter()
+        await bot.load_initial_extensions()
+        timings['extensions'] = time.perf_counter() - phase
+
+        phase = time.perf_counter()
+        await bot.command_tree_digest()
+        timings['tree_hash'] = time.perf_counter() - phase
+
+        timings['ready'] = time.perf_counter() - start
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--eager', action='store_true', help='load heavy dependencies in cog_load (startup.lazy_imports: false)')
+    args = parser.parse_args()
+
+    print("cold import (median of fresh interpreters)")
+    for module in MODULES:
+        try:
+            samples = cold_import_seconds(module, args.repeat)
+            print(f"  {module:<18} {statistics.median(samples) * 1000:>8.1f} ms")
+        except RuntimeError as e:
+            print(f"  {module:<18} {'-':>8}     ({e})")
+
+    timings = asyncio.run(time_to_ready(lazy=not args.eager))
+    print(f"time to ready ({'eager' if args.eager else 'lazy'} imports, no gateway)")
+    for name, seconds in timings.items():
+        print(f"  {name:<18} {seconds * 1000:>8.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
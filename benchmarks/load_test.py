@@ -0,0 +1,597 @@
+# オフラインの負荷試験。合成したInteractionを本物のコマンドツリー・Viewに流し、シナリオごとに
+# スループット・応答遅延のパーセンタイル・イベントループ遅延・メモリを計測してJSONに保存する
+# Discordへは接続しない。応答・フォローアップは偽物に差し替え、Vertex AIはローカルのMockGenerativeModelに置き換える
+# リポジトリのルートで `python -m benchmarks.load_test` として実行する
+# 例: python -m benchmarks.load_test --scenarios ping,ask --concurrency 1,16,64 --ai-latency 0.5 --ai-error-rate 0.05
+#     python -m benchmarks.load_test --baseline results/load_test.json (前回の結果と比べ、悪化していれば終了コード1)
+import argparse
+import asyncio
+import gc
+import io
+import itertools
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+
+import discord
+import psutil
+
+from system_metrics import percentile
+
+SCENARIOS = ('ping', 'getprefix', 'setprefix', 'button', 'select', 'modal', 'ask', 'ask_stream', 'imagine')
+LOCALES = ('en-US', 'ja', 'ko', 'ru', 'th')
+APPLICATION_ID = 100000000000000001
+GUILD_ID = 200000000000000001
+CHANNEL_ID = 300000000000000001
+
+_ids = itertools.count(1)
+
+
+def snowflake() -> int:
+    # 作成時刻(/ask のフォローアップ期限の計算に使われる)が現在になるID
+    return discord.utils.time_snowflake(discord.utils.utcnow()) + next(_ids) % 4096
+
+
+# ---- Vertex AI の代わり ----
+
+class MockUnavailable(Exception):
+    # google.api_core.exceptions.ServiceUnavailable の代わり(スケジューラーの再試行対象にする)
+    pass
+
+
+class _MockChunk:
+    __slots__ = ('text',)
+
+    def __init__(self, text: str):
+        self.text = text
+
+
+class _MockImage:
+    __slots__ = ('_image_bytes',)
+
+    def __init__(self, data: bytes):
+        self._image_bytes = data
+
+
+class _MockImageResponse:
+    def __init__(self, data: bytes):
+        self.images = [_MockImage(data)]
+
+
+def _sample_png(size: int = 256) -> bytes:
+    from PIL import Image
+
+    buffer = io.BytesIO()
+    Image.new('RGB', (size, size), (64, 128, 192)).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+# vertexai.preview.generative_models.GenerativeModel と同じ呼び出し方ができるスタンドイン
+# latency 秒(±jitter)で応答し、error_rate の割合で MockUnavailable を送出する
+class MockGenerativeModel:
+    def __init__(self, latency: float = 0.5, jitter: float = 0.2, error_rate: float = 0.0, chunks: int = 8, reply_chars: int = 600, image: bytes | None = None, seed: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.chunks = chunks
+        self.reply_chars = reply_chars
+        self.image = image
+        self.calls = 0
+        self.errors = 0
+        self._random = random.Random(seed)
+
+    def _delay(self) -> float:
+        return max(0.0, self.latency + self._random.uniform(-self.jitter, self.jitter))
+
+    def _maybe_fail(self):
+        if self._random.random() < self.error_rate:
+            self.errors += 1
+            raise MockUnavailable("mock model unavailable")
+
+    async def generate_content_async(self, contents, stream: bool = False):
+        self.calls += 1
+        if self.image is not None:
+            await asyncio.sleep(self._delay())
+            self._maybe_fail()
+            return _MockImageResponse(self.image)
+        text = ("lorem ipsum dolor sit amet " * (self.reply_chars // 27 + 1))[:self.reply_chars]
+        if not stream:
+            await asyncio.sleep(self._delay())
+            self._maybe_fail()
+            return _MockChunk(text)
+        self._maybe_fail()
+        return self._stream(text)
+
+    async def _stream(self, text: str):
+        # 最初のチャンクまでに遅延の半分、残りを各チャンクに分ける
+        delay = self._delay()
+        step = max(1, len(text) // self.chunks)
+        await asyncio.sleep(delay / 2)
+        for index in range(0, len(text), step):
+            yield _MockChunk(text[index:index + step])
+            await asyncio.sleep(delay / 2 / self.chunks)
+
+
+# ---- Discordへの応答の代わり ----
+
+class FakeWebhookMessage:
+    def __init__(self, api_latency: float):
+        self.id = snowflake()
+        self.api_latency = api_latency
+
+    async def edit(self, **kwargs):
+        await asyncio.sleep(self.api_latency)
+        return self
+
+
+# interaction.followup の代わり
+class FakeFollowup:
+    def __init__(self, api_latency: float):
+        self.api_latency = api_latency
+        self.sent = 0
+
+    async def send(self, content=None, *, embed=None, embeds=None, view=None, file=None, files=None, ephemeral=False, wait=False, **kwargs):
+        _serialize(embed, embeds, view)
+        await asyncio.sleep(self.api_latency)
+        self.sent += 1
+        return FakeWebhookMessage(self.api_latency)
+
+
+def _serialize(embed, embeds, view):
+    # 本物と同じくペイロードを組み立てる(この処理の時間も計測に含める)
+    for item in ([embed] if embed else []) + list(embeds or []):
+        item.to_dict()
+    if view is not None:
+        view.to_components()
+
+
+# interaction.response の代わり。最初の応答の時刻を記録し、Viewは本物と同じくConnectionStateに登録する
+class FakeResponse:
+    def __init__(self, interaction, api_latency: float):
+        self._parent = interaction
+        self.api_latency = api_latency
+        self.kind: str | None = None
+        self.responded_at: float | None = None
+        self.acknowledged = asyncio.get_running_loop().create_future()
+        self.views: list[tuple[int, discord.ui.View]] = []
+        self.modal: discord.ui.Modal | None = None
+
+    def is_done(self) -> bool:
+        return self.kind is not None
+
+    def _mark(self, kind: str):
+        if self.kind is not None:
+            raise discord.InteractionResponded(self._parent)
+        self.kind = kind
+        self.responded_at = time.perf_counter()
+
+    def _acknowledge(self):
+        if not self.acknowledged.done():
+            self.acknowledged.set_result(None)
+
+    async def send_message(self, content=None, *, embed=None, embeds=None, view=None, file=None, files=None, ephemeral=False, **kwargs):
+        self._mark('message')
+        _serialize(embed, embeds, view)
+        await asyncio.sleep(self.api_latency)
+        if view is not None:
+            message_id = snowflake()
+            if not view.is_finished():
+                self._parent._state.store_view(view, message_id)
+            self.views.append((message_id, view))
+        self._acknowledge()
+
+    async def defer(self, *, ephemeral=False, thinking=False):
+        self._mark('defer')
+        await asyncio.sleep(self.api_latency)
+        self._acknowledge()
+
+    async def send_modal(self, modal):
+        self._mark('modal')
+        modal.to_dict()
+        await asyncio.sleep(self.api_latency)
+        if not modal.is_finished():
+            self._parent._state.store_view(modal)
+        self.modal = modal
+        self._acknowledge()
+
+    async def edit_message(self, **kwargs):
+        self._mark('edit')
+        _serialize(kwargs.get('embed'), kwargs.get('embeds'), kwargs.get('view'))
+        await asyncio.sleep(self.api_latency)
+        self._acknowledge()
+
+
+# ---- 合成Interaction ----
+
+def _user_payload(user_id: int) -> dict:
+    return {'id': str(user_id), 'username': f'loadtest{user_id % 10000}', 'discriminator': '0', 'global_name': None, 'avatar': None}
+
+
+def _interaction_payload(kind: int, data: dict, user_id: int, locale: str, message: dict | None = None) -> dict:
+    payload = {
+        'id': str(snowflake()),
+        'application_id': str(APPLICATION_ID),
+        'type': kind,
+        'token': 'loadtest',
+        'version': 1,
+        'data': data,
+        'guild_id': str(GUILD_ID),
+        'channel': {'id': str(CHANNEL_ID), 'type': 0, 'guild_id': str(GUILD_ID), 'name': 'load-test', 'position': 0, 'permission_overwrites': [], 'nsfw': False, 'parent_id': None},
+        'member': {
+            'user': _user_payload(user_id),
+            'roles': [],
+            'joined_at': '2024-01-01T00:00:00+00:00',
+            'deaf': False,
+            'mute': False,
+            'flags': 0,
+            'permissions': str(discord.Permissions.all().value),
+        },
+        'locale': locale,
+        'guild_locale': 'en-US',
+        'app_permissions': str(discord.Permissions.all().value),
+        'attachment_size_limit': 10 * 1024 * 1024,
+        'entitlements': [],
+        'authorizing_integration_owners': {},
+    }
+    if message is not None:
+        payload['message'] = message
+    return payload
+
+
+def _message_payload(message_id: int, view: discord.ui.View) -> dict:
+    return {
+        'id': str(message_id),
+        'channel_id': str(CHANNEL_ID),
+        'type': 0,
+        'content': '',
+        'embeds': [],
+        'attachments': [],
+        'timestamp': discord.utils.utcnow().isoformat(),
+        'edited_timestamp': None,
+        'pinned': False,
+        'mention_everyone': False,
+        'tts': False,
+        'mentions': [],
+        'mention_roles': [],
+        'author': _user_payload(APPLICATION_ID),
+        'components': view.to_components(),
+        'flags': 0,
+    }
+
+
+def make_interaction(bot, payload: dict, api_latency: float) -> discord.Interaction:
+    interaction = discord.Interaction(data=payload, state=bot._connection)
+    interaction._cs_response = FakeResponse(interaction, api_latency)
+    interaction._cs_followup = FakeFollowup(api_latency)
+    return interaction
+
+
+def dispatch(bot, interaction: discord.Interaction, payload: dict):
+    # ConnectionState.parse_interaction_create と同じ振り分け(Interactionだけを差し替えたもの)
+    state = bot._connection
+    data = payload['data']
+    if payload['type'] == 2:
+        task = asyncio.create_task(bot.tree._call(interaction))
+    elif payload['type'] == 3:
+        state._view_store.dispatch_view(data['component_type'], data['custom_id'], interaction)
+        task = None
+    else:
+        state._view_store.dispatch_modal(data['custom_id'], interaction, data['components'], data.get('resolved', {}))
+        task = None
+    bot.dispatch('interaction', interaction)
+    return task
+
+
+def command_name(bot, key: str) -> str:
+    return bot.settings.translations['en-US'][key]
+
+
+def _command_data(bot, key: str, options: dict | None = None) -> dict:
+    data = {'id': str(APPLICATION_ID + 1), 'name': command_name(bot, key), 'type': 1}
+    if options:
+        data['options'] = [{'name': name, 'type': option_type, 'value': value} for name, (option_type, value) in options.items()]
+    return data
+
+
+def _component_for(view: discord.ui.View, component_type: int):
+    for item in view.children:
+        if item.to_component_dict()['type'] == component_type:
+            return item
+    raise LookupError(f"No component of type {component_type} in {view!r}")
+
+
+# ---- シナリオ ----
+
+class Runner:
+    def __init__(self, bot, args):
+        self.bot = bot
+        self.args = args
+        self.random = random.Random(args.seed)
+
+    def _user(self) -> int:
+        # 同じユーザーに集中させないよう users 人で回す(会話・レート制限はユーザー単位)
+        return 400000000000000001 + self.random.randrange(self.args.users)
+
+    def _locale(self) -> str:
+        return self.random.choice(LOCALES)
+
+    async def _command(self, key: str, options: dict | None = None, user_id: int | None = None, locale: str | None = None):
+        payload = _interaction_payload(2, _command_data(self.bot, key, options), user_id or self._user(), locale or self._locale())
+        interaction = make_interaction(self.bot, payload, self.args.api_latency)
+        start = time.perf_counter()
+        await dispatch(self.bot, interaction, payload)
+        return interaction, start
+
+    async def _component(self, view_holder: FakeResponse, component_type: int, values=None, locale: str | None = None):
+        message_id, view = view_holder.views[0]
+        item = _component_for(view, component_type)
+        data = {'custom_id': item.custom_id, 'component_type': component_type}
+        if values is not None:
+            data['values'] = values
+        payload = _interaction_payload(3, data, self._user(), locale or self._locale(), _message_payload(message_id, view))
+        interaction = make_interaction(self.bot, payload, self.args.api_latency)
+        start = time.perf_counter()
+        dispatch(self.bot, interaction, payload)
+        await asyncio.wait_for(interaction.response.acknowledged, self.args.timeout)
+        return interaction, start
+
+    async def one(self, scenario: str, context: dict) -> tuple[float, float, bool]:
+        # (最初の応答までの秒数, 完了までの秒数, 失敗したか) を返す
+        if scenario == 'ping':
+            interaction, start = await self._command('ping_command_name')
+        elif scenario == 'getprefix':
+            interaction, start = await self._command('getprefix_command_name')
+        elif scenario == 'setprefix':
+            interaction, start = await self._command('setprefix_command_name', {'prefix': (3, self.random.choice('!?$%&'))})
+        elif scenario in ('ask', 'ask_stream'):
+            # 半分は新しい会話、残りは同じユーザーの会話の続き(履歴の読み込みを含む)
+            options = {'question': (3, f"question {self.random.randrange(self.args.distinct_questions)}")}
+            if self.random.random() < 0.5:
+                options['new_conversation'] = (5, True)
+            interaction, start = await self._command('ask_command_name', options)
+        elif scenario == 'imagine':
+            interaction, start = await self._command('imagine_command_name', {'prompt': (3, "a lighthouse at dusk")})
+        elif scenario in ('button', 'select'):
+            interaction, start = await self._component(context['holder'], 2 if scenario == 'button' else 3, None if scenario == 'button' else ['blue'], context['locale'])
+        elif scenario == 'modal':
+            # モーダルは送信されると閉じるので、毎回開いてから送信する
+            opener, start = await self._command('modal_test_command_name')
+            modal = opener.response.modal
+            data = {
+                'custom_id': modal.custom_id,
+                'components': [
+                    {'type': 1, 'components': [{'type': 4, 'custom_id': 'name_input', 'value': 'Load Test'}]},
+                    {'type': 1, 'components': [{'type': 4, 'custom_id': 'age_input', 'value': '30'}]},
+                ],
+            }
+            payload = _interaction_payload(5, data, self._user(), str(opener.locale))
+            interaction = make_interaction(self.bot, payload, self.args.api_latency)
+            dispatch(self.bot, interaction, payload)
+            await asyncio.wait_for(interaction.response.acknowledged, self.args.timeout)
+        else:
+            raise ValueError(f"Unknown scenario: {scenario}")
+
+        finished = time.perf_counter()
+        response = interaction.response
+        failed = response.responded_at is None or getattr(interaction, 'command_failed', False)
+        acknowledged = (response.responded_at or finished) - start
+        return acknowledged, finished - start, failed
+
+    async def prepare(self, scenario: str) -> dict:
+        # ボタン・セレクトメニューは、先にそれを含むメッセージを送っておく
+        if scenario in ('button', 'select'):
+            locale = self._locale()
+            opener, _ = await self._command('button_test_command_name' if scenario == 'button' else 'select_test_command_name', locale=locale)
+            return {'holder': opener.response, 'locale': locale}
+        return {}
+
+
+class LoopLagMonitor:
+    # interval ごとに起きて、予定より遅れた時間をイベントループの遅延として記録する。あわせてRSSの最大値も記録する
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.lags: list[float] = []
+        self.peak_rss = 0
+        self._process = psutil.Process()
+        self._task: asyncio.Task | None = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        ticks = 0
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(0.0, loop.time() - expected))
+            ticks += 1
+            if ticks % 10 == 0:
+                self.peak_rss = max(self.peak_rss, self._process.memory_info().rss)
+
+    def __enter__(self):
+        self.peak_rss = self._process.memory_info().rss
+        self._task = asyncio.create_task(self._run())
+        return self
+
+    def __exit__(self, *exc):
+        self._task.cancel()
+
+
+def _summary(values: list[float]) -> dict:
+    # 値がない場合は None にする(JSONにNaNを書かないため)
+    ordered = sorted(values)
+    if not ordered:
+        return dict.fromkeys(('p50', 'p90', 'p95', 'p99', 'max', 'mean'))
+    result = {f'p{p}': percentile(ordered, p) * 1000 for p in (50, 90, 95, 99)}
+    result['max'] = ordered[-1] * 1000
+    result['mean'] = sum(ordered) / len(ordered) * 1000
+    return result
+
+
+def _ms(value) -> str:
+    return '-' if value is None else f"{value:.2f}"
+
+
+async def run_scenario(runner: Runner, scenario: str, concurrency: int, requests: int) -> dict:
+    context = await runner.prepare(scenario)
+    process = psutil.Process()
+    gc.collect()
+    rss_before = process.memory_info().rss
+    acknowledged, completed = [], []
+    failures = 0
+    remaining = itertools.count()
+
+    async def worker():
+        nonlocal failures
+        while next(remaining) < requests:
+            try:
+                ack, total, failed = await runner.one(scenario, context)
+            except Exception:
+                failures += 1
+                continue
+            acknowledged.append(ack)
+            completed.append(total)
+            failures += failed
+
+    with LoopLagMonitor() as monitor:
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+    rss_after = process.memory_info().rss
+
+    return {
+        'scenario': scenario,
+        'concurrency': concurrency,
+        'requests': requests,
+        'failures': failures,
+        'elapsed_s': elapsed,
+        'throughput_rps': len(completed) / elapsed if elapsed else 0.0,
+        'ack_ms': _summary(acknowledged),
+        'latency_ms': _summary(completed),
+        'loop_lag_ms': _summary(monitor.lags),
+        'rss_mb': {'before': rss_before / 2**20, 'after': rss_after / 2**20, 'peak': max(monitor.peak_rss, rss_after) / 2**20},
+    }
+
+
+async def build_bot(args):
+    import main
+
+    db_path = ':memory:' if args.database == 'memory' else os.path.join(tempfile.mkdtemp(prefix='folium-load-'), 'bot.db')
+    main.SETTINGS.apply_overrides({
+        'database': {'type': 'sqlite', 'path': db_path},
+        'metrics': {'exporter': {'enabled': False}},
+        'reload': {'enabled': False},
+        'scheduler': {'enabled': False},
+        'rate_limit': {'enabled': args.rate_limit},
+        'ai': {'streaming': {'enabled': False}, 'response_cache': {'enabled': not args.no_response_cache}},
+    })
+    bot = main.MyBot()
+    return bot
+
+
+def install_mock_models(bot, args):
+    cog = bot.get_cog('AICommands')
+    if cog is None:
+        return
+    cog.gemini_model = MockGenerativeModel(args.ai_latency, args.ai_jitter, args.ai_error_rate, seed=args.seed)
+    cog.imagen_model = MockGenerativeModel(args.ai_latency * 4, args.ai_jitter, args.ai_error_rate, image=_sample_png(), seed=args.seed + 1)
+    cog.scheduler.retry_on = (MockUnavailable,)
+    cog._models_loaded = True
+
+
+async def run(args) -> dict:
+    bot = await build_bot(args)
+    results = []
+    async with bot:
+        # login() の代わりに、ボット自身のユーザーとアプリケーションIDだけを設定する
+        state = bot._connection
+        state.user = discord.ClientUser(state=state, data={**_user_payload(APPLICATION_ID), 'bot': True, 'verified': True, 'mfa_enabled': False, 'flags': 0})
+        state.application_id = APPLICATION_ID
+        await bot.start_services()
+        await bot.load_initial_extensions()
+        install_mock_models(bot, args)
+        runner = Runner(bot, args)
+        for scenario in args.scenarios:
+            # ストリーミングの有無は呼び出しごとに設定から読まれるので、シナリオごとに切り替える
+            bot.settings.apply_overrides({'ai': {'streaming': {'enabled': scenario == 'ask_stream', 'edit_interval': 0.2}}})
+            for concurrency in args.concurrency:
+                result = await run_scenario(runner, scenario, concurrency, args.requests)
+                results.append(result)
+                print(
+                    f"  {scenario:<11} c={concurrency:<4} {result['throughput_rps']:>9.1f} req/s"
+                    f"  ack p50/p99 {_ms(result['ack_ms']['p50']):>7}/{_ms(result['ack_ms']['p99']):>7} ms"
+                    f"  done p99 {_ms(result['latency_ms']['p99']):>8} ms"
+                    f"  lag p99 {_ms(result['loop_lag_ms']['p99']):>6} ms"
+                    f"  rss {result['rss_mb']['peak']:>6.1f} MB"
+                    f"  fail {result['failures']}"
+                )
+    return {
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'discord_py': discord.__version__,
+        'settings': {key: value for key, value in vars(args).items() if key not in ('output', 'baseline')},
+        'results': results,
+    }
+
+
+def compare(current: dict, baseline: dict, tolerance: float) -> list[str]:
+    # 同じシナリオ・同時実行数の結果を比べ、スループットの低下またはp99の増加が tolerance を超えたものを返す
+    previous = {(r['scenario'], r['concurrency']): r for r in baseline.get('results', [])}
+    regressions = []
+    for result in current['results']:
+        before = previous.get((result['scenario'], result['concurrency']))
+        if before is None:
+            continue
+        name = f"{result['scenario']} c={result['concurrency']}"
+        if result['throughput_rps'] < before['throughput_rps'] * (1 - tolerance):
+            regressions.append(f"{name}: throughput {before['throughput_rps']:.1f} -> {result['throughput_rps']:.1f} req/s")
+        if None not in (result['latency_ms']['p99'], before['latency_ms']['p99']) and result['latency_ms']['p99'] > before['latency_ms']['p99'] * (1 + tolerance):
+            regressions.append(f"{name}: p99 {before['latency_ms']['p99']:.2f} -> {result['latency_ms']['p99']:.2f} ms")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scenarios', type=lambda value: value.split(','), default=list(SCENARIOS), help=f"comma separated: {','.join(SCENARIOS)}")
+    parser.add_argument('--concurrency', type=lambda value: [int(item) for item in value.split(',')], default=[1, 16, 64])
+    parser.add_argument('--requests', type=int, default=500, help='interactions per scenario and concurrency level')
+    parser.add_argument('--users', type=int, default=200, help='distinct synthetic users')
+    parser.add_argument('--distinct-questions', type=int, default=50, help='distinct /ask questions (lower means more response cache hits)')
+    parser.add_argument('--database', choices=('memory', 'sqlite'), default='sqlite')
+    parser.add_argument('--api-latency', type=float, default=0.0, help='simulated Discord API latency per response (seconds)')
+    parser.add_argument('--ai-latency', type=float, default=0.2)
+    parser.add_argument('--ai-jitter', type=float, default=0.05)
+    parser.add_argument('--ai-error-rate', type=float, default=0.0)
+    parser.add_argument('--rate-limit', action='store_true', help='keep rate_limit enabled (synthetic users will hit it)')
+    parser.add_argument('--no-response-cache', action='store_true')
+    parser.add_argument('--timeout', type=float, default=10.0, help='seconds to wait for a component or modal response')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='load_test_results.json')
+    parser.add_argument('--baseline', help='previous JSON results to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.15, help='allowed relative regression before failing')
+    args = parser.parse_args()
+
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    print(f"load test ({args.database} database, AI latency {args.ai_latency * 1000:.0f}ms, error rate {args.ai_error_rate:.0%})")
+    report = asyncio.run(run(args))
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f"results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for line in regressions:
+            print(f"  REGRESSION {line}")
+        if regressions:
+            sys.exit(1)
+        print("no regressions against baseline")
+
+
+if __name__ == '__main__':
+    main()
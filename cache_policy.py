@@ -0,0 +1,178 @@
+import logging
+import sys
+from collections import deque
+
+import discord
+
+logger = logging.getLogger('discord')
+
+# 大きさの見積もりで1つのキャッシュから調べるオブジェクトの数
+SIZE_SAMPLE = 50
+
+
+# Cogが必要とするゲートウェイのIntentとキャッシュ。Cogのクラス属性 cache_needs として宣言する
+# 例: cache_needs = CacheNeeds(intents=('members',), member_cache=('joined',))
+class CacheNeeds:
+    __slots__ = ('intents', 'member_cache', 'messages')
+
+    def __init__(self, intents=(), member_cache=(), messages: bool = False):
+        self.intents = frozenset(intents) # discord.Intents のフラグ名
+        self.member_cache = frozenset(member_cache) # discord.MemberCacheFlags のフラグ名
+        self.messages = messages # メッセージキャッシュ(bot.cached_messages や編集・削除イベントの before)を使うか
+
+    def __repr__(self):
+        return f"<CacheNeeds(intents={sorted(self.intents)}, member_cache={sorted(self.member_cache)}, messages={self.messages})>"
+
+
+# 実際に使うIntent・メンバーキャッシュ・メッセージキャッシュの組み合わせ
+class CachePolicy:
+    __slots__ = ('intents', 'member_cache_flags', 'max_messages', 'chunk_guilds_at_startup')
+
+    def __init__(self, intents: discord.Intents, member_cache_flags: discord.MemberCacheFlags, max_messages: int | None, chunk_guilds_at_startup: bool):
+        self.intents = intents
+        self.member_cache_flags = member_cache_flags
+        self.max_messages = max_messages
+        self.chunk_guilds_at_startup = chunk_guilds_at_startup
+
+    @classmethod
+    def from_config(cls, config, needs=()) -> 'CachePolicy':
+        # mode: auto は guilds と各Cogの宣言(と config の intents/member_cache)だけを有効にする
+        # mode: default は以前と同じ Intents.default() + message_content と既定のキャッシュを使う
+        if config.get('mode', 'auto') == 'default':
+            intents = discord.Intents.default()
+            intents.message_content = True
+            return cls(intents, discord.MemberCacheFlags.from_intents(intents), 1000, intents.members)
+
+        intent_names = {'guilds', *config.get('intents', ())}
+        member_cache = set(config.get('member_cache', ()))
+        messages = False
+        for need in needs:
+            intent_names |= need.intents
+            member_cache |= need.member_cache
+            messages = messages or need.messages
+
+        intents = discord.Intents.none()
+        for name in sorted(intent_names):
+            if name not in discord.Intents.VALID_FLAGS:
+                raise ValueError(f"Unknown intent: {name}")
+            setattr(intents, name, True)
+        # メンバーキャッシュのフラグに必要なIntentも有効にする
+        if 'joined' in member_cache:
+            intents.members = True
+        if 'voice' in member_cache:
+            intents.voice_states = True
+        flags = discord.MemberCacheFlags.none()
+        for name in sorted(member_cache):
+            if name not in discord.MemberCacheFlags.VALID_FLAGS:
+                raise ValueError(f"Unknown member cache flag: {name}")
+            setattr(flags, name, True)
+
+        max_messages = config.get('max_messages', 1000) if messages else None
+        chunk = bool(config.get('chunk_guilds_at_startup', False)) and intents.members
+        return cls(intents, flags, max_messages or None, chunk)
+
+    def client_options(self) -> dict:
+        return {
+            'intents': self.intents,
+            'member_cache_flags': self.member_cache_flags,
+            'max_messages': self.max_messages,
+            'chunk_guilds_at_startup': self.chunk_guilds_at_startup,
+        }
+
+    def apply(self, state):
+        # Cogの読み込み後(ゲートウェイに接続する前)に、Client作成時に渡した設定を差し替える
+        # discord.py の ConnectionState.__init__ が行う設定と同じ内容。IntentはIDENTIFYのときに読まれる
+        self.member_cache_flags._verify_intents(self.intents)
+        state._intents = self.intents
+        state.member_cache_flags = self.member_cache_flags
+        state._chunk_guilds = self.chunk_guilds_at_startup
+        state.max_messages = self.max_messages
+        state._messages = deque(maxlen=self.max_messages) if self.max_messages else None
+        if not self.intents.members or self.member_cache_flags._empty:
+            state.store_user = state.store_user_no_intents
+        else:
+            state.store_user = type(state).store_user.__get__(state)
+
+    def satisfies(self, needs: CacheNeeds) -> bool:
+        return (
+            all(getattr(self.intents, name) for name in needs.intents)
+            and all(getattr(self.member_cache_flags, name) for name in needs.member_cache)
+            and (self.max_messages is not None or not needs.messages)
+        )
+
+    def describe(self) -> str:
+        intents = [name for name, enabled in self.intents if enabled]
+        member_cache = [name for name, enabled in self.member_cache_flags if enabled]
+        return f"intents={intents} member_cache={member_cache or 'none'} max_messages={self.max_messages} chunk_guilds={self.chunk_guilds_at_startup}"
+
+    def __eq__(self, other):
+        return isinstance(other, CachePolicy) and (
+            self.intents.value, self.member_cache_flags.value, self.max_messages, self.chunk_guilds_at_startup
+        ) == (other.intents.value, other.member_cache_flags.value, other.max_messages, other.chunk_guilds_at_startup)
+
+    __hash__ = None
+
+
+def approx_size(obj) -> int:
+    # オブジェクト本体と、直接持っている文字列・数値・小さなコンテナの大きさ
+    # 他のキャッシュ済みオブジェクト(ギルド・ユーザーなど)への参照はたどらない
+    size = sys.getsizeof(obj)
+    values = []
+    if hasattr(obj, '__dict__'):
+        values.extend(vars(obj).values())
+    for cls in type(obj).__mro__:
+        for name in getattr(cls, '__slots__', ()):
+            if isinstance(name, str) and not name.startswith('__'):
+                values.append(getattr(obj, name, None))
+    for value in values:
+        if isinstance(value, (str, bytes, int, float)):
+            size += sys.getsizeof(value)
+        elif isinstance(value, (list, tuple, set, frozenset, dict)) and len(value) <= 64:
+            size += sys.getsizeof(value)
+    return size
+
+
+def _estimate(objects, count: int) -> int:
+    sample = []
+    for obj in objects:
+        sample.append(approx_size(obj))
+        if len(sample) >= SIZE_SAMPLE:
+            break
+    if not sample:
+        return 0
+    return int(sum(sample) / len(sample) * count)
+
+
+def cache_report(bot) -> list[tuple[str, int, int]]:
+    # (キャッシュ名, オブジェクト数, 推定バイト数)。大きさは各キャッシュの一部を調べて件数倍したもの
+    state = bot._connection
+    guilds = list(state._guilds.values())
+    report = [('guilds', len(guilds), _estimate(guilds, len(guilds)))]
+
+    def nested(name, attribute):
+        count = sum(len(getattr(guild, attribute)) for guild in guilds)
+        objects = (obj for guild in guilds for obj in getattr(guild, attribute).values())
+        report.append((name, count, _estimate(objects, count)))
+
+    nested('members', '_members')
+    nested('channels', '_channels')
+    nested('threads', '_threads')
+    nested('roles', '_roles')
+    report.append(('users', len(state._users), _estimate(state._users.values(), len(state._users))))
+    report.append(('emojis', len(state._emojis), _estimate(state._emojis.values(), len(state._emojis))))
+    report.append(('stickers', len(state._stickers), _estimate(state._stickers.values(), len(state._stickers))))
+    messages = state._messages or ()
+    report.append(('messages', len(messages), _estimate(messages, len(messages))))
+    report.append(('private_channels', len(state._private_channels), _estimate(state._private_channels.values(), len(state._private_channels))))
+    views = getattr(state, '_view_store', None)
+    if views is not None:
+        stored = [view for items in views._views.values() for view in items.values()]
+        report.append(('view_items', len(stored), _estimate(stored, len(stored))))
+    return report
+
+
+def format_report(report) -> str:
+    total = sum(size for _, _, size in report)
+    lines = [f"{name:<17} {count:>10} objects  ~{size / 1024:>10.1f} KiB" for name, count, size in report]
+    lines.append(f"{'total':<17} {sum(count for _, count, _ in report):>10} objects  ~{total / 1024:>10.1f} KiB")
+    return '\n'.join(lines)
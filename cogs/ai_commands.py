@@ -2,83 +2,302 @@ import discord
 from discord.ext import commands
 from discord import app_commands
 import logging
-import vertexai
-from vertexai.preview.generative_models import GenerativeModel, Image
-from PIL import Image as PILImage
-import io
+import asyncio
+import datetime
+import time
 
-from main import TRANSLATIONS, get_localized_name # VERTEX_AI_PROJECT_IDとVERTEX_AI_LOCATIONをインポート
+from ai_scheduler import AIRequestScheduler, SchedulerRejected
+from response_cache import ResponseCache, cache_key
+from conversation import ConversationStore
+from streaming import MessageStreamer, send_paginated
+from image_pipeline import DEFAULT_UPLOAD_LIMIT, ImagePipeline
+from rate_limit import rate_limited
+from instrumentation import REGISTRY, track_phase
+from config_service import SETTINGS, localized
+from cache_policy import CacheNeeds
 
 logger = logging.getLogger('discord')
 
+GEMINI_MODEL_NAME = "gemini-1.5-pro-preview-0514" # Gemini 2.5 Pro
+IMAGEN_MODEL_NAME = "imagen-004" # Imagen 4
+
+# Discordのフォローアップは最初の応答から15分間だけ有効
+FOLLOWUP_WINDOW = datetime.timedelta(minutes=15)
+
+def _load_models():
+    # vertexaiの読み込みと初期化は重いため、起動時ではなく最初に使われたときにスレッドで行う
+    # vertexai.init()はGOOGLE_APPLICATION_CREDENTIALS環境変数から認証情報を自動的に読み取る
+    import vertexai
+    from vertexai.preview.generative_models import GenerativeModel
+    from google.api_core import exceptions as google_exceptions
+
+    vertexai.init()
+    # 上流のレート制限・一時的な過負荷は再試行の対象にする
+    retryable = (google_exceptions.ResourceExhausted, google_exceptions.TooManyRequests, google_exceptions.ServiceUnavailable)
+    return GenerativeModel(GEMINI_MODEL_NAME), GenerativeModel(IMAGEN_MODEL_NAME), retryable
+
+def _chunk_text(chunk) -> str:
+    # 安全フィルターなどでテキストを含まないチャンクは .text が ValueError になる
+    try:
+        return chunk.text
+    except ValueError:
+        return ''
+
 class AICommands(commands.Cog):
+    # 会話の履歴はConversationStoreが持つので、メッセージの本文(message_content)は受け取らない
+    cache_needs = CacheNeeds()
+
     def __init__(self, bot):
         self.bot = bot
 
-        # vertexai.init()はGOOGLE_APPLICATION_CREDENTIALS環境変数から認証情報を自動的に読み取る
-        try:
-            vertexai.init()
-            self.gemini_model = GenerativeModel("gemini-1.5-pro-preview-0514") # Gemini 2.5 Pro
-            self.imagen_model = GenerativeModel("imagen-004") # Imagen 4
-        except Exception as e:
-            logger.error(f"Failed to initialize Vertex AI: {e}. AI commands will not function.")
-            self.gemini_model = None
-            self.imagen_model = None
+        # モデルは _ensure_models() で読み込む。lazy_imports が無効なら cog_load の時点で読み込む
+        self.lazy_imports = bot.config.get('startup', {}).get('lazy_imports', True)
+        self.gemini_model = None
+        self.imagen_model = None
+        self._models_loaded = False
+        self._models_lock = asyncio.Lock()
+
+        scheduler_config = bot.config.get('ai', {}).get('scheduler', {})
+        self.scheduler = AIRequestScheduler(
+            name='vertex_ai',
+            max_concurrency=scheduler_config.get('max_concurrency', 4),
+            per_key_concurrency=scheduler_config.get('per_key_concurrency', 3),
+            per_user_concurrency=scheduler_config.get('per_user_concurrency', 1),
+            max_queue=scheduler_config.get('max_queue', 100),
+            max_retries=scheduler_config.get('max_retries', 3),
+            base_delay=scheduler_config.get('base_delay', 1.0),
+            max_delay=scheduler_config.get('max_delay', 30.0),
+        )
+        REGISTRY.register_collector(self.scheduler.collect)
+
+        image_config = bot.config.get('ai', {}).get('images', {})
+        self.image_pipeline = ImagePipeline(
+            max_workers=image_config.get('workers', 2),
+            memory_budget=image_config.get('memory_budget', 64 * 1024 * 1024),
+        )
+
+        cache_config = bot.config.get('ai', {}).get('response_cache', {})
+        self.response_cache = None
+        if cache_config.get('enabled', True):
+            self.response_cache = ResponseCache(
+                db=bot.db if cache_config.get('persistent', False) else None,
+                max_entries=cache_config.get('max_entries', 1024),
+                max_bytes=cache_config.get('max_bytes', 8 * 1024 * 1024),
+                ttl=cache_config.get('ttl', 86400),
+                persistent_max_rows=cache_config.get('persistent_max_rows', 100000),
+            )
+            REGISTRY.register_collector(self.response_cache.collect)
+
+        conversation_config = bot.config.get('ai', {}).get('conversation', {})
+        self.conversations = None
+        if conversation_config.get('enabled', True):
+            self.conversations = ConversationStore(
+                db=bot.db if conversation_config.get('persistent', True) else None,
+                summarize=self._summarize,
+                history_tokens=conversation_config.get('history_tokens', 4000),
+                summary_tokens=conversation_config.get('summary_tokens', 500),
+                hot_turns=conversation_config.get('hot_turns', 12),
+                compact_tokens=conversation_config.get('compact_tokens', 3000),
+                max_conversations=conversation_config.get('max_conversations', 2000),
+                ttl=conversation_config.get('ttl', 7 * 86400),
+            )
+            REGISTRY.register_collector(self.conversations.collect)
+
+    async def cog_load(self):
+        if not self.lazy_imports:
+            await self._ensure_models()
+
+    async def _ensure_models(self):
+        if self._models_loaded:
+            return
+        async with self._models_lock:
+            if self._models_loaded:
+                return
+            start = time.perf_counter()
+            try:
+                self.gemini_model, self.imagen_model, self.scheduler.retry_on = await asyncio.to_thread(_load_models)
+                logger.info(f"Vertex AI initialized in {time.perf_counter() - start:.2f}s.")
+            except Exception as e:
+                logger.error(f"Failed to initialize Vertex AI: {e}. AI commands will not function.")
+            self._models_loaded = True
+
+    async def cog_unload(self):
+        REGISTRY.unregister_collector(self.scheduler.collect)
+        self.image_pipeline.close()
+        if self.response_cache:
+            REGISTRY.unregister_collector(self.response_cache.collect)
+            await self.response_cache.close()
+        if self.conversations is not None:
+            REGISTRY.unregister_collector(self.conversations.collect)
+            await self.conversations.close()
+
+    async def _summarize(self, prompt: str) -> str:
+        # 古いターンの要約。バックグラウンドで行うため、まとめて1つのキーでスケジューラーに流す
+        await self._ensure_models()
+        if not self.gemini_model:
+            raise RuntimeError("Vertex AI is not available")
+        response = await self.scheduler.submit(('summary',), lambda: self.gemini_model.generate_content_async(prompt))
+        return response.text
+
+    def _scheduler_key(self, interaction: discord.Interaction):
+        # ギルド内ではギルド単位、DMではユーザー単位で公平に割り当てる(ギルド内のユーザーごとの上限は submit の user で指定する)
+        if interaction.guild_id:
+            return ('guild', interaction.guild_id)
+        return ('user', interaction.user.id)
+
+    def _deadline(self, interaction: discord.Interaction) -> float:
+        # フォローアップの期限をイベントループの時刻に変換する
+        remaining = (interaction.created_at + FOLLOWUP_WINDOW - discord.utils.utcnow()).total_seconds()
+        margin = self.bot.config.get('ai', {}).get('scheduler', {}).get('deadline_margin', 60)
+        return asyncio.get_running_loop().time() + remaining - margin
+
+    async def _send_cached(self, interaction: discord.Interaction, key: str, question: str, memory_only: bool = False) -> bool:
+        cached = self.response_cache.get_memory(key) if memory_only else await self.response_cache.get(key)
+        if cached is None:
+            return False
+        await send_paginated(interaction, cached, ephemeral=True)
+        if self.conversations is not None:
+            await self.conversations.record(interaction.user.id, interaction.channel_id, question, cached)
+        logger.info("Ask command used by %s (cached). Question: %s", interaction.user.display_name, question, extra={'event': 'ask'})
+        return True
 
     @app_commands.command(
-        name=TRANSLATIONS['en-US']["ask_command_name"],
-        description=TRANSLATIONS['en-US']["ask_command_description"],
-        name_localizations=get_localized_name("ask_command_name"),
-        description_localizations=get_localized_name("ask_command_description"),
+        name=localized("ask_command_name"),
+        description=localized("ask_command_description"),
+    )
+    @app_commands.describe(
+        question=localized("ask_option_question_description"),
+        new_conversation=localized("ask_option_new_conversation_description"),
     )
-    @app_commands.describe(question=TRANSLATIONS['en-US']["ask_option_question_description"])
-    async def ask(self, interaction: discord.Interaction, question: str):
-        locale = interaction.locale if interaction.locale in TRANSLATIONS else discord.Locale.english_us
-        messages = TRANSLATIONS.get(str(locale).replace('_', '-'), TRANSLATIONS['en-US'])
+    @rate_limited()
+    async def ask(self, interaction: discord.Interaction, question: str, new_conversation: bool = False):
+        messages = SETTINGS.catalog[interaction.locale]
 
-        if not self.gemini_model:
+        if self._models_loaded and not self.gemini_model:
             await interaction.response.send_message(messages["ask_error_response"], ephemeral=True)
             return
 
-        await interaction.response.defer(ephemeral=True) # 処理に時間がかかるためdefer
+        # 応答キャッシュは正規化した質問だけで引き、保存するのも履歴なしで答えた応答だけ
+        # 会話の続き("なぜ?" など)に文脈を無視した答えを返さないよう、使うのも履歴のない質問に限る
+        # 履歴がないと分かっていればメモリ上のキャッシュだけをdeferせずに引く
+        # DBの永続層は遅かったり失敗したりすると3秒の応答期限に間に合わないので、履歴を読んだ後に引く
+        key = cache_key(question, GEMINI_MODEL_NAME, interaction.locale.value)
+        if self.response_cache is not None and not new_conversation and (self.conversations is None or self.conversations.is_empty(interaction.user.id, interaction.channel_id)):
+            if await self._send_cached(interaction, key, question, memory_only=True):
+                return
+
+        deadline = self._deadline(interaction)
+        try:
+            self.scheduler.check_admission(deadline)
+        except SchedulerRejected:
+            await interaction.response.send_message(messages["ai_busy_response"], ephemeral=True)
+            return
+
+        with track_phase("defer"):
+            await interaction.response.defer(ephemeral=True) # 処理に時間がかかるためdefer
+
+        # 会話の履歴(要約 + 直近のターン)を付けて送る。履歴はトークン数の上限内に収まる
+        # DBを読むことがあるので、3秒の応答期限に影響しないようdeferの後に行う
+        contents = question
+        if self.conversations is not None:
+            try:
+                if new_conversation:
+                    await self.conversations.reset(interaction.user.id, interaction.channel_id)
+                contents = await self.conversations.history(interaction.user.id, interaction.channel_id, question)
+            except Exception as e:
+                # deferした後なので、履歴を読めなくても質問だけで答える
+                logger.warning(f"Failed to load conversation history: {e}")
+        store_in_cache = self.response_cache is not None and (isinstance(contents, str) or len(contents) == 1)
+        if store_in_cache and await self._send_cached(interaction, key, question):
+            return
+
+        # 初回はここでモデルを読み込む(deferの後なので3秒の応答期限には影響しない)
+        await self._ensure_models()
+        if not self.gemini_model:
+            await interaction.followup.send(messages["ask_error_response"], ephemeral=True)
+            return
+
+        # ストリーミングの設定は再読み込みで変わりうるため、呼び出しごとに読む
+        streaming_config = self.bot.config.get('ai', {}).get('streaming', {})
+        streaming = streaming_config.get('enabled', True)
+        streamer = MessageStreamer(interaction.followup, ephemeral=True, edit_interval=streaming_config.get('edit_interval', 1.0))
+
+        async def generate():
+            with track_phase("ai"):
+                if not streaming:
+                    response = await self.gemini_model.generate_content_async(contents)
+                    await send_paginated(interaction, response.text, ephemeral=True)
+                    return response.text
+                # 生成されたチャンクから順にメッセージを編集して表示する
+                responses = await self.gemini_model.generate_content_async(contents, stream=True)
+                async for chunk in responses:
+                    await streamer.feed(_chunk_text(chunk))
+                return await streamer.finish()
 
         try:
-            response = await self.gemini_model.generate_content_async(question)
-            await interaction.followup.send(response.text)
-            logger.info(f"Ask command used by {interaction.user.display_name}. Question: {question}")
+            # すでに一部を表示した後のエラーは再試行しない(表示が重複するため)
+            text = await self.scheduler.submit(self._scheduler_key(interaction), generate, user=interaction.user.id, deadline=deadline, retry_if=lambda e: not streamer.started)
+            if not text or not text.strip():
+                # 空の応答はキャッシュにも会話にも残さない(ストリーミングしない場合は send_paginated が案内を送っている)
+                logger.warning(f"Empty response from model for {interaction.user.id}")
+                if streaming:
+                    await interaction.followup.send(messages["ai_empty_response"], ephemeral=True)
+                return
+            if store_in_cache:
+                self.response_cache.put(key, text, GEMINI_MODEL_NAME, interaction.locale.value)
+            if self.conversations is not None:
+                await self.conversations.record(interaction.user.id, interaction.channel_id, question, text)
+            logger.info("Ask command used by %s. Question: %s", interaction.user.display_name, question, extra={'event': 'ask'})
+        except SchedulerRejected as e:
+            logger.warning(f"Ask command rejected by scheduler: {e}")
+            await interaction.followup.send(messages["ai_busy_response"], ephemeral=True)
         except Exception as e:
             logger.error(f"Error in ask command: {e}")
             await interaction.followup.send(messages["ask_error_response"], ephemeral=True)
 
     @app_commands.command(
-        name=TRANSLATIONS['en-US']["imagine_command_name"],
-        description=TRANSLATIONS['en-US']["imagine_command_description"],
-        name_localizations=get_localized_name("imagine_command_name"),
-        description_localizations=get_localized_name("imagine_command_description"),
+        name=localized("imagine_command_name"),
+        description=localized("imagine_command_description"),
     )
-    @app_commands.describe(prompt=TRANSLATIONS['en-US']["imagine_option_prompt_description"])
+    @app_commands.describe(prompt=localized("imagine_option_prompt_description"))
+    @rate_limited()
     async def imagine(self, interaction: discord.Interaction, prompt: str):
-        locale = interaction.locale if interaction.locale in TRANSLATIONS else discord.Locale.english_us
-        messages = TRANSLATIONS.get(str(locale).replace('_', '-'), TRANSLATIONS['en-US'])
+        messages = SETTINGS.catalog[interaction.locale]
 
-        if not self.imagen_model:
+        if self._models_loaded and not self.imagen_model:
             await interaction.response.send_message(messages["imagine_error_response"], ephemeral=True)
             return
 
-        await interaction.response.defer() # 画像生成に時間がかかるためdefer
+        deadline = self._deadline(interaction)
+        try:
+            self.scheduler.check_admission(deadline)
+        except SchedulerRejected:
+            await interaction.response.send_message(messages["ai_busy_response"], ephemeral=True)
+            return
+
+        with track_phase("defer"):
+            await interaction.response.defer() # 画像生成に時間がかかるためdefer
+
+        await self._ensure_models()
+        if not self.imagen_model:
+            await interaction.followup.send(messages["imagine_error_response"], ephemeral=True)
+            return
+
+        async def generate():
+            with track_phase("ai"):
+                return await self.imagen_model.generate_content_async(prompt)
 
         try:
-            image_response = await self.imagen_model.generate_content_async(prompt)
-            # 生成された画像をPIL Imageオブジェクトに変換
-            pil_image = PILImage.open(io.BytesIO(image_response.images[0]._image_bytes))
-
-            # Discordに送信するためにBytesIOに保存
-            with io.BytesIO() as image_binary:
-                pil_image.save(image_binary, 'PNG')
-                image_binary.seek(0)
-                file = discord.File(fp=image_binary, filename='generated_image.png')
-                await interaction.followup.send(messages["imagine_success_response"].format(prompt=prompt), file=file)
-            logger.info(f"Imagine command used by {interaction.user.display_name}. Prompt: {prompt}")
+            image_response = await self.scheduler.submit(self._scheduler_key(interaction), generate, user=interaction.user.id, deadline=deadline)
+            # 生成された画像はそのまま(必要な場合だけワーカープロセスで変換して)送る
+            image_bytes = image_response.images[0]._image_bytes
+            max_bytes = interaction.guild.filesize_limit if interaction.guild else DEFAULT_UPLOAD_LIMIT
+            async with self.image_pipeline.deliver(image_bytes, max_bytes) as file:
+                await interaction.followup.send(messages.format("imagine_success_response", prompt=prompt), file=file)
+            logger.info("Imagine command used by %s. Prompt: %s", interaction.user.display_name, prompt, extra={'event': 'imagine'})
+        except SchedulerRejected as e:
+            logger.warning(f"Imagine command rejected by scheduler: {e}")
+            await interaction.followup.send(messages["ai_busy_response"], ephemeral=True)
         except Exception as e:
             logger.error(f"Error in imagine command: {e}")
             await interaction.followup.send(messages["imagine_error_response"], ephemeral=True)
@@ -0,0 +1,127 @@
+import discord
+from discord.ext import commands
+from discord import app_commands
+import asyncio
+import io
+import os
+import time
+import logging
+from typing import Literal
+
+from config_service import SETTINGS, localized
+from cache_policy import CacheNeeds
+from image_pipeline import DEFAULT_UPLOAD_LIMIT
+from profiler import ProfilerBusy, owner_only
+
+logger = logging.getLogger('discord')
+
+# メッセージ本文に載せる要約の上限(Discordのメッセージは2000文字まで)
+SUMMARY_LIMIT = 1700
+
+
+def _truncate(text: str, limit: int = SUMMARY_LIMIT) -> str:
+    if len(text) <= limit:
+        return text
+    return text[:limit].rsplit('\n', 1)[0] + '\n...'
+
+
+def _save(directory: str, files: dict[str, bytes]) -> str:
+    path = os.path.join(directory, time.strftime('%Y%m%d-%H%M%S'))
+    os.makedirs(path, exist_ok=True)
+    for name, data in files.items():
+        with open(os.path.join(path, name), 'wb') as f:
+            f.write(data)
+    return path
+
+
+# 本番環境のプロセスを再起動せずに調べるための、オーナー専用のコマンド
+# 計測するのはコマンドを受け取ったプロセス(クラスタ)だけ。処理は bot.profiler が行う
+class Diagnostics(commands.Cog):
+    cache_needs = CacheNeeds()
+
+    profile = app_commands.Group(
+        name=localized("profile_group_name"),
+        description=localized("profile_group_description"),
+        default_permissions=discord.Permissions(administrator=True),
+    )
+
+    def __init__(self, bot):
+        self.bot = bot
+
+    async def _respond(self, interaction: discord.Interaction, capture):
+        messages = SETTINGS.catalog[interaction.locale]
+        if self.bot.profiler.running:
+            await interaction.response.send_message(messages["profile_busy_response"], ephemeral=True)
+            return
+
+        # 計測中に応答期限(3秒)が過ぎないよう先にdeferする。フォローアップは15分まで送れる
+        await interaction.response.defer(ephemeral=True, thinking=True)
+        try:
+            report = await capture()
+        except ProfilerBusy:
+            await interaction.followup.send(messages["profile_busy_response"], ephemeral=True)
+            return
+        except Exception as e:
+            logger.error(f"Profiler capture failed: {e}")
+            await interaction.followup.send(messages["error_unexpected"], ephemeral=True)
+            return
+
+        files = await asyncio.to_thread(report.compressed)
+        content = messages.format("profile_result_response", kind=report.kind, pid=os.getpid()) + f"\n```\n{_truncate(report.summary)}\n```"
+        max_bytes = interaction.guild.filesize_limit if interaction.guild else DEFAULT_UPLOAD_LIMIT
+        if sum(len(data) for data in files.values()) > max_bytes:
+            # 添付できない大きさの結果はホストに保存して場所だけ知らせる
+            directory = self.bot.config.get('profiler', {}).get('output_dir', 'logs/profiles')
+            path = await asyncio.to_thread(_save, directory, files)
+            await interaction.followup.send(content + messages.format("profile_saved_response", path=path), ephemeral=True)
+        else:
+            attachments = [discord.File(io.BytesIO(data), filename=name) for name, data in files.items()]
+            await interaction.followup.send(content, files=attachments, ephemeral=True)
+        logger.info(f"Profiler {report.kind} capture requested by {interaction.user.id}")
+
+    @profile.command(
+        name=localized("profile_cpu_command_name"),
+        description=localized("profile_cpu_command_description"),
+    )
+    @app_commands.describe(
+        seconds=localized("profile_option_seconds_description"),
+        mode=localized("profile_option_mode_description"),
+    )
+    @owner_only()
+    async def cpu(self, interaction: discord.Interaction, seconds: app_commands.Range[int, 1, 600] = 10, mode: Literal['sample', 'cprofile'] = 'sample'):
+        await self._respond(interaction, lambda: self.bot.profiler.cpu(seconds, mode))
+
+    @profile.command(
+        name=localized("profile_memory_command_name"),
+        description=localized("profile_memory_command_description"),
+    )
+    @app_commands.describe(seconds=localized("profile_option_seconds_description"))
+    @owner_only()
+    async def memory(self, interaction: discord.Interaction, seconds: app_commands.Range[int, 1, 600] = 30):
+        await self._respond(interaction, lambda: self.bot.profiler.memory(seconds))
+
+    @profile.command(
+        name=localized("profile_slow_command_name"),
+        description=localized("profile_slow_command_description"),
+    )
+    @app_commands.describe(
+        seconds=localized("profile_option_seconds_description"),
+        threshold_ms=localized("profile_option_threshold_description"),
+    )
+    @owner_only()
+    async def slow(self, interaction: discord.Interaction, seconds: app_commands.Range[int, 1, 600] = 30, threshold_ms: app_commands.Range[int, 1, 10000] = 100):
+        await self._respond(interaction, lambda: self.bot.profiler.slow_callbacks(seconds, threshold_ms / 1000))
+
+    @profile.command(
+        name=localized("profile_tasks_command_name"),
+        description=localized("profile_tasks_command_description"),
+    )
+    @owner_only()
+    async def tasks(self, interaction: discord.Interaction):
+        async def capture():
+            return self.bot.profiler.tasks()
+
+        await self._respond(interaction, capture)
+
+async def setup(bot):
+    await bot.add_cog(Diagnostics(bot))
@@ -1,115 +1,128 @@
 import discord
 from discord.ext import commands
 from discord import app_commands
+import functools
 import logging
 
-from main import TRANSLATIONS, get_localized_name # TRANSLATIONSとget_localized_nameをインポート
+from component_router import make_custom_id, modal_values
+from config_service import SETTINGS, localized
+from cache_policy import CacheNeeds
 
 logger = logging.getLogger('discord')
 
-# ボタンのViewクラス
-class ButtonView(discord.ui.View):
-    def __init__(self, locale):
-        super().__init__(timeout=180) # タイムアウトを設定
-        self.messages = TRANSLATIONS.get(str(locale).replace('_', '-'), TRANSLATIONS['en-US'])
-        self.add_item(discord.ui.Button(label=self.messages["button_label"], style=discord.ButtonStyle.primary, emoji="👋", custom_id="my_button"))
-
-    @discord.ui.button(custom_id="my_button")
-    async def button_callback(self, interaction: discord.Interaction, button: discord.ui.Button):
-        await interaction.response.send_message(self.messages["button_response"], ephemeral=True)
-        logger.info(f"Button clicked by {interaction.user.display_name}")
-
-# セレクトメニューのViewクラス
-class SelectView(discord.ui.View):
-    def __init__(self, locale):
-        super().__init__(timeout=180)
-        self.messages = TRANSLATIONS.get(str(locale).replace('_', '-'), TRANSLATIONS['en-US'])
-
-        options=[
-            discord.SelectOption(label=self.messages["select_option_red"], value="red", emoji="🔴"),
-            discord.SelectOption(label=self.messages["select_option_blue"], value="blue", emoji="🔵"),
-            discord.SelectOption(label=self.messages["select_option_green"], value="green", emoji="🟢"),
-        ]
-        self.add_item(discord.ui.Select(placeholder=self.messages["select_placeholder"], min_values=1, max_values=1, options=options, custom_id="my_select"))
-
-    @discord.ui.select(custom_id="my_select")
-    async def select_callback(self, interaction: discord.Interaction, select: discord.ui.Select):
-        selected_color = select.values[0]
-        # 選択された色をローカライズ
-        localized_color = self.messages[f"select_option_{selected_color}"]
-        await interaction.response.send_message(self.messages["select_response"].format(color=localized_color), ephemeral=True)
-        logger.info(f"Select menu used by {interaction.user.display_name}: {selected_color}")
-
-# モーダルのクラス
-class MyModal(discord.ui.Modal):
-    def __init__(self, locale):
-        super().__init__(title=TRANSLATIONS['en-US']["modal_title"], custom_id="my_modal")
-        self.messages = TRANSLATIONS.get(str(locale).replace('_', '-'), TRANSLATIONS['en-US'])
-
-        self.name = discord.ui.TextInput(
-            label=self.messages["modal_name_label"],
-            placeholder=self.messages["modal_name_placeholder"],
-            max_length=50,
-            required=True,
-            custom_id="name_input"
-        )
-        self.add_item(self.name)
-
-        self.age = discord.ui.TextInput(
-            label=self.messages["modal_age_label"],
-            placeholder=self.messages["modal_age_placeholder"],
-            max_length=3,
-            required=False,
-            custom_id="age_input"
-        )
-        self.add_item(self.age)
-
-    async def on_submit(self, interaction: discord.Interaction):
-        age_value = self.age.value if self.age.value else self.messages["modal_response_age_empty"]
-        await interaction.response.send_message(self.messages["modal_response"].format(name=self.name.value, age=age_value), ephemeral=True)
-        logger.info(f"Modal submitted by {interaction.user.display_name}: Name={self.name.value}, Age={self.age.value}")
-
-    async def on_error(self, interaction: discord.Interaction, error: Exception) -> None:
-        await interaction.response.send_message(self.messages["modal_error"], ephemeral=True)
-        logger.error(f"Modal submission error: {error}")
+# custom_id のルート名。形式を変えるときはバージョンを上げ、古いバージョンのハンドラーも残す
+BUTTON_ROUTE = 'btn'
+SELECT_ROUTE = 'sel'
+MODAL_ROUTE = 'modal'
+
+# 送信するView・モーダルはロケール(の翻訳テーブル)ごとに一度だけ作り、使い回す
+# stop()済みなのでConnectionStateには登録されず、メッセージごとのオブジェクトやタイムアウトのタスクは残らない
+# 押されたときの処理はcustom_idに入れたロケールを元に、InteractiveUIのハンドラーが行う
+@functools.lru_cache(maxsize=64)
+def button_view(messages) -> discord.ui.View:
+    view = discord.ui.View(timeout=None)
+    view.add_item(discord.ui.Button(label=messages["button_label"], style=discord.ButtonStyle.primary, emoji="👋", custom_id=make_custom_id(BUTTON_ROUTE, messages.locale)))
+    view.stop()
+    return view
+
+@functools.lru_cache(maxsize=64)
+def select_view(messages) -> discord.ui.View:
+    options=[
+        discord.SelectOption(label=messages["select_option_red"], value="red", emoji="🔴"),
+        discord.SelectOption(label=messages["select_option_blue"], value="blue", emoji="🔵"),
+        discord.SelectOption(label=messages["select_option_green"], value="green", emoji="🟢"),
+    ]
+    view = discord.ui.View(timeout=None)
+    view.add_item(discord.ui.Select(placeholder=messages["select_placeholder"], min_values=1, max_values=1, options=options, custom_id=make_custom_id(SELECT_ROUTE, messages.locale)))
+    view.stop()
+    return view
+
+@functools.lru_cache(maxsize=64)
+def profile_modal(messages) -> discord.ui.Modal:
+    modal = discord.ui.Modal(title=messages["modal_title"], timeout=None, custom_id=make_custom_id(MODAL_ROUTE, messages.locale))
+    modal.add_item(discord.ui.TextInput(
+        label=messages["modal_name_label"],
+        placeholder=messages["modal_name_placeholder"],
+        max_length=50,
+        required=True,
+        custom_id="name_input"
+    ))
+    modal.add_item(discord.ui.TextInput(
+        label=messages["modal_age_label"],
+        placeholder=messages["modal_age_placeholder"],
+        max_length=3,
+        required=False,
+        custom_id="age_input"
+    ))
+    modal.stop()
+    return modal
+
+def _messages_for(locale: str):
+    # custom_id に入れたロケールの翻訳。再読み込み後は新しい翻訳が使われる
+    return SETTINGS.catalog[discord.Locale(locale)]
 
 class InteractiveUI(commands.Cog):
+    # 状態はcustom_idにあるので、送信したメッセージをキャッシュする必要はない
+    cache_needs = CacheNeeds()
+
     def __init__(self, bot):
         self.bot = bot
 
+    async def cog_load(self):
+        self.bot.components.add(BUTTON_ROUTE, self.on_button)
+        self.bot.components.add(SELECT_ROUTE, self.on_select)
+        self.bot.components.add(MODAL_ROUTE, self.on_modal_submit)
+
+    async def cog_unload(self):
+        for route in (BUTTON_ROUTE, SELECT_ROUTE, MODAL_ROUTE):
+            self.bot.components.remove(route)
+
+    async def on_button(self, interaction: discord.Interaction, locale: str):
+        messages = _messages_for(locale)
+        await interaction.response.send_message(messages["button_response"], ephemeral=True)
+        logger.info("Button clicked by %s", interaction.user.display_name, extra={'event': 'ui'})
+
+    async def on_select(self, interaction: discord.Interaction, locale: str):
+        messages = _messages_for(locale)
+        selected_color = interaction.data['values'][0]
+        # 選択された色をローカライズ
+        localized_color = messages[f"select_option_{selected_color}"]
+        await interaction.response.send_message(messages.format("select_response", color=localized_color), ephemeral=True)
+        logger.info("Select menu used by %s: %s", interaction.user.display_name, selected_color, extra={'event': 'ui'})
+
+    async def on_modal_submit(self, interaction: discord.Interaction, locale: str):
+        messages = _messages_for(locale)
+        values = modal_values(interaction)
+        name, age = values.get("name_input", ""), values.get("age_input", "")
+        age_value = age if age else messages["modal_response_age_empty"]
+        await interaction.response.send_message(messages.format("modal_response", name=name, age=age_value), ephemeral=True)
+        logger.info("Modal submitted by %s: Name=%s, Age=%s", interaction.user.display_name, name, age, extra={'event': 'ui'})
+
     @app_commands.command(
-        name=TRANSLATIONS['en-US']["button_test_command_name"],
-        description=TRANSLATIONS['en-US']["button_test_command_description"],
-        name_localizations=get_localized_name("button_test_command_name"),
-        description_localizations=get_localized_name("button_test_command_description"),
+        name=localized("button_test_command_name"),
+        description=localized("button_test_command_description"),
     )
     async def button_test(self, interaction: discord.Interaction):
-        locale = interaction.locale if interaction.locale in TRANSLATIONS else discord.Locale.english_us
-        messages = TRANSLATIONS.get(str(locale).replace('_', '-'), TRANSLATIONS['en-US'])
-        await interaction.response.send_message(messages["button_test_message"], view=ButtonView(interaction.locale))
-        logger.info(f"Button test command used by {interaction.user.display_name}")
+        messages = SETTINGS.catalog[interaction.locale]
+        await interaction.response.send_message(messages["button_test_message"], view=button_view(messages))
+        logger.info("Button test command used by %s", interaction.user.display_name, extra={'event': 'ui'})
 
     @app_commands.command(
-        name=TRANSLATIONS['en-US']["select_test_command_name"],
-        description=TRANSLATIONS['en-US']["select_test_command_description"],
-        name_localizations=get_localized_name("select_test_command_name"),
-        description_localizations=get_localized_name("select_test_command_description"),
+        name=localized("select_test_command_name"),
+        description=localized("select_test_command_description"),
     )
     async def select_test(self, interaction: discord.Interaction):
-        locale = interaction.locale if interaction.locale in TRANSLATIONS else discord.Locale.english_us
-        messages = TRANSLATIONS.get(str(locale).replace('_', '-'), TRANSLATIONS['en-US'])
-        await interaction.response.send_message(messages["select_test_message"], view=SelectView(interaction.locale))
-        logger.info(f"Select test command used by {interaction.user.display_name}")
+        messages = SETTINGS.catalog[interaction.locale]
+        await interaction.response.send_message(messages["select_test_message"], view=select_view(messages))
+        logger.info("Select test command used by %s", interaction.user.display_name, extra={'event': 'ui'})
 
     @app_commands.command(
-        name=TRANSLATIONS['en-US']["modal_test_command_name"],
-        description=TRANSLATIONS['en-US']["modal_test_command_description"],
-        name_localizations=get_localized_name("modal_test_command_name"),
-        description_localizations=get_localized_name("modal_test_command_description"),
+        name=localized("modal_test_command_name"),
+        description=localized("modal_test_command_description"),
     )
     async def modal_test(self, interaction: discord.Interaction):
-        await interaction.response.send_modal(MyModal(interaction.locale))
-        logger.info(f"Modal test command used by {interaction.user.display_name}")
+        await interaction.response.send_modal(profile_modal(SETTINGS.catalog[interaction.locale]))
+        logger.info("Modal test command used by %s", interaction.user.display_name, extra={'event': 'ui'})
 
 async def setup(bot):
     await bot.add_cog(InteractiveUI(bot))
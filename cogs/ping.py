@@ -2,28 +2,33 @@ import discord
 from discord.ext import commands
 from discord import app_commands
 import platform
-import psutil
+import math
 import datetime
 import logging
 
-from main import TRANSLATIONS, get_localized_name # TRANSLATIONSとget_localized_nameをインポート
+from config_service import SETTINGS, localized
+from rate_limit import rate_limited
+from cache_policy import CacheNeeds
 
 logger = logging.getLogger('discord')
 
 class Ping(commands.Cog):
+    cache_needs = CacheNeeds() # 応答に使うのはInteractionに含まれる情報だけ
+
     def __init__(self, bot):
         self.bot = bot
         self.start_time = datetime.datetime.now()
+        # 実行中に変わらない情報は一度だけ取得しておく
+        self.python_version = platform.python_version()
+        self.os_info = f"{platform.system()} {platform.release()} ({platform.version()})"
 
     @app_commands.command(
-        name=TRANSLATIONS['en-US']["ping_command_name"],
-        description=TRANSLATIONS['en-US']["ping_command_description"],
-        name_localizations=get_localized_name("ping_command_name"),
-        description_localizations=get_localized_name("ping_command_description"),
+        name=localized("ping_command_name"),
+        description=localized("ping_command_description"),
     )
+    @rate_limited()
     async def ping(self, interaction: discord.Interaction):
-        locale = interaction.locale if interaction.locale in TRANSLATIONS else discord.Locale.english_us
-        messages = TRANSLATIONS.get(str(locale).replace('_', '-'), TRANSLATIONS['en-US'])
+        messages = SETTINGS.catalog[interaction.locale]
 
         latency = self.bot.latency * 1000
 
@@ -32,33 +37,34 @@ class Ping(commands.Cog):
         minutes, seconds = divmod(remainder, 60)
         uptime_str = f"{hours}時間 {minutes}分 {seconds}秒"
 
-        memory = psutil.virtual_memory()
-        total_memory = memory.total / (1024**3)
-        used_memory = memory.used / (1024**3)
-        memory_percent = memory.percent
+        # CPU・メモリはバックグラウンドのサンプラーが取得した最新値を使う
+        sample = self.bot.metrics_sampler.latest
+        total_memory = sample.memory_total / (1024**3)
+        used_memory = sample.memory_used / (1024**3)
+        memory_percent = sample.memory_percent
+        cpu_percent = sample.cpu_percent
 
-        cpu_percent = psutil.cpu_percent(interval=1)
+        latency_p = self.bot.metrics_sampler.latency_percentiles()
+        latency_percentiles = " / ".join("-" if math.isnan(latency_p[p]) else f"{latency_p[p] * 1000:.2f}ms" for p in (50, 95, 99))
+        loop_lag = sample.loop_lag * 1000
 
-        python_version = platform.python_version()
         discord_py_version = discord.__version__
 
-        system_info = platform.system()
-        release_info = platform.release()
-        version_info = platform.version()
-
         embed = discord.Embed(
             title=messages["ping_embed_title"],
             description=messages["ping_embed_description"],
             color=discord.Color.blue()
         )
         embed.add_field(name=messages["ping_field_latency"], value=f"{latency:.2f}ms", inline=False)
+        embed.add_field(name=messages["ping_field_latency_percentiles"], value=latency_percentiles, inline=False)
+        embed.add_field(name=messages["ping_field_loop_lag"], value=f"{loop_lag:.2f}ms", inline=False)
         embed.add_field(name=messages["ping_field_uptime"], value=uptime_str, inline=False)
         embed.add_field(name=messages["ping_field_memory_usage"], value=f"{used_memory:.2f}GB / {total_memory:.2f}GB ({memory_percent:.2f}%)", inline=False)
         embed.add_field(name=messages["ping_field_cpu_usage"], value=f"{cpu_percent:.2f}%", inline=False)
-        embed.add_field(name=messages["ping_field_python_version"], value=python_version, inline=False)
+        embed.add_field(name=messages["ping_field_python_version"], value=self.python_version, inline=False)
         embed.add_field(name=messages["ping_field_pycord_version"], value=discord_py_version, inline=False)
-        embed.add_field(name=messages["ping_field_os_info"], value=f"{system_info} {release_info} ({version_info})", inline=False)
-        embed.set_footer(text=messages["ping_footer_requested_by"].format(user_display_name=interaction.user.display_name), icon_url=interaction.user.avatar.url if interaction.user.avatar else interaction.user.default_avatar.url)
+        embed.add_field(name=messages["ping_field_os_info"], value=self.os_info, inline=False)
+        embed.set_footer(text=messages.format("ping_footer_requested_by", user_display_name=interaction.user.display_name), icon_url=interaction.user.avatar.url if interaction.user.avatar else interaction.user.default_avatar.url)
 
         await interaction.response.send_message(embed=embed)
 
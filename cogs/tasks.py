@@ -1,27 +1,33 @@
 import discord
-from discord.ext import commands, tasks
+from discord.ext import commands
 import logging
 
+from cache_policy import CacheNeeds
+
 logger = logging.getLogger('discord')
 
 class ScheduledTasks(commands.Cog):
+    cache_needs = CacheNeeds()
+
     def __init__(self, bot):
         self.bot = bot
-        self.my_periodic_task.start() # タスクを開始
+        self.jobs = []
 
-    def cog_unload(self):
-        self.my_periodic_task.cancel() # Cogがアンロードされたときにタスクをキャンセル
+    async def cog_load(self):
+        # 実行はbot.schedulerが行う(複数プロセスで動かしても1回だけ実行される)
+        # 間隔などは config.yaml の scheduler.jobs.periodic_task で上書きできる
+        self.jobs.append(self.bot.scheduler.register('periodic_task', self.my_periodic_task, every=60, jitter=5, needs_ready=True))
 
-    @tasks.loop(seconds=60) # 60秒ごとに実行
-    async def my_periodic_task(self):
-        # ボットが準備完了状態になるまで待機
-        await self.bot.wait_until_ready()
-        logger.info("定期タスクが実行されました！")
-        # ここに定期的に実行したい処理を記述
+    async def cog_unload(self):
+        for job in self.jobs:
+            if job is not None:
+                self.bot.scheduler.unregister(job) # Cogがアンロードされたときにジョブを外す
+        self.jobs.clear()
 
-    @my_periodic_task.before_loop
-    async def before_my_periodic_task(self):
-        logger.info("定期タスクの開始を待機中...")
+    async def my_periodic_task(self, scheduled_at: float):
+        # needs_ready=True なので、ボットが準備完了になるまでは実行されない
+        logger.info("定期タスクが実行されました！", extra={'event': 'periodic_task'})
+        # ここに定期的に実行したい処理を記述
 
 async def setup(bot):
     await bot.add_cog(ScheduledTasks(bot))
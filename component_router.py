@@ -0,0 +1,98 @@
+import logging
+
+import discord
+
+from instrumentation import REGISTRY
+
+logger = logging.getLogger('discord')
+
+COMPONENTS_TOTAL = REGISTRY.counter('folium_components_total', 'Component and modal interactions by route and outcome.', ('route', 'status'))
+
+# Discordのcustom_idの上限
+CUSTOM_ID_LIMIT = 100
+
+
+def make_custom_id(route: str, *state, version: int = 1) -> str:
+    # 例: make_custom_id('btn', 'ja') -> "btn:v1:ja"
+    parts = [route, f"v{version}", *(str(value) for value in state)]
+    if any(':' in part for part in parts[:2]):
+        raise ValueError(f"Route name must not contain ':': {route}")
+    custom_id = ':'.join(parts)
+    if len(custom_id) > CUSTOM_ID_LIMIT:
+        raise ValueError(f"custom_id is longer than {CUSTOM_ID_LIMIT} characters: {custom_id}")
+    return custom_id
+
+
+def parse_custom_id(custom_id: str) -> tuple[str, int, list[str]] | None:
+    # "route:v1:a:b" -> ('route', 1, ['a', 'b'])。この形式でなければ None(Viewなど他の仕組みが扱う)
+    route, _, rest = custom_id.partition(':')
+    version, _, state = rest.partition(':')
+    if not route or not version.startswith('v') or not version[1:].isdigit():
+        return None
+    return route, int(version[1:]), state.split(':') if state else []
+
+
+def modal_values(interaction: discord.Interaction) -> dict[str, str]:
+    # モーダル送信のテキスト入力を custom_id -> 値 にする(ActionRowとLabelのどちらの入れ子にも対応)
+    values = {}
+    pending = list(interaction.data.get('components', []))
+    while pending:
+        component = pending.pop()
+        if 'components' in component:
+            pending.extend(component['components'])
+        elif 'component' in component:
+            pending.append(component['component'])
+        elif 'custom_id' in component and 'value' in component:
+            values[component['custom_id']] = component['value']
+    return values
+
+
+# 起動時に一度だけ登録するコンポーネント(ボタン・セレクトメニュー・モーダル)のルーター
+# 状態はすべてcustom_idに入れるので、送信したメッセージごとにViewやタイマーを持たず、再起動後も古いメッセージのボタンが動く
+# ハンドラーは handler(interaction, *state) の形で呼ばれる
+class ComponentRouter:
+    def __init__(self):
+        self._routes: dict[str, dict[int, object]] = {}
+        self.on_expired = None # 登録されていないバージョンのcustom_idを受け取ったときに呼ばれる(interaction)
+
+    def add(self, route: str, handler, version: int = 1):
+        versions = self._routes.setdefault(route, {})
+        if version in versions:
+            raise ValueError(f"Component route '{route}' v{version} is already registered")
+        versions[version] = handler
+
+    def remove(self, route: str, version: int | None = None):
+        if version is None:
+            self._routes.pop(route, None)
+            return
+        versions = self._routes.get(route, {})
+        versions.pop(version, None)
+        if not versions:
+            self._routes.pop(route, None)
+
+    def __contains__(self, route: str) -> bool:
+        return route in self._routes
+
+    async def dispatch(self, interaction: discord.Interaction) -> bool:
+        # 処理したら True。このルーターの形式でないcustom_idは False を返して何もしない
+        if interaction.type not in (discord.InteractionType.component, discord.InteractionType.modal_submit):
+            return False
+        parsed = parse_custom_id(interaction.data.get('custom_id', ''))
+        if parsed is None or parsed[0] not in self._routes:
+            return False
+        route, version, state = parsed
+        handler = self._routes[route].get(version)
+        if handler is None:
+            # 以前のバージョンで送ったメッセージのボタンなど
+            COMPONENTS_TOTAL.inc(route=route, status='expired')
+            if self.on_expired is not None:
+                await self.on_expired(interaction)
+            return True
+        try:
+            await handler(interaction, *state)
+        except Exception as e:
+            COMPONENTS_TOTAL.inc(route=route, status='error')
+            logger.error(f"Component handler '{route}' v{version} failed: {e}")
+            raise
+        COMPONENTS_TOTAL.inc(route=route, status='ok')
+        return True
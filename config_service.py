@@ -0,0 +1,329 @@
+import asyncio
+import logging
+import os
+import time
+from types import MappingProxyType
+
+import yaml
+from discord import app_commands
+
+from i18n import DEFAULT_LOCALE, LOCALES_DIR, MessageCatalog, load_messages, locale_path, validate_messages
+
+logger = logging.getLogger('discord')
+
+CONFIG_PATH = 'config.yaml'
+# 再読み込みしても反映されない(起動時にオブジェクトを作るときだけ読む)セクション。ai.scheduler のように . で下の階層を指定できる
+RESTART_REQUIRED = (
+    'database', 'cluster', 'startup', 'scheduler', 'reload', 'cache', 'metrics', 'logging',
+    'ai.scheduler', 'ai.response_cache', 'ai.conversation', 'ai.images',
+)
+# 上のセクションの中で、再読み込みで反映されるキー
+LIVE_KEYS = ('logging.sampling', 'ai.scheduler.deadline_margin')
+
+
+def _config_section(config, path: str):
+    section = config
+    for name in path.split('.'):
+        if not hasattr(section, 'get'):
+            return None
+        section = section.get(name)
+    if hasattr(section, 'items'):
+        live = {key.rsplit('.', 1)[1] for key in LIVE_KEYS if key.rsplit('.', 1)[0] == path}
+        section = {key: value for key, value in section.items() if key not in live}
+    return section
+
+
+def restart_required_changes(old, new) -> list[str]:
+    # 変更されたが再起動するまで反映されないセクションの一覧
+    return [path for path in RESTART_REQUIRED if _config_section(old, path) != _config_section(new, path)]
+
+
+def override_config_with_env(cfg: dict, prefix: str = "") -> dict:
+    # 例: bot.prefix は BOT_PREFIX、ai.streaming.enabled は AI_STREAMING_ENABLED で上書きできる
+    for key, value in cfg.items():
+        env_var_name = f"{prefix}{key.upper()}"
+        if isinstance(value, dict):
+            override_config_with_env(value, f"{env_var_name}_")
+            continue
+        env_value = os.getenv(env_var_name)
+        if env_value is None:
+            continue
+        # boolはintのサブクラスなので、先に判定する
+        if isinstance(value, bool):
+            cfg[key] = env_value.lower() in ('true', '1', 't', 'y', 'yes')
+        elif isinstance(value, (int, float)):
+            try:
+                cfg[key] = type(value)(env_value)
+            except ValueError:
+                logger.warning(f"Environment variable {env_var_name} has invalid {type(value).__name__} value: {env_value}")
+                continue
+        else:
+            cfg[key] = env_value
+        logger.info(f"Overridden config['{key}'] with environment variable {env_var_name}: {cfg[key]}")
+    return cfg
+
+
+def freeze(value):
+    # スナップショットを共有しても書き換えられないように、dictは読み取り専用、listはtupleにする
+    if isinstance(value, dict):
+        return MappingProxyType({key: freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+def thaw(value):
+    if isinstance(value, MappingProxyType):
+        return {key: thaw(item) for key, item in value.items()}
+    if isinstance(value, tuple):
+        return [thaw(item) for item in value]
+    return value
+
+
+def _merge(base: dict, overrides: dict) -> dict:
+    for key, value in overrides.items():
+        if isinstance(value, dict) and isinstance(base.get(key), dict):
+            _merge(base[key], value)
+        else:
+            base[key] = value
+    return base
+
+
+def parse_config(path: str) -> dict:
+    with open(path, 'r', encoding='utf-8') as f:
+        cfg = yaml.safe_load(f)
+    if not isinstance(cfg, dict):
+        raise ValueError(f"{path} must contain a mapping")
+    for section, key in (('bot', 'prefix'), ('database', 'type')):
+        if not isinstance(cfg.get(section), dict) or key not in cfg[section]:
+            raise ValueError(f"{path} is missing {section}.{key}")
+    return override_config_with_env(cfg)
+
+
+def _stat(path: str):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+
+# ある時点の設定と翻訳。作成後は変更されず、更新は新しいSnapshotへの差し替えで行う
+class Snapshot:
+    __slots__ = ('version', 'config', 'translations', 'catalog', 'files', 'loaded_at')
+
+    def __init__(self, version: int, config, translations, catalog: MessageCatalog, files: dict, loaded_at: float):
+        object.__setattr__(self, 'version', version)
+        object.__setattr__(self, 'config', config)
+        object.__setattr__(self, 'translations', translations)
+        object.__setattr__(self, 'catalog', catalog)
+        object.__setattr__(self, 'files', MappingProxyType(files))
+        object.__setattr__(self, 'loaded_at', loaded_at)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Snapshot is immutable")
+
+    def __repr__(self):
+        return f"<Snapshot(version={self.version}, locales={sorted(self.translations)})>"
+
+
+# config.yaml と locales/*/messages.json を監視し、変更されたファイルだけを読み直して差し替える
+# 読み込みと検証はスレッドで行い、イベントループ上では参照の差し替えだけを行う
+# 検証に失敗した場合は以前のスナップショットを使い続ける
+class ConfigService:
+    def __init__(self, config_path: str = CONFIG_PATH, locales_dir: str = LOCALES_DIR, poll_interval: float = 2.0):
+        self.config_path = config_path
+        self.locales_dir = locales_dir
+        self.poll_interval = poll_interval
+        self._snapshot: Snapshot | None = None
+        self._listeners = []
+        self._task: asyncio.Task | None = None
+        self._reload_lock = asyncio.Lock()
+
+    @property
+    def snapshot(self) -> Snapshot:
+        return self._snapshot
+
+    @property
+    def config(self):
+        return self._snapshot.config
+
+    @property
+    def catalog(self) -> MessageCatalog:
+        return self._snapshot.catalog
+
+    @property
+    def translations(self):
+        return self._snapshot.translations
+
+    def load(self) -> Snapshot:
+        # 起動時の読み込み。失敗した場合はそのまま例外にする
+        snapshot = self._build(self._snapshot, self._scan(), force=True)
+        self._snapshot = snapshot
+        return snapshot
+
+    def add_listener(self, callback):
+        # callback(old, new) は差し替えの直後にイベントループ上で呼ばれる
+        self._listeners.append(callback)
+
+    def remove_listener(self, callback):
+        self._listeners.remove(callback)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._watch(), name='config-watch')
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                await self.reload()
+            except Exception as e:
+                logger.error(f"Config watcher failed: {e}")
+
+    async def reload(self) -> bool:
+        async with self._reload_lock:
+            current = self._snapshot
+            try:
+                snapshot = await asyncio.to_thread(self._reload_changed, current)
+            except Exception as e:
+                logger.error(f"Rejected config/locale change; keeping version {current.version}: {e}")
+                return False
+            if snapshot is None:
+                return False
+            if snapshot.version == current.version:
+                # すべて却下された場合は、観測したファイルの状態だけを更新する
+                self._snapshot = snapshot
+                return False
+            self._swap(current, snapshot)
+            return True
+
+    def apply_overrides(self, overrides: dict):
+        # 実行中に一部の値だけを差し替える(ベンチマークや管理用)
+        current = self._snapshot
+        config = freeze(_merge(thaw(current.config), overrides))
+        self._swap(current, Snapshot(current.version + 1, config, current.translations, current.catalog, dict(current.files), time.time()))
+
+    def _swap(self, old: Snapshot, new: Snapshot):
+        self._snapshot = new
+        for callback in list(self._listeners):
+            try:
+                callback(old, new)
+            except Exception as e:
+                logger.error(f"Config listener {callback!r} failed: {e}")
+
+    def _scan(self) -> dict:
+        files = {self.config_path: _stat(self.config_path)}
+        for lang_dir in os.listdir(self.locales_dir):
+            path = locale_path(lang_dir, self.locales_dir)
+            stat = _stat(path)
+            if stat is not None:
+                files[path] = stat
+        return files
+
+    def _reload_changed(self, current: Snapshot) -> Snapshot | None:
+        files = self._scan()
+        if files == dict(current.files):
+            return None
+        return self._build(current, files)
+
+    def _build(self, current: Snapshot | None, files: dict, force: bool = False) -> Snapshot | None:
+        # 初回の読み込みでは失敗をそのまま例外にする
+        # 再読み込みではファイル単位で却下し、そのファイルだけ以前の内容を使い続ける
+        # (snapshot.files には観測した状態を記録するので、同じ内容のまま何度もエラーにはならない)
+        previous_files = {} if current is None else current.files
+        changed = {path for path, stat in files.items() if force or previous_files.get(path) != stat}
+        removed = previous_files.keys() - files.keys()
+        applied, rejected = [], []
+
+        def reject(path: str, error: Exception):
+            if current is None:
+                raise error
+            rejected.append(path)
+            logger.error(f"Rejected {os.path.relpath(path)}; keeping the previous version: {error}")
+
+        config = None if current is None else current.config
+        if self.config_path in changed:
+            try:
+                new_config = freeze(parse_config(self.config_path))
+            except Exception as e:
+                reject(self.config_path, e)
+            else:
+                if current is not None:
+                    for section in restart_required_changes(current.config, new_config):
+                        logger.warning(f"config.yaml section '{section}' changed; it takes effect after a restart.")
+                config = new_config
+                applied.append(self.config_path)
+
+        translations = {} if current is None else dict(current.translations)
+        loaded = {}
+        for path in sorted(changed - {self.config_path}):
+            try:
+                loaded[os.path.basename(os.path.dirname(path))] = (path, load_messages(path))
+            except Exception as e:
+                reject(path, e)
+        for path in sorted(removed - {self.config_path}):
+            lang_code = os.path.basename(os.path.dirname(path))
+            if lang_code == DEFAULT_LOCALE:
+                reject(path, ValueError(f"{DEFAULT_LOCALE} translations cannot be removed"))
+            else:
+                translations.pop(lang_code, None)
+                applied.append(path)
+
+        # 既定ロケールを先に検証する。変更後のen-USに既存の翻訳が合わなくなる場合はen-USの変更を却下する
+        if DEFAULT_LOCALE in loaded:
+            path, messages = loaded.pop(DEFAULT_LOCALE)
+            try:
+                validate_messages(DEFAULT_LOCALE, messages, messages, translations.get(DEFAULT_LOCALE))
+                for lang_code in sorted(translations.keys() - loaded.keys() - {DEFAULT_LOCALE}):
+                    validate_messages(lang_code, translations[lang_code], messages)
+            except ValueError as e:
+                reject(path, e)
+            else:
+                translations[DEFAULT_LOCALE] = MappingProxyType(messages)
+                applied.append(path)
+        if DEFAULT_LOCALE not in translations:
+            raise ValueError(f"{locale_path(DEFAULT_LOCALE, self.locales_dir)} not found")
+
+        reference = translations[DEFAULT_LOCALE]
+        for lang_code, (path, messages) in sorted(loaded.items()):
+            try:
+                for warning in validate_messages(lang_code, messages, reference):
+                    logger.warning(f"Locale '{lang_code}': {warning}")
+            except ValueError as e:
+                reject(path, e)
+            else:
+                translations[lang_code] = MappingProxyType(messages)
+                applied.append(path)
+
+        if current is not None and not applied:
+            # 変更はすべて却下されたが、観測した状態は記録しておく
+            return Snapshot(current.version, current.config, current.translations, current.catalog, files, current.loaded_at)
+
+        translations = MappingProxyType(translations)
+        if current is None or any(path != self.config_path for path in applied):
+            catalog = MessageCatalog(translations)
+        else:
+            catalog = current.catalog
+
+        version = 1 if current is None else current.version + 1
+        if current is not None:
+            logger.info(f"Reloaded {', '.join(sorted(os.path.relpath(path) for path in applied))} (snapshot version {version}).")
+        return Snapshot(version, config, translations, catalog, files, time.time())
+
+SETTINGS = ConfigService()
+SETTINGS.load()
+
+
+def localized(key: str) -> app_commands.locale_str:
+    # コマンド名・説明用。既定の文字列はen-US、各ロケールの訳は同期時にCatalogTranslatorが付ける
+    return app_commands.locale_str(SETTINGS.translations[DEFAULT_LOCALE][key], key=key)
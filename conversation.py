@@ -0,0 +1,359 @@
+import asyncio
+import logging
+import math
+import time
+from collections import OrderedDict, deque
+
+from sqlalchemy import delete, select, update
+
+from instrumentation import REGISTRY
+from models import Conversation, ConversationTurn
+
+logger = logging.getLogger('discord')
+
+CONTEXT_TOKENS = REGISTRY.histogram(
+    'folium_ai_context_tokens',
+    'Estimated tokens sent per /ask request, including history.',
+    buckets=(250, 500, 1000, 2000, 4000, 8000, 16000, 32000),
+)
+
+# 要約は履歴の先頭に「ユーザーの発言とモデルの返事」の組として入れる
+SUMMARY_PREAMBLE = "Summary of our conversation so far:\n"
+SUMMARY_ACK = "Understood. I'll keep that in mind."
+SUMMARY_PROMPT = (
+    "You maintain a running summary of a conversation between a user and an assistant.\n"
+    "Update the summary with the new turns below. Keep facts, names, decisions and open questions; drop small talk.\n"
+    "Write in the language the user writes in, and keep it under {limit} words.\n\n"
+    "Current summary:\n{summary}\n\n"
+    "New turns:\n{transcript}\n\n"
+    "Updated summary:"
+)
+
+
+def estimate_tokens(text: str) -> int:
+    # トークナイザーを呼ばずに多めに見積もる
+    # 英数字はおよそ4文字で1トークン、それ以外(日本語など)は1文字1トークンとして数える
+    ascii_chars = len(text.encode('ascii', 'ignore'))
+    return max(1, math.ceil(ascii_chars / 4) + len(text) - ascii_chars)
+
+
+def truncate_to_tokens(text: str, limit: int) -> str:
+    if estimate_tokens(text) <= limit:
+        return text
+    # 1文字1トークンの見積もりが上限なので、二分探索で収まる長さを探す
+    low, high = 0, len(text)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if estimate_tokens(text[:middle]) <= limit:
+            low = middle
+        else:
+            high = middle - 1
+    return text[:low]
+
+
+def _content(role: str, text: str) -> dict:
+    # generate_content_async にそのまま渡せるContentの辞書形式
+    return {'role': role, 'parts': [{'text': text}]}
+
+
+class Turn:
+    __slots__ = ('seq', 'role', 'text', 'tokens')
+
+    def __init__(self, seq: int, role: str, text: str, tokens: int):
+        self.seq = seq
+        self.role = role
+        self.text = text
+        self.tokens = tokens
+
+
+class ConversationState:
+    __slots__ = ('conversation_id', 'summary', 'summary_tokens', 'summarized_through', 'next_seq', 'turns', 'lock', 'compacting', 'last_used', 'discarded')
+
+    def __init__(self, conversation_id: int | None = None, summary: str = "", summary_tokens: int = 0, summarized_through: int = 0, next_seq: int = 1):
+        self.conversation_id = conversation_id
+        self.summary = summary
+        self.summary_tokens = summary_tokens
+        self.summarized_through = summarized_through
+        self.next_seq = next_seq
+        # まだ要約していないターン(ユーザーとモデルの組で並ぶ)
+        self.turns: deque[Turn] = deque()
+        # DBへの書き込みの順序を保つためのロック
+        self.lock = asyncio.Lock()
+        self.compacting = False
+        self.last_used = time.time()
+        # reset() で削除された会話。まだ実行されていない書き込みはこれを見て何もしない
+        self.discarded = False
+
+    @property
+    def tail_tokens(self) -> int:
+        return sum(turn.tokens for turn in self.turns)
+
+
+# ユーザー×チャンネルごとの /ask の会話履歴
+# - 直近のターンはメモリ上(LRU)に持ち、DBには後から書き込む
+# - 古いターンは summarize で要約にまとめ、DBからは削除する
+# - 送信する履歴は history_tokens に収まるよう新しい順に詰めるため、会話がどれだけ続いても上限を超えない
+class ConversationStore:
+    def __init__(
+        self,
+        db=None,
+        summarize=None,
+        history_tokens: int = 4000,
+        summary_tokens: int = 500,
+        hot_turns: int = 12,
+        compact_tokens: int = 3000,
+        max_conversations: int = 2000,
+        ttl: float = 7 * 86400,
+        purge_every: int = 200,
+    ):
+        self.db = db
+        self.summarize = summarize # async (prompt: str) -> str。Noneなら古いターンは要約せずに捨てる
+        self.history_tokens = history_tokens
+        self.summary_tokens = summary_tokens
+        self.hot_turns = max(2, hot_turns - hot_turns % 2)
+        self.compact_tokens = compact_tokens
+        self.max_conversations = max_conversations
+        self.ttl = ttl
+        self.purge_every = purge_every
+        self.compactions = 0
+        self._states: OrderedDict[tuple[int, int], ConversationState] = OrderedDict()
+        self._loading: dict[tuple[int, int], asyncio.Future] = {}
+        self._background: set[asyncio.Task] = set()
+        # 会話ごとの実行中のターンの書き込み(reset() が削除する前に終わらせる)
+        # 要約の書き込みは会話のIDを指定した更新・削除だけなので、削除の後に実行されても何も変わらない
+        self._saves: dict[tuple[int, int], set[asyncio.Task]] = {}
+        self._records_since_purge = 0
+
+    def __len__(self):
+        return len(self._states)
+
+    async def _get(self, key: tuple[int, int]) -> ConversationState:
+        state = self._states.get(key)
+        if state is not None:
+            self._states.move_to_end(key)
+            return state
+
+        # 同じ会話への同時の読み込みは1回にまとめる
+        pending = self._loading.get(key)
+        if pending is not None:
+            return await asyncio.shield(pending)
+        future = asyncio.get_running_loop().create_future()
+        self._loading[key] = future
+        try:
+            state = await self._load(key)
+            self._states[key] = state
+            while len(self._states) > self.max_conversations:
+                self._states.popitem(last=False)
+            future.set_result(state)
+            return state
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()
+            raise
+        finally:
+            del self._loading[key]
+
+    async def _load(self, key: tuple[int, int]) -> ConversationState:
+        if self.db is None:
+            return ConversationState()
+        user_id, channel_id = key
+        async with self.db.read_session() as session:
+            row = (await session.execute(
+                select(Conversation).where(Conversation.user_id == user_id, Conversation.channel_id == channel_id)
+            )).scalar_one_or_none()
+            if row is None:
+                return ConversationState()
+            turns = (await session.execute(
+                select(ConversationTurn)
+                .where(ConversationTurn.conversation_id == row.id, ConversationTurn.seq > row.summarized_through)
+                .order_by(ConversationTurn.seq)
+            )).scalars().all()
+        state = ConversationState(row.id, row.summary, row.summary_tokens, row.summarized_through, row.next_seq)
+        state.turns.extend(Turn(turn.seq, turn.role, turn.text, turn.tokens) for turn in turns)
+        return state
+
+    def is_empty(self, user_id: int, channel_id: int) -> bool:
+        # 要約もターンもない会話ならTrue。DBを読まずに分かる範囲だけで判定し、メモリにない会話はDBに残っているかもしれないのでFalse
+        state = self._states.get((user_id, channel_id))
+        if state is None:
+            return self.db is None and (user_id, channel_id) not in self._loading
+        return not state.summary and not state.turns
+
+    async def history(self, user_id: int, channel_id: int, question: str) -> list[dict]:
+        # 要約 + 収まるだけの直近のターン + 今回の質問 を返す
+        state = await self._get((user_id, channel_id))
+        remaining = self.history_tokens - estimate_tokens(question)
+
+        prefix = []
+        if state.summary:
+            cost = state.summary_tokens + estimate_tokens(SUMMARY_PREAMBLE) + estimate_tokens(SUMMARY_ACK)
+            if cost <= remaining:
+                prefix = [_content('user', SUMMARY_PREAMBLE + state.summary), _content('model', SUMMARY_ACK)]
+                remaining -= cost
+
+        # ユーザーとモデルの組を崩さないように、新しい組から順に詰める
+        selected = []
+        turns = list(state.turns)
+        for index in range(len(turns) - 2, -1, -2):
+            user_turn, model_turn = turns[index], turns[index + 1]
+            cost = user_turn.tokens + model_turn.tokens
+            if cost > remaining:
+                break
+            selected.append(_content('model', model_turn.text))
+            selected.append(_content('user', user_turn.text))
+            remaining -= cost
+        selected.reverse()
+
+        contents = prefix + selected + [_content('user', question)]
+        CONTEXT_TOKENS.observe(self.history_tokens - remaining)
+        return contents
+
+    async def record(self, user_id: int, channel_id: int, question: str, answer: str):
+        state = await self._get((user_id, channel_id))
+        new_turns = [
+            Turn(state.next_seq, 'user', question, estimate_tokens(question)),
+            Turn(state.next_seq + 1, 'model', answer, estimate_tokens(answer)),
+        ]
+        state.next_seq += 2
+        state.turns.extend(new_turns)
+        state.last_used = time.time()
+        if self.db is not None:
+            self._spawn(self._persist_turns((user_id, channel_id), state, new_turns), (user_id, channel_id))
+        if not state.compacting and (len(state.turns) > 2 * self.hot_turns or state.tail_tokens > self.compact_tokens):
+            state.compacting = True
+            self._spawn(self._compact(state))
+
+    async def reset(self, user_id: int, channel_id: int):
+        key = (user_id, channel_id)
+        state = self._states.pop(key, None)
+        if state is not None:
+            state.discarded = True
+        if self.db is None:
+            return
+        # 古い会話への書き込みが削除の後に実行されると、会話の行を作り直したり、存在しない会話のターンを書き込んだりする
+        # 破棄した会話の書き込みは何もせずに終わり、LRUから外れた会話の書き込みは削除の前に終わらせる
+        pending = self._saves.get(key)
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+        lock = state.lock if state is not None else asyncio.Lock()
+        async with lock:
+            async with self.db.get_session() as session:
+                conversation_ids = select(Conversation.id).where(Conversation.user_id == user_id, Conversation.channel_id == channel_id)
+                await session.execute(delete(ConversationTurn).where(ConversationTurn.conversation_id.in_(conversation_ids.scalar_subquery())))
+                await session.execute(delete(Conversation).where(Conversation.user_id == user_id, Conversation.channel_id == channel_id))
+                await session.commit()
+
+    def _spawn(self, coro, key: tuple[int, int] | None = None):
+        task = asyncio.create_task(coro)
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+        if key is None:
+            return
+        saves = self._saves.setdefault(key, set())
+        saves.add(task)
+        task.add_done_callback(lambda task: self._forget_save(key, task))
+
+    def _forget_save(self, key: tuple[int, int], task: asyncio.Task):
+        saves = self._saves.get(key)
+        if saves is not None:
+            saves.discard(task)
+            if not saves:
+                del self._saves[key]
+
+    async def _persist_turns(self, key: tuple[int, int], state: ConversationState, turns: list[Turn]):
+        try:
+            async with state.lock:
+                if state.discarded:
+                    return
+                now = time.time()
+                async with self.db.get_session() as session:
+                    if state.conversation_id is None:
+                        row = Conversation(user_id=key[0], channel_id=key[1], next_seq=state.next_seq, updated_at=now)
+                        session.add(row)
+                        await session.flush()
+                        state.conversation_id = row.id
+                    else:
+                        await session.execute(
+                            update(Conversation).where(Conversation.id == state.conversation_id).values(next_seq=state.next_seq, updated_at=now)
+                        )
+                    session.add_all(
+                        ConversationTurn(conversation_id=state.conversation_id, seq=turn.seq, role=turn.role, text=turn.text, tokens=turn.tokens, created_at=now)
+                        for turn in turns
+                    )
+                    await session.commit()
+            self._records_since_purge += 1
+            if self._records_since_purge >= self.purge_every:
+                self._records_since_purge = 0
+                await self.purge()
+        except Exception as e:
+            logger.warning(f"Failed to persist conversation turns: {e}")
+
+    def _turns_to_compact(self, state: ConversationState) -> list[Turn]:
+        # 直近の hot_turns 件とトークン数の上限を満たすまで、古い組から要約に回す(最後の1組は必ず残す)
+        turns = list(state.turns)
+        tail_tokens = state.tail_tokens
+        take = 0
+        while len(turns) - take > 2 and (len(turns) - take > self.hot_turns or tail_tokens > self.compact_tokens // 2):
+            tail_tokens -= turns[take].tokens + turns[take + 1].tokens
+            take += 2
+        return turns[:take]
+
+    async def _compact(self, state: ConversationState):
+        try:
+            older = self._turns_to_compact(state)
+            if not older:
+                return
+            summary = state.summary
+            if self.summarize is not None:
+                transcript = "\n".join(f"{'User' if turn.role == 'user' else 'Assistant'}: {turn.text}" for turn in older)
+                prompt = SUMMARY_PROMPT.format(limit=self.summary_tokens // 2, summary=state.summary or "(none)", transcript=transcript)
+                summary = truncate_to_tokens((await self.summarize(prompt)).strip(), self.summary_tokens)
+
+            through = older[-1].seq
+            state.summary = summary
+            state.summary_tokens = estimate_tokens(summary) if summary else 0
+            state.summarized_through = through
+            while state.turns and state.turns[0].seq <= through:
+                state.turns.popleft()
+            self.compactions += 1
+
+            if self.db is not None:
+                async with state.lock:
+                    if state.discarded or state.conversation_id is None:
+                        return
+                    async with self.db.get_session() as session:
+                        await session.execute(
+                            update(Conversation).where(Conversation.id == state.conversation_id).values(
+                                summary=state.summary, summary_tokens=state.summary_tokens, summarized_through=through,
+                            )
+                        )
+                        await session.execute(
+                            delete(ConversationTurn).where(ConversationTurn.conversation_id == state.conversation_id, ConversationTurn.seq <= through)
+                        )
+                        await session.commit()
+        except Exception as e:
+            # 要約に失敗してもターンは残り、history() が予算内に切り詰める
+            logger.warning(f"Failed to compact conversation: {e}")
+        finally:
+            state.compacting = False
+
+    async def purge(self):
+        if self.db is None or self.ttl <= 0:
+            return
+        cutoff = time.time() - self.ttl
+        # 削除する会話がメモリに残っていると、存在しない行へ書き込もうとするため先に外す
+        for key in [key for key, state in self._states.items() if state.last_used < cutoff]:
+            del self._states[key]
+        async with self.db.get_session() as session:
+            stale = select(Conversation.id).where(Conversation.updated_at < cutoff)
+            await session.execute(delete(ConversationTurn).where(ConversationTurn.conversation_id.in_(stale.scalar_subquery())))
+            await session.execute(delete(Conversation).where(Conversation.updated_at < cutoff))
+            await session.commit()
+
+    async def close(self):
+        if self._background:
+            await asyncio.gather(*self._background, return_exceptions=True)
+
+    def collect(self):
+        yield 'folium_conversations_cached', 'gauge', 'Conversations held in memory.', [({}, len(self._states))]
+        yield 'folium_conversation_compactions_total', 'counter', 'Older turns folded into a summary.', [({}, self.compactions)]
@@ -1,21 +1,291 @@
+from sqlalchemy import event
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
 from sqlalchemy.orm import declarative_base
+from contextlib import asynccontextmanager
+import asyncio
 import logging
+import time
+
+from instrumentation import DB_SESSION_SECONDS, REGISTRY, record_phase
+from migrations import migrate
 
 logger = logging.getLogger('discord')
 
 # Baseはmodels.pyからインポートするように変更
 from models import Base
 
+# SQLiteの古いビルドでは1文あたりのバインド変数が999個まで
+SQLITE_MAX_VARIABLES = 999
+
+FLUSH_SECONDS = REGISTRY.histogram('folium_write_behind_flush_seconds', 'Time taken to flush a write-behind batch.', ('table',))
+COALESCED = REGISTRY.counter('folium_write_behind_coalesced_total', 'Updates merged into an already pending row.', ('table',))
+
+# 接続ごとに適用するSQLiteのPRAGMA
+# WALにすると読み込みが書き込みを待たなくなり、synchronous=NORMALはWALでは安全かつfsyncを減らせる
+DEFAULT_SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,
+    'cache_size': -16000, # 負の値はKiB単位(約16MB)
+    'temp_store': 'MEMORY',
+    'foreign_keys': 'ON',
+}
+
+
+def build_database_url(db_config) -> str:
+    if db_config['type'] == "sqlite":
+        return f"sqlite+aiosqlite:///{db_config['path']}"
+    elif db_config['type'] == "postgresql":
+        return f"postgresql+asyncpg://{db_config['user']}:{db_config['password']}@{db_config['host']}:{db_config['port']}/{db_config['dbname']}"
+    raise ValueError("Unsupported database type in config.yaml")
+
+
 class Database:
-    def __init__(self, db_url: str):
-        self.engine = create_async_engine(db_url, echo=False) # echo=TrueでSQLログを出力
+    def __init__(
+        self,
+        db_url: str,
+        pool_size: int | None = None,
+        max_overflow: int | None = None,
+        pool_timeout: float | None = None,
+        pool_recycle: int | None = None,
+        pool_pre_ping: bool = False,
+        sqlite_pragmas: dict | None = None,
+        statement_cache_size: int | None = None,
+        query_cache_size: int | None = None,
+    ):
+        self.is_sqlite = db_url.startswith('sqlite')
+        in_memory = self.is_sqlite and ':memory:' in db_url
+        engine_options = {'echo': False, 'pool_pre_ping': pool_pre_ping} # echo=TrueでSQLログを出力
+        if query_cache_size is not None:
+            engine_options['query_cache_size'] = query_cache_size
+
+        # インメモリのSQLiteはStaticPoolになるため、プール設定は渡さない
+        if not in_memory:
+            for key, value in (('pool_size', pool_size), ('max_overflow', max_overflow), ('pool_timeout', pool_timeout), ('pool_recycle', pool_recycle)):
+                if value is not None:
+                    engine_options[key] = value
+
+        if db_url.startswith('postgresql+asyncpg') and statement_cache_size is not None:
+            # asyncpg側のプリペアドステートメントキャッシュと、SQLAlchemy側のキャッシュの両方を設定する
+            # (pgbouncerのtransactionモード経由の場合は0にする)
+            engine_options['connect_args'] = {
+                'statement_cache_size': statement_cache_size,
+                'prepared_statement_cache_size': statement_cache_size,
+            }
+
+        self.engine = create_async_engine(db_url, **engine_options)
         self.async_session = async_sessionmaker(self.engine, expire_on_commit=False, class_=AsyncSession)
+        # 読み込み専用の接続は最初からAUTOCOMMITにした別プールで持つ
+        # (チェックアウトのたびに分離レベルを切り替えるとかえって遅くなるため)
+        # インメモリのSQLiteは接続ごとに別のデータベースになるため、同じエンジンを使う
+        if in_memory:
+            self.read_engine = self.engine
+        else:
+            self.read_engine = create_async_engine(db_url, isolation_level="AUTOCOMMIT", **engine_options)
+        self.read_only_session = async_sessionmaker(self.read_engine, expire_on_commit=False, class_=AsyncSession)
+
+        if self.is_sqlite and sqlite_pragmas:
+            for engine in {self.engine, self.read_engine}:
+                self._install_sqlite_pragmas(engine, dict(sqlite_pragmas))
+
+    @classmethod
+    def from_config(cls, db_config) -> 'Database':
+        pool_config = db_config.get('pool', {})
+        is_sqlite = db_config['type'] == "sqlite"
+        return cls(
+            build_database_url(db_config),
+            pool_size=pool_config.get('size'),
+            max_overflow=pool_config.get('max_overflow'),
+            pool_timeout=pool_config.get('timeout'),
+            pool_recycle=pool_config.get('recycle'),
+            pool_pre_ping=pool_config.get('pre_ping', not is_sqlite),
+            sqlite_pragmas=db_config.get('sqlite_pragmas', DEFAULT_SQLITE_PRAGMAS) if is_sqlite else None,
+            statement_cache_size=db_config.get('statement_cache_size'),
+            query_cache_size=db_config.get('query_cache_size'),
+        )
+
+    @staticmethod
+    def _install_sqlite_pragmas(engine, pragmas: dict):
+        @event.listens_for(engine.sync_engine, "connect")
+        def _set_sqlite_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for name, value in pragmas.items():
+                cursor.execute(f"PRAGMA {name}={value}")
+            cursor.close()
 
     async def init_db(self):
-        async with self.engine.begin() as conn:
-            await conn.run_sync(Base.metadata.create_all)
-        logger.info("Database initialized and tables created.")
+        # 新しいデータベースは最新の構成で作り、既存のデータベースには未適用のマイグレーションを適用する
+        applied = await migrate(self.engine)
+        logger.info(f"Database initialized ({len(applied)} migrations applied).")
+
+    async def close(self):
+        await self.engine.dispose()
+        if self.read_engine is not self.engine:
+            await self.read_engine.dispose()
+
+    # `async with db.get_session() as session:` の形で使う
+    # セッションを開いていた時間はコマンドごとの "db" フェーズとして記録される
+    @asynccontextmanager
+    async def get_session(self):
+        start = time.perf_counter()
+        try:
+            async with self.async_session() as session:
+                yield session
+        finally:
+            self._record(time.perf_counter() - start)
+
+    # 読み込み専用のセッション。AUTOCOMMITの接続を使い、BEGIN/COMMITを発行しない
+    @asynccontextmanager
+    async def read_session(self):
+        start = time.perf_counter()
+        try:
+            async with self.read_only_session() as session:
+                yield session
+        finally:
+            self._record(time.perf_counter() - start)
+
+    async def bulk_upsert(self, model, rows: list[dict], index_elements: list[str]):
+        # INSERT ... ON CONFLICT DO UPDATE をSQLite・PostgreSQLの両方で使う
+        if not rows:
+            return
+        table = model.__table__
+        dialect_insert = sqlite.insert if self.is_sqlite else postgresql.insert
+        columns = len(rows[0])
+        chunk = max(1, SQLITE_MAX_VARIABLES // columns) if self.is_sqlite else 1000
+        async with self.get_session() as session:
+            for start in range(0, len(rows), chunk):
+                stmt = dialect_insert(table).values(rows[start:start + chunk])
+                update = {name: stmt.excluded[name] for name in rows[0] if name not in index_elements}
+                if update:
+                    stmt = stmt.on_conflict_do_update(index_elements=index_elements, set_=update)
+                else:
+                    stmt = stmt.on_conflict_do_nothing(index_elements=index_elements)
+                await session.execute(stmt)
+            await session.commit()
+
+    def _record(self, elapsed: float):
+        DB_SESSION_SECONDS.observe(elapsed)
+        record_phase('db', elapsed)
+
+
+# 同じキーへの更新をまとめて、件数または時間を契機に一括upsertで書き込むキュー(write-behind)
+# 書き込み前の値は peek() で参照でき、close() で残りをすべて書き出してから終了する
+class WriteBehindQueue:
+    def __init__(self, db: Database, model, key: str, max_batch: int = 500, flush_interval: float = 1.0):
+        self.db = db
+        self.model = model
+        self.key = key
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.table_name = model.__tablename__
+        self._pending: dict[object, dict] = {}
+        # 書き込み中のバッチ。完了するまでは peek() からも見えるようにしておく
+        self._inflight: dict[object, dict] = {}
+        self._waiters: list[asyncio.Future] = []
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task: asyncio.Task | None = None
+        REGISTRY.register_collector(self.collect)
+
+    def __len__(self):
+        return len(self._pending)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(), name=f'write-behind-{self.table_name}')
+
+    def peek(self, key) -> dict | None:
+        pending = self._pending.get(key)
+        inflight = self._inflight.get(key)
+        if pending is not None and inflight is not None:
+            return {**inflight, **pending}
+        return pending if pending is not None else inflight
+
+    async def submit(self, key, wait: bool = False, **values):
+        row = self._pending.get(key)
+        if row is None:
+            self._pending[key] = {self.key: key, **values}
+        else:
+            row.update(values)
+            COALESCED.inc(table=self.table_name)
+        if len(self._pending) >= self.max_batch:
+            self._wakeup.set()
+        if wait:
+            # 書き込みが完了するまで待つ(永続化が必要な呼び出し元向け)
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            self._wakeup.set()
+            await waiter
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Failed to flush {len(self._pending)} pending writes to {self.table_name}: {e}")
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._pending:
+                self._resolve_waiters()
+                return
+            batch, self._pending = self._pending, {}
+            self._inflight = batch
+            waiters, self._waiters = self._waiters, []
+            start = time.perf_counter()
+            try:
+                # 列の組み合わせごとにまとめて書き込む
+                groups: dict[frozenset, list[dict]] = {}
+                for row in batch.values():
+                    groups.setdefault(frozenset(row), []).append(row)
+                for rows in groups.values():
+                    await self.db.bulk_upsert(self.model, rows, [self.key])
+            except BaseException:
+                # 失敗した(キャンセルされた場合も含む)分は、その後に届いた新しい値を優先しつつキューに戻す
+                for key, row in batch.items():
+                    newer = self._pending.get(key)
+                    self._pending[key] = {**row, **newer} if newer else row
+                self._waiters = waiters + self._waiters
+                raise
+            finally:
+                self._inflight = {}
+            FLUSH_SECONDS.observe(time.perf_counter() - start, table=self.table_name)
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_result(None)
+
+    def _resolve_waiters(self):
+        waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    async def close(self):
+        if self._task is not None:
+            # 書き込み中のバッチがあれば終わるのを待ってから止める(途中でキャンセルするとバッチがキューから外れたままになる)
+            async with self._flush_lock:
+                self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.error(f"Lost {len(self._pending)} pending writes to {self.table_name} on shutdown: {e}")
+            for waiter in self._waiters:
+                if not waiter.done():
+                    waiter.set_exception(e)
+            raise
+        finally:
+            REGISTRY.unregister_collector(self.collect)
 
-    async def get_session(self) -> AsyncSession:
-        return self.async_session()
+    def collect(self):
+        yield 'folium_write_behind_pending', 'gauge', 'Rows waiting to be flushed.', [({'table': self.table_name}, len(self._pending))]
@@ -0,0 +1,200 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+from sqlalchemy import select
+
+from models import Guild
+
+logger = logging.getLogger('discord')
+
+
+class GuildConfig:
+    __slots__ = ('guild_id', 'prefix')
+
+    def __init__(self, guild_id: int, prefix: str):
+        self.guild_id = guild_id
+        self.prefix = prefix
+
+    def __repr__(self):
+        return f"<GuildConfig(guild_id={self.guild_id}, prefix='{self.prefix}')>"
+
+
+class CacheStats:
+    __slots__ = ('hits', 'misses', 'evictions', 'expirations')
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @property
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def as_dict(self) -> dict:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'hit_ratio': self.hit_ratio,
+        }
+
+
+# Guildテーブルの前段に置くプロセス内キャッシュ
+# 起動時にテーブル全体を読み込む
+# 更新はキャッシュへ即座に反映し、DBへの書き込みは writer(WriteBehindQueue)がまとめて行う
+# writer を渡さない場合は、DBへ書き込んでからキャッシュに反映する(write-through)
+class GuildConfigCache:
+    def __init__(self, db, default_prefix: str, max_size: int = 10000, ttl: float = 0, writer=None):
+        self.db = db
+        self.writer = writer
+        self.default_prefix = default_prefix
+        self.max_size = max_size
+        self.ttl = ttl  # 0以下なら期限なし
+        self.stats = CacheStats()
+        # guild_id -> (GuildConfig or None, 格納時刻)。Noneは「カスタム設定なし」のネガティブキャッシュ
+        self._entries: OrderedDict[int, tuple[GuildConfig | None, float]] = OrderedDict()
+        self._loading: dict[int, asyncio.Future] = {}
+        # 読み込み中に set_prefix や invalidate があったギルド。読み込んだ値は古いのでキャッシュに入れない
+        self._superseded: set[int] = set()
+        # テーブル全体を保持している間は、キャッシュにないギルド = 行が存在しないギルドとみなせる
+        self._authoritative = False
+
+    def __len__(self):
+        return len(self._entries)
+
+    async def warm(self):
+        async with self.db.read_session() as session:
+            result = await session.execute(select(Guild).limit(self.max_size + 1))
+            rows = result.scalars().all()
+
+        now = time.monotonic()
+        self._entries.clear()
+        for row in rows[:self.max_size]:
+            self._entries[row.guild_id] = (GuildConfig(row.guild_id, row.prefix), now)
+        self._authoritative = len(rows) <= self.max_size and self.ttl <= 0
+        logger.info(f"Guild config cache warmed with {len(self._entries)} guilds (authoritative={self._authoritative}).")
+
+    def _supersede(self, guild_id: int):
+        if guild_id in self._loading:
+            self._superseded.add(guild_id)
+
+    def _store(self, guild_id: int, config: GuildConfig | None):
+        self._entries[guild_id] = (config, time.monotonic())
+        self._entries.move_to_end(guild_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.stats.evictions += 1
+            self._authoritative = False
+
+    def _lookup(self, guild_id: int):
+        entry = self._entries.get(guild_id)
+        if entry is None:
+            return False, None
+        config, stored_at = entry
+        if self.ttl > 0 and time.monotonic() - stored_at > self.ttl:
+            del self._entries[guild_id]
+            self.stats.expirations += 1
+            return False, None
+        self._entries.move_to_end(guild_id)
+        return True, config
+
+    async def get(self, guild_id: int) -> GuildConfig | None:
+        found, config = self._lookup(guild_id)
+        if found:
+            self.stats.hits += 1
+            return config
+        if self._authoritative:
+            # 全件保持中なので、存在しないギルドはDBを引かずに「設定なし」と判定できる
+            self.stats.hits += 1
+            return None
+
+        self.stats.misses += 1
+        # 同じギルドへの同時ミスは1回のクエリにまとめる
+        pending = self._loading.get(guild_id)
+        if pending is not None:
+            return await asyncio.shield(pending)
+
+        future = asyncio.get_running_loop().create_future()
+        self._loading[guild_id] = future
+        try:
+            config = await self._load(guild_id)
+            if guild_id in self._superseded:
+                # 読み込みの間に更新された。新しい値がキャッシュにあればそれを返す
+                found, newer = self._lookup(guild_id)
+                if found:
+                    config = newer
+            else:
+                self._store(guild_id, config)
+            future.set_result(config)
+            return config
+        except Exception as e:
+            future.set_exception(e)
+            # 待機者がいない場合に "exception was never retrieved" を出さないようにする
+            future.exception()
+            raise
+        finally:
+            del self._loading[guild_id]
+            self._superseded.discard(guild_id)
+
+    async def get_prefix(self, guild_id: int) -> str:
+        config = await self.get(guild_id)
+        return config.prefix if config else self.default_prefix
+
+    async def _load(self, guild_id: int) -> GuildConfig | None:
+        # まだDBに書き込まれていない更新があればそちらを優先する
+        if self.writer is not None:
+            pending = self.writer.peek(guild_id)
+            if pending is not None and 'prefix' in pending:
+                return GuildConfig(guild_id, pending['prefix'])
+        async with self.db.read_session() as session:
+            result = await session.execute(select(Guild).where(Guild.guild_id == guild_id))
+            row = result.scalar_one_or_none()
+        return GuildConfig(guild_id, row.prefix) if row else None
+
+    async def set_prefix(self, guild_id: int, prefix: str, wait: bool = False) -> GuildConfig:
+        if self.writer is not None:
+            config = GuildConfig(guild_id, prefix)
+            self._supersede(guild_id)
+            self._store(guild_id, config)
+            # 同じギルドへの連続した更新は1行にまとめられ、次のフラッシュで一括upsertされる
+            await self.writer.submit(guild_id, wait=wait, prefix=prefix)
+            return config
+
+        async with self.db.get_session() as session:
+            result = await session.execute(select(Guild).where(Guild.guild_id == guild_id))
+            row = result.scalar_one_or_none()
+            if row:
+                row.prefix = prefix
+            else:
+                session.add(Guild(guild_id=guild_id, prefix=prefix))
+            await session.commit()
+
+        # DBへのコミットが成功してからキャッシュを更新する
+        config = GuildConfig(guild_id, prefix)
+        self._supersede(guild_id)
+        self._store(guild_id, config)
+        return config
+
+    def collect(self):
+        labels = {'cache': 'guild_config'}
+        yield 'folium_cache_hits_total', 'counter', 'Cache lookups served from memory.', [(labels, self.stats.hits)]
+        yield 'folium_cache_misses_total', 'counter', 'Cache lookups that went to the database.', [(labels, self.stats.misses)]
+        yield 'folium_cache_evictions_total', 'counter', 'Entries evicted by the LRU bound.', [(labels, self.stats.evictions)]
+        yield 'folium_cache_entries', 'gauge', 'Entries currently cached.', [(labels, len(self._entries))]
+
+    def invalidate(self, guild_id: int | None = None):
+        if guild_id is None:
+            self._entries.clear()
+            self._superseded.update(self._loading)
+            self._authoritative = False
+        else:
+            self._entries.pop(guild_id, None)
+            self._supersede(guild_id)
+            # 削除したギルドを「行なし」と誤判定しないようにする
+            self._authoritative = False
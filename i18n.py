@@ -0,0 +1,208 @@
+import json
+import logging
+import os
+import string
+from types import MappingProxyType
+
+import discord
+from discord import app_commands
+
+logger = logging.getLogger('discord')
+
+LOCALES_DIR = 'locales'
+DEFAULT_LOCALE = 'en-US'
+
+_formatter = string.Formatter()
+
+
+def locale_path(lang_code: str, locales_dir: str = LOCALES_DIR) -> str:
+    return os.path.join(locales_dir, lang_code, 'messages.json')
+
+
+def load_messages(path: str) -> dict[str, str]:
+    with open(path, 'r', encoding='utf-8') as f:
+        messages = json.load(f)
+    if not isinstance(messages, dict) or not all(isinstance(key, str) and isinstance(value, str) for key, value in messages.items()):
+        raise ValueError(f"{path} must be a JSON object of strings")
+    return messages
+
+
+# 翻訳ファイルを読み込む
+def load_translations(locales_dir: str = LOCALES_DIR) -> dict[str, dict[str, str]]:
+    translations = {}
+    for lang_dir in os.listdir(locales_dir):
+        messages_file = locale_path(lang_dir, locales_dir)
+        if os.path.exists(messages_file):
+            translations[lang_dir] = load_messages(messages_file)
+    return translations
+
+
+def placeholders(template: str) -> set[str]:
+    # 書式が壊れている場合(閉じていない { など)は ValueError になる
+    return {field.split('.')[0].split('[')[0] for _, field, _, _ in _formatter.parse(template) if field}
+
+
+def validate_messages(lang_code: str, messages: dict[str, str], reference: dict[str, str], previous: dict[str, str] | None = None) -> list[str]:
+    # 読み込んだ翻訳をen-US(reference)のキーと照らし合わせる
+    # 実行時に失敗する内容は ValueError にし、フォールバックで済むものは警告として返す
+    errors, warnings = [], []
+    if lang_code == DEFAULT_LOCALE and previous is not None:
+        # コードから参照されているキーを既定ロケールから消すことはできない
+        removed = previous.keys() - messages.keys()
+        if removed:
+            errors.append(f"removes keys {sorted(removed)}")
+    for key, template in messages.items():
+        try:
+            fields = placeholders(template)
+        except ValueError as e:
+            errors.append(f"'{key}' is not a valid template: {e}")
+            continue
+        if key not in reference:
+            warnings.append(f"unknown key '{key}'")
+        elif fields - placeholders(reference[key]):
+            errors.append(f"'{key}' uses placeholders {sorted(fields - placeholders(reference[key]))} not in {DEFAULT_LOCALE}")
+    missing = reference.keys() - messages.keys()
+    if missing and lang_code != DEFAULT_LOCALE:
+        warnings.append(f"missing {len(missing)} keys")
+    if errors:
+        raise ValueError(f"Locale '{lang_code}': " + "; ".join(errors))
+    return warnings
+
+
+def get_localized_name(key: str, translations: dict[str, dict[str, str]]) -> dict[discord.Locale, str]:
+    localizations = {}
+    for lang_code, messages in translations.items():
+        if key in messages:
+            try:
+                locale = discord.Locale(lang_code) # ディレクトリ名はDiscordのロケール値(en-US, ja など)と同じ
+                localizations[locale] = messages[key]
+            except ValueError:
+                # DiscordのLocaleに存在しない言語コードはスキップ
+                pass
+    return localizations
+
+
+# tree.set_translator() に渡す。key付きのlocale_strを翻訳ファイルから訳す
+# source は現在の翻訳(ロケール -> メッセージ)を返す関数で、再読み込み後の内容もそのまま反映される
+class CatalogTranslator(app_commands.Translator):
+    def __init__(self, source):
+        self.source = source
+
+    async def translate(self, string: app_commands.locale_str, locale: discord.Locale, context: app_commands.TranslationContext) -> str | None:
+        key = string.extras.get('key')
+        if key is None:
+            return None
+        messages = self.source().get(locale.value)
+        # 訳がないロケールはNoneを返し、Discord側で既定の文字列が使われる
+        return messages.get(key) if messages else None
+
+
+def fallback_chain(locale_code: str, available, default: str = DEFAULT_LOCALE) -> tuple[str, ...]:
+    # 例: ja -> en-US, en-GB -> en-US, es-419 -> es-ES(あれば) -> en-US
+    chain = []
+    if locale_code in available:
+        chain.append(locale_code)
+    language = locale_code.split('-')[0]
+    for code in sorted(available):
+        if code not in chain and code.split('-')[0] == language:
+            chain.append(code)
+    if default not in chain:
+        chain.append(default)
+    return tuple(chain)
+
+
+def _compile_template(template: str):
+    # 起動時にテンプレートを固定の文字列と {name} / {name:spec} の組に分解しておき、呼び出し時はつなげるだけにする
+    # 属性・添字の参照(a.b, a[0])や変換(!r)、入れ子の書式を含むものは str.format に任せる
+    parts = []
+    literal = ''
+    for text, field, spec, conversion in _formatter.parse(template):
+        literal += text
+        if field is None:
+            continue
+        if not field.isidentifier() or conversion or '{' in spec:
+            return template.format
+        parts.append((literal, field, spec))
+        literal = ''
+    tail = literal
+
+    if not parts:
+        return lambda **kwargs: tail
+    if len(parts) == 1:
+        (head, name, spec), = parts
+        return lambda **kwargs: head + format(kwargs[name], spec) + tail
+
+    parts = tuple(parts)
+
+    def render(**kwargs):
+        out = ''
+        for text, name, spec in parts:
+            out += text + format(kwargs[name], spec)
+        return out + tail
+
+    return render
+
+
+class MessageTable:
+    __slots__ = ('locale', '_messages', '_formatters')
+
+    def __init__(self, locale: str, messages: dict[str, str]):
+        object.__setattr__(self, 'locale', locale)
+        object.__setattr__(self, '_messages', MappingProxyType(dict(messages)))
+        object.__setattr__(self, '_formatters', MappingProxyType({key: _compile_template(value) for key, value in messages.items()}))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("MessageTable is immutable")
+
+    def __getitem__(self, key: str) -> str:
+        return self._messages[key]
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._messages
+
+    def get(self, key: str, default: str | None = None) -> str | None:
+        return self._messages.get(key, default)
+
+    def format(self, key: str, /, **kwargs) -> str:
+        return self._formatters[key](**kwargs)
+
+    def __repr__(self):
+        return f"<MessageTable(locale='{self.locale}', messages={len(self._messages)})>"
+
+
+# discord.Locale -> MessageTable の対応表を起動時に一度だけ作る
+# ホットパスでは catalog[interaction.locale] の辞書参照1回でロケール解決が終わる
+class MessageCatalog:
+    __slots__ = ('_tables', 'default')
+
+    def __init__(self, translations: dict[str, dict[str, str]], default_locale: str = DEFAULT_LOCALE):
+        if default_locale not in translations:
+            raise ValueError(f"Default locale '{default_locale}' not found in translations")
+
+        tables_by_chain: dict[tuple[str, ...], MessageTable] = {}
+        tables: dict[discord.Locale, MessageTable] = {}
+        for locale in discord.Locale:
+            chain = fallback_chain(locale.value, translations, default_locale)
+            table = tables_by_chain.get(chain)
+            if table is None:
+                table = MessageTable(chain[0], self._merge(chain, translations))
+                tables_by_chain[chain] = table
+            tables[locale] = table
+
+        self._tables = MappingProxyType(tables)
+        self.default = tables_by_chain.get((default_locale,)) or MessageTable(default_locale, translations[default_locale])
+
+    @staticmethod
+    def _merge(chain: tuple[str, ...], translations: dict[str, dict[str, str]]) -> dict[str, str]:
+        # チェーンの後ろ(フォールバック先)から順に上書きしていく
+        merged = {}
+        for code in reversed(chain):
+            merged.update(translations[code])
+        missing = translations[chain[-1]].keys() - translations[chain[0]].keys()
+        if missing and chain[0] != chain[-1]:
+            logger.warning(f"Locale '{chain[0]}' is missing {len(missing)} keys; falling back via {' -> '.join(chain[1:])}: {sorted(missing)}")
+        return merged
+
+    def __getitem__(self, locale: discord.Locale) -> MessageTable:
+        return self._tables.get(locale, self.default)
+
@@ -0,0 +1,171 @@
+import asyncio
+import io
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager
+
+import discord
+
+from instrumentation import REGISTRY, record_phase
+
+logger = logging.getLogger('discord')
+
+# ギルド外(DM)でのアップロード上限
+DEFAULT_UPLOAD_LIMIT = 10 * 1024 * 1024
+
+DELIVERIES = REGISTRY.counter('folium_image_deliveries_total', 'Generated images delivered, by path.', ('path',))
+
+_SIGNATURES = (
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'\xff\xd8\xff', 'jpg'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+)
+
+
+def sniff_format(data) -> str | None:
+    head = bytes(memoryview(data)[:12])
+    for signature, extension in _SIGNATURES:
+        if head.startswith(signature):
+            return extension
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'webp'
+    return None
+
+
+def _transcode(data: bytes, max_bytes: int) -> tuple[bytes, str]:
+    # ワーカープロセスで実行される。PILはここでだけ読み込む
+    from PIL import Image
+
+    image = Image.open(io.BytesIO(data))
+    image.load()
+
+    output = io.BytesIO()
+    image.save(output, 'PNG', optimize=True)
+    if output.tell() <= max_bytes:
+        return output.getvalue(), 'png'
+
+    # PNGで収まらない場合は品質、次に解像度を下げながらWebPで収まるまで再圧縮する
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+    while True:
+        for quality in (90, 80, 70, 60):
+            output = io.BytesIO()
+            image.save(output, 'WEBP', quality=quality, method=4)
+            if output.tell() <= max_bytes:
+                return output.getvalue(), 'webp'
+        width, height = image.size
+        if width <= 64 or height <= 64:
+            raise ValueError(f"Image cannot be compressed below {max_bytes} bytes")
+        image = image.resize((int(width * 0.75), int(height * 0.75)), Image.LANCZOS)
+
+
+# memoryviewをコピーせずにファイルのように読めるようにする(discord.Fileに渡す用)
+class MemoryViewReader(io.RawIOBase):
+    def __init__(self, buffer):
+        self._view = memoryview(buffer).cast('B')
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        size = min(len(b), len(self._view) - self._position)
+        if size <= 0:
+            return 0
+        b[:size] = self._view[self._position:self._position + size]
+        self._position += size
+        return size
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._position + offset
+        elif whence == io.SEEK_END:
+            position = len(self._view) + offset
+        else:
+            raise ValueError(f"Invalid whence: {whence}")
+        if position < 0:
+            raise ValueError("Negative seek position")
+        self._position = position
+        return position
+
+    def tell(self):
+        return self._position
+
+    def close(self):
+        if not self.closed:
+            self._view.release()
+        super().close()
+
+
+# 同時に保持する画像バッファの合計サイズを制限する
+class MemoryBudget:
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.used = 0
+        self._condition = asyncio.Condition()
+
+    @asynccontextmanager
+    async def reserve(self, size: int):
+        async with self._condition:
+            # 上限より大きいバッファは、他に何も保持していないときだけ通す
+            await self._condition.wait_for(lambda: self.used == 0 or self.used + size <= self.capacity)
+            self.used += size
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self.used -= size
+                self._condition.notify_all()
+
+
+# /imagine の画像をDiscordへ渡すまでの処理
+# - そのまま送れる形式・サイズならmemoryview経由でコピーせずに渡す
+# - 変換や圧縮が必要な場合はプロセスプールで行い、イベントループを止めない
+class ImagePipeline:
+    def __init__(self, max_workers: int = 2, memory_budget: int = 64 * 1024 * 1024, accepted_formats=('png', 'jpg', 'gif', 'webp')):
+        self.max_workers = max_workers
+        self.budget = MemoryBudget(memory_budget)
+        self.accepted_formats = frozenset(accepted_formats)
+        self._executor: ProcessPoolExecutor | None = None
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        # 最初に変換が必要になるまでワーカーは起動しない
+        # この時点ではログのリスナーなどのスレッドが動いているため、forkではなくspawnで起動する(ロックを持ったままコピーされるとデッドロックする)
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context('spawn'))
+        return self._executor
+
+    @asynccontextmanager
+    async def deliver(self, data: bytes, max_bytes: int = DEFAULT_UPLOAD_LIMIT, filename: str = 'generated_image'):
+        extension = sniff_format(data)
+        passthrough = extension in self.accepted_formats and len(data) <= max_bytes
+        reservation = len(data) if passthrough else len(data) + max_bytes
+
+        async with self.budget.reserve(reservation):
+            if passthrough:
+                DELIVERIES.inc(path='passthrough')
+                payload = data
+            else:
+                DELIVERIES.inc(path='transcode')
+                loop = asyncio.get_running_loop()
+                start = loop.time()
+                payload, extension = await loop.run_in_executor(self._get_executor(), _transcode, data, max_bytes)
+                record_phase('transcode', loop.time() - start)
+
+            file = discord.File(MemoryViewReader(payload), filename=f'{filename}.{extension}')
+            try:
+                yield file
+            finally:
+                file.close()
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
@@ -0,0 +1,275 @@
+import asyncio
+import bisect
+import contextlib
+import logging
+import math
+import time
+from contextvars import ContextVar
+
+import discord
+from discord import app_commands
+
+logger = logging.getLogger('discord')
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + '}'
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    if math.isnan(value):
+        return 'NaN'
+    return repr(float(value))
+
+
+class _Metric:
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def _key(self, labels: dict) -> tuple:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key: tuple) -> dict:
+        return dict(zip(self.labelnames, key))
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {_escape(self.documentation)}', f'# TYPE {self.name} {self.kind}']
+        lines.extend(self._render_samples())
+        return lines
+
+    def _render_samples(self) -> list[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def _render_samples(self):
+        return [f'{self.name}{_format_labels(self._labels(key))} {_format_value(value)}' for key, value in self._values.items()]
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[tuple, float] = {}
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels):
+        self.inc(-amount, **labels)
+
+    def _render_samples(self):
+        return [f'{self.name}{_format_labels(self._labels(key))} {_format_value(value)}' for key, value in self._values.items()]
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # key -> [各バケットの件数(累積ではない), 合計, 件数]
+        self._values: dict[tuple, list] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        state = self._values.get(key)
+        if state is None:
+            state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+        state[0][bisect.bisect_left(self.buckets, value)] += 1
+        state[1] += value
+        state[2] += 1
+
+    def _render_samples(self):
+        lines = []
+        for key, (counts, total, count) in self._values.items():
+            labels = self._labels(key)
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{_format_labels({**labels, "le": _format_value(bound)})} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(labels)} {_format_value(total)}')
+            lines.append(f'{self.name}_count{_format_labels(labels)} {count}')
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: dict[str, _Metric] = {}
+        self._collectors = []
+
+    def _register(self, cls, name, documentation, labelnames, **kwargs):
+        metric = self._metrics.get(name)
+        if metric is not None:
+            if not isinstance(metric, cls) or metric.labelnames != tuple(labelnames):
+                raise ValueError(f"Metric {name} is already registered with a different type or labels")
+            return metric
+        metric = self._metrics[name] = cls(name, documentation, labelnames, **kwargs)
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames=()) -> Counter:
+        return self._register(Counter, name, documentation, labelnames)
+
+    def gauge(self, name: str, documentation: str, labelnames=()) -> Gauge:
+        return self._register(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    # スクレイプ時に呼ばれ、(name, kind, documentation, [(labels, value), ...]) を返す関数を登録する
+    # キャッシュの統計値のように、別の場所で管理している値を公開するために使う
+    def register_collector(self, collector):
+        self._collectors.append(collector)
+
+    def unregister_collector(self, collector):
+        try:
+            self._collectors.remove(collector)
+        except ValueError:
+            pass
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        for collector in self._collectors:
+            try:
+                collected = list(collector())
+            except Exception as e:
+                logger.warning(f"Metrics collector {collector!r} failed: {e}")
+                continue
+            for name, kind, documentation, samples in collected:
+                lines.append(f'# HELP {name} {_escape(documentation)}')
+                lines.append(f'# TYPE {name} {kind}')
+                for labels, value in samples:
+                    lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+COMMAND_SECONDS = REGISTRY.histogram(
+    'folium_command_duration_seconds',
+    'App command latency by phase (total, defer, db, ai).',
+    ('command', 'phase'),
+)
+COMMAND_TOTAL = REGISTRY.counter('folium_commands_total', 'App command invocations by outcome.', ('command', 'status'))
+DB_SESSION_SECONDS = REGISTRY.histogram('folium_db_session_seconds', 'Time spent inside Database sessions.')
+
+# 実行中のコマンドごとのフェーズ別累積時間(DB時間、AI時間など)と、そのコマンドを実行しているタスク
+# コマンドの中で作られたタスク(会話の保存、write-behindのフラッシュなど)もコンテキストを引き継ぐが、
+# コマンドより長く動き続けるためコマンドの時間には数えない
+_current_phases: ContextVar[tuple[asyncio.Task, dict] | None] = ContextVar('folium_command_phases', default=None)
+
+
+def record_phase(phase: str, seconds: float):
+    current = _current_phases.get()
+    if current is None:
+        return
+    try:
+        task = asyncio.current_task()
+    except RuntimeError:
+        # to_thread などでイベントループの外から呼ばれた場合
+        return
+    owner, phases = current
+    if task is owner:
+        phases[phase] = phases.get(phase, 0.0) + seconds
+
+
+@contextlib.contextmanager
+def track_phase(phase: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_phase(phase, time.perf_counter() - start)
+
+
+# MyBot.tree で登録されたすべてのアプリコマンドの実行時間を計測するCommandTree
+class InstrumentedCommandTree(app_commands.CommandTree):
+    async def _call(self, interaction: discord.Interaction):
+        phases = {}
+        token = _current_phases.set((asyncio.current_task(), phases))
+        start = time.perf_counter()
+        status = None
+        try:
+            await super()._call(interaction)
+        except app_commands.CommandNotFound:
+            # 同期されていない古いコマンドなど。コマンド名が分からないので 'unknown' として数える
+            status = 'not_found'
+            raise
+        finally:
+            total = time.perf_counter() - start
+            _current_phases.reset(token)
+            command = interaction.command.qualified_name if interaction.command else 'unknown'
+            if status is None:
+                if interaction.type is discord.InteractionType.autocomplete:
+                    status = 'autocomplete'
+                else:
+                    status = 'error' if interaction.command_failed else 'ok'
+            COMMAND_TOTAL.inc(command=command, status=status)
+            # オートコンプリートの時間はコマンド本体の時間と混ぜない
+            COMMAND_SECONDS.observe(total, command=command, phase='autocomplete' if status == 'autocomplete' else 'total')
+            for phase, seconds in phases.items():
+                COMMAND_SECONDS.observe(seconds, command=command, phase=phase)
+
+
+# ローカルの /metrics エンドポイント(Prometheusのテキスト形式)
+class MetricsExporter:
+    def __init__(self, registry: MetricsRegistry = REGISTRY, host: str = '127.0.0.1', port: int = 9464):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self._runner = None
+
+    async def start(self):
+        from aiohttp import web
+
+        app = web.Application()
+        app.router.add_get('/metrics', self._handle_metrics)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        logger.info(f"Metrics exporter listening on http://{self.host}:{self.port}/metrics")
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def _handle_metrics(self, request):
+        from aiohttp import web
+
+        return web.Response(body=self.registry.render().encode('utf-8'), headers={'Content-Type': CONTENT_TYPE})
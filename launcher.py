@@ -0,0 +1,243 @@
+import argparse
+import json
+import logging
+import math
+import multiprocessing
+import os
+import queue
+import signal
+import time
+import urllib.request
+
+import yaml
+
+logger = logging.getLogger('folium.launcher')
+
+GATEWAY_BOT_URL = 'https://discord.com/api/v10/gateway/bot'
+# Discordの推奨値はおおよそ1000ギルドにつき1シャード
+GUILDS_PER_SHARD = 1000
+
+
+def shard_ranges(shard_count: int, clusters: int) -> list[list[int]]:
+    # シャードを連続した範囲に分け、先頭のクラスタから1つずつ余りを割り振る
+    clusters = max(1, min(clusters, shard_count))
+    base, extra = divmod(shard_count, clusters)
+    ranges, start = [], 0
+    for cluster_id in range(clusters):
+        size = base + (1 if cluster_id < extra else 0)
+        ranges.append(list(range(start, start + size)))
+        start += size
+    return ranges
+
+
+def shard_for_guild(guild_id: int, shard_count: int) -> int:
+    return (guild_id >> 22) % shard_count
+
+
+def fetch_recommended_shards(token: str) -> int:
+    request = urllib.request.Request(GATEWAY_BOT_URL, headers={'Authorization': f'Bot {token}', 'User-Agent': 'Folium launcher'})
+    with urllib.request.urlopen(request, timeout=10) as response:
+        return json.load(response)['shards']
+
+
+# ゲートウェイの代わりにシャードの割り当てをローカルで確認するためのスタンドイン
+class MockGateway:
+    def __init__(self, guild_ids: list[int]):
+        self.guild_ids = guild_ids
+
+    @classmethod
+    def synthetic(cls, guild_count: int):
+        # Discordのsnowflakeと同じ形(上位ビットがタイムスタンプ)のギルドIDを作る
+        step = 7_919
+        return cls([((i * step) << 22) | (i % 4096) for i in range(1, guild_count + 1)])
+
+    def recommended_shards(self) -> int:
+        return max(1, math.ceil(len(self.guild_ids) / GUILDS_PER_SHARD))
+
+    def distribution(self, shard_count: int, clusters: int) -> list[dict]:
+        per_shard = [0] * shard_count
+        for guild_id in self.guild_ids:
+            per_shard[shard_for_guild(guild_id, shard_count)] += 1
+        report = []
+        for cluster_id, shard_ids in enumerate(shard_ranges(shard_count, clusters)):
+            report.append({
+                'cluster_id': cluster_id,
+                'shards': f'{shard_ids[0]}-{shard_ids[-1]}' if shard_ids else '-',
+                'guilds': sum(per_shard[shard_id] for shard_id in shard_ids),
+                'max_guilds_per_shard': max((per_shard[shard_id] for shard_id in shard_ids), default=0),
+            })
+        return report
+
+
+def _run_worker(cluster_id: int, shard_ids: list[int], shard_count: int, health_queue):
+    # ワーカープロセスのエントリーポイント。main を読み込む前にクラスタIDを設定してログファイルを分ける
+    os.environ['FOLIUM_CLUSTER_ID'] = str(cluster_id)
+    import main
+
+    main.run_bot(shard_ids=shard_ids, shard_count=shard_count, cluster_id=cluster_id, health_queue=health_queue)
+
+
+class _Worker:
+    __slots__ = ('cluster_id', 'shard_ids', 'process', 'started_at', 'restarts', 'next_start')
+
+    def __init__(self, cluster_id: int, shard_ids: list[int]):
+        self.cluster_id = cluster_id
+        self.shard_ids = shard_ids
+        self.process = None
+        self.started_at = 0.0
+        self.restarts = 0
+        self.next_start = 0.0
+
+
+# 複数のワーカープロセスを起動し、落ちたものを再起動しながら状態を集約する
+class ClusterLauncher:
+    def __init__(self, token: str | None, clusters: int = 1, shard_count: int = 0, health_interval: float = 30, max_restart_delay: float = 60):
+        self.token = token
+        self.clusters = clusters
+        self.shard_count = shard_count
+        self.health_interval = health_interval
+        self.max_restart_delay = max_restart_delay
+        self._context = multiprocessing.get_context('spawn')
+        self._health_queue = self._context.Queue()
+        self._health: dict[int, dict] = {}
+        self._workers: list[_Worker] = []
+        self._stopping = False
+
+    def _resolve_shard_count(self) -> int:
+        if self.shard_count > 0:
+            return self.shard_count
+        count = fetch_recommended_shards(self.token)
+        logger.info(f"Gateway recommends {count} shards")
+        return count
+
+    def _start(self, worker: _Worker, shard_count: int):
+        process = self._context.Process(
+            target=_run_worker,
+            args=(worker.cluster_id, worker.shard_ids, shard_count, self._health_queue),
+            name=f'folium-cluster-{worker.cluster_id}',
+        )
+        process.start()
+        worker.process = process
+        worker.started_at = time.monotonic()
+        logger.info(f"Started cluster {worker.cluster_id} (pid {process.pid}) with shards {worker.shard_ids[0]}-{worker.shard_ids[-1]}")
+
+    def _stop(self, *_):
+        self._stopping = True
+
+    def run(self):
+        shard_count = self._resolve_shard_count()
+        self._workers = [_Worker(cluster_id, shard_ids) for cluster_id, shard_ids in enumerate(shard_ranges(shard_count, self.clusters))]
+        signal.signal(signal.SIGINT, self._stop)
+        signal.signal(signal.SIGTERM, self._stop)
+
+        for worker in self._workers:
+            self._start(worker, shard_count)
+
+        last_report = time.monotonic()
+        try:
+            while not self._stopping:
+                self._drain_health(timeout=1.0)
+                self._supervise(shard_count)
+                if time.monotonic() - last_report >= self.health_interval:
+                    self._log_health()
+                    last_report = time.monotonic()
+        finally:
+            self._shutdown()
+
+    def _supervise(self, shard_count: int):
+        now = time.monotonic()
+        for worker in self._workers:
+            process = worker.process
+            if process is not None and process.is_alive():
+                continue
+            if process is not None:
+                uptime = now - worker.started_at
+                # 長時間動いていたワーカーの停止は新しい障害として扱い、待ち時間をリセットする
+                if uptime > 300:
+                    worker.restarts = 0
+                delay = min(self.max_restart_delay, 2 ** worker.restarts)
+                worker.restarts += 1
+                worker.next_start = now + delay
+                worker.process = None
+                self._health.pop(worker.cluster_id, None)
+                logger.warning(f"Cluster {worker.cluster_id} exited with code {process.exitcode} after {uptime:.0f}s; restarting in {delay:.0f}s")
+            elif now >= worker.next_start and not self._stopping:
+                self._start(worker, shard_count)
+
+    def _drain_health(self, timeout: float):
+        try:
+            report = self._health_queue.get(timeout=timeout)
+        except queue.Empty:
+            return
+        while True:
+            self._health[report['cluster_id']] = report
+            try:
+                report = self._health_queue.get_nowait()
+            except queue.Empty:
+                return
+
+    def health_summary(self) -> dict:
+        now = time.time()
+        stale_after = self.health_interval * 3
+        latencies = [latency for report in self._health.values() for latency in report['shards'].values() if math.isfinite(latency)]
+        return {
+            'clusters': len(self._workers),
+            'alive': sum(1 for worker in self._workers if worker.process is not None and worker.process.is_alive()),
+            'ready': sum(1 for report in self._health.values() if report['ready']),
+            'stale': sorted(cluster_id for cluster_id, report in self._health.items() if now - report['timestamp'] > stale_after),
+            'guilds': sum(report['guilds'] for report in self._health.values()),
+            'max_latency_ms': round(max(latencies) * 1000, 2) if latencies else None,
+            'restarts': {worker.cluster_id: worker.restarts for worker in self._workers if worker.restarts},
+        }
+
+    def _log_health(self):
+        logger.info(f"Cluster health: {self.health_summary()}")
+
+    def _shutdown(self):
+        logger.info("Stopping clusters...")
+        for worker in self._workers:
+            if worker.process is not None and worker.process.is_alive():
+                worker.process.terminate()
+        for worker in self._workers:
+            if worker.process is not None:
+                worker.process.join(timeout=30)
+                if worker.process.is_alive():
+                    worker.process.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run Folium as multiple sharded worker processes.')
+    parser.add_argument('--clusters', type=int, help='number of worker processes')
+    parser.add_argument('--shards', type=int, help='total shard count (0 = gateway recommendation)')
+    parser.add_argument('--dry-run', action='store_true', help='show shard assignment against a mock gateway and exit')
+    parser.add_argument('--guilds', type=int, default=10000, help='synthetic guild count for --dry-run')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='[%(asctime)s] [%(levelname)-8s] %(name)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+
+    with open('config.yaml', 'r', encoding='utf-8') as f:
+        cluster_config = (yaml.safe_load(f) or {}).get('cluster', {})
+    clusters = args.clusters or cluster_config.get('clusters', 1)
+    shard_count = args.shards if args.shards is not None else cluster_config.get('shard_count', 0)
+
+    if args.dry_run:
+        gateway = MockGateway.synthetic(args.guilds)
+        shard_count = shard_count or gateway.recommended_shards()
+        print(f"{args.guilds} guilds, {shard_count} shards, {clusters} clusters")
+        for row in gateway.distribution(shard_count, clusters):
+            print(f"  cluster {row['cluster_id']}: shards {row['shards']:>9}  guilds {row['guilds']:>7}  max/shard {row['max_guilds_per_shard']}")
+        return
+
+    with open('auth.json', 'r', encoding='utf-8') as f:
+        token = json.load(f).get('discord_token')
+    ClusterLauncher(
+        token,
+        clusters=clusters,
+        shard_count=shard_count,
+        health_interval=cluster_config.get('health_interval', 30),
+        max_restart_delay=cluster_config.get('max_restart_delay', 60),
+    ).run()
+
+
+if __name__ == '__main__':
+    main()
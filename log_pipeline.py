@@ -0,0 +1,228 @@
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+
+from instrumentation import REGISTRY
+
+DROPPED = REGISTRY.counter('folium_log_dropped_total', 'Log records dropped because the log queue was full.', ('level',))
+SAMPLED_OUT = REGISTRY.counter('folium_log_sampled_out_total', 'Log records skipped by sampling.', ('event',))
+
+DEFAULT_FORMAT = '[{asctime}] [{levelname:<8}] {name}: {message}'
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# JSON出力に含めない LogRecord の標準属性(これ以外は extra として出力する)
+_RESERVED = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'taskName'}
+
+
+# イベントループ側のフロントエンド。キューに入れるだけで、書式化もI/Oもしない
+# キューが一杯のときは待たずに捨てて数える(ディスクが詰まってもハートビートを止めない)
+class BoundedQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, maxsize: int = 10000):
+        super().__init__(queue.Queue(maxsize))
+        self.dropped = 0
+
+    def prepare(self, record):
+        # 既定の prepare はここでメッセージを組み立てるが、書式化はリスナーのスレッドまで遅らせる
+        # 例外情報だけは、後で元の例外オブジェクトが変わらないうちにテキスト化しておく
+        record = copy.copy(record)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            DROPPED.inc(level=record.levelname)
+
+
+# extra={'event': 名前} の付いたINFO以下のログを、設定した割合だけ残す
+# 乱数ではなく累積で判定するので、例えば0.1なら正確に10件に1件になる
+class SamplingFilter(logging.Filter):
+    def __init__(self, rates: dict[str, float] | None = None):
+        super().__init__()
+        self.rates = dict(rates or {})
+        self._credit: dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record) -> bool:
+        event = getattr(record, 'event', None)
+        if event is None or record.levelno > logging.INFO:
+            return True
+        rate = self.rates.get(event, 1.0)
+        if rate >= 1.0:
+            return True
+        with self._lock:
+            credit = self._credit.get(event, 1.0) + rate
+            keep = credit >= 1.0
+            self._credit[event] = credit - 1.0 if keep else credit
+        if keep:
+            record.sample_rate = rate
+        else:
+            SAMPLED_OUT.inc(event=event)
+        return keep
+
+
+# 1行1オブジェクトのJSON。メッセージの組み立てはこの時点(リスナーのスレッド)で行う
+class JsonLinesFormatter(logging.Formatter):
+    def format(self, record) -> str:
+        entry = {
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RESERVED and not key.startswith('_'):
+                entry[key] = value if isinstance(value, (str, int, float, bool, type(None))) else repr(value)
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, separators=(',', ':'))
+
+
+# まとめて書き込めるRotatingFileHandler。リスナーからはレコードのリストで呼ばれる
+class BatchingFileHandler(logging.handlers.RotatingFileHandler):
+    def emit_batch(self, records):
+        lines = []
+        for record in records:
+            try:
+                lines.append(self.format(record))
+            except Exception:
+                self.handleError(record)
+        if not lines:
+            return
+        data = self.terminator.join(lines) + self.terminator
+        try:
+            with self.lock:
+                if self.stream is None:
+                    self.stream = self._open()
+                if self.maxBytes > 0 and self.stream.tell() + len(data.encode(self.encoding or 'utf-8')) >= self.maxBytes:
+                    self.doRollover()
+                self.stream.write(data)
+                self.stream.flush()
+        except Exception:
+            self.handleError(records[-1])
+
+
+# キューからレコードを取り出し、最大 batch_size 件ずつハンドラーへ渡すスレッド
+class BatchingListener:
+    _STOP = object()
+
+    def __init__(self, queue_handler: BoundedQueueHandler, handlers, batch_size: int = 256, flush_interval: float = 0.5):
+        self.queue = queue_handler.queue
+        self.queue_handler = queue_handler
+        self.handlers = list(handlers)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._reported_drops = 0
+        self._thread: threading.Thread | None = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='log-listener', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5.0):
+        # 残っているレコードを書き出してから止める。全体で timeout 秒を超えては待たない(atexit から呼ばれるため)
+        if self._thread is None:
+            return
+        deadline = time.monotonic() + timeout
+        try:
+            self.queue.put(self._STOP, timeout=timeout)
+        except queue.Full:
+            # リスナーが書き込みで詰まっている。一番古いレコードを捨てて(数は最後にリスナーが報告する)停止の合図を入れる
+            try:
+                record = self.queue.get_nowait()
+                self.queue_handler.dropped += 1
+                DROPPED.inc(level=record.levelname)
+                self.queue.put_nowait(self._STOP)
+            except (queue.Empty, queue.Full):
+                pass
+        thread, self._thread = self._thread, None
+        thread.join(max(0.0, deadline - time.monotonic()))
+        if thread.is_alive():
+            # 書き込み中のハンドラーは閉じずに諦める(デーモンスレッドなのでプロセスの終了は妨げない)
+            print(f"Log listener did not stop within {timeout}s; {self.queue.qsize()} log records were not written", file=sys.stderr)
+            return
+        for handler in self.handlers:
+            handler.close()
+
+    def _run(self):
+        while True:
+            try:
+                batch = [self.queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                self._report_drops()
+                continue
+            # 溜まっている分は待たずにまとめて取り出す
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = batch[-1] is self._STOP
+            if stop:
+                batch.pop()
+            self._write(batch)
+            self._report_drops()
+            if stop:
+                return
+
+    def _write(self, records):
+        if not records:
+            return
+        for handler in self.handlers:
+            accepted = [record for record in records if record.levelno >= handler.level and handler.filter(record)]
+            if not accepted:
+                continue
+            if hasattr(handler, 'emit_batch'):
+                handler.emit_batch(accepted)
+            else:
+                for record in accepted:
+                    handler.handle(record)
+
+    def _report_drops(self):
+        dropped = self.queue_handler.dropped
+        if dropped > self._reported_drops:
+            record = logging.LogRecord('discord.logging', logging.WARNING, __file__, 0, "Dropped %d log records because the log queue was full", (dropped - self._reported_drops,), None)
+            self._reported_drops = dropped
+            self._write([record])
+
+
+def setup_logging(logger: logging.Logger, config, filename: str) -> BatchingListener:
+    # logger にキューのハンドラーだけを付け、ファイルへの書き込みはリスナーのスレッドで行う
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+    file_handler = BatchingFileHandler(
+        filename=filename,
+        encoding='utf-8',
+        maxBytes=config.get('max_bytes', 32 * 1024 * 1024),
+        backupCount=config.get('backup_count', 5),
+    )
+    if config.get('format', 'text') == 'json':
+        file_handler.setFormatter(JsonLinesFormatter())
+    else:
+        file_handler.setFormatter(logging.Formatter(DEFAULT_FORMAT, DATE_FORMAT, style='{'))
+
+    queue_handler = BoundedQueueHandler(config.get('queue_size', 10000))
+    sampling = SamplingFilter(config.get('sampling', {}))
+    queue_handler.addFilter(sampling)
+    logger.addHandler(queue_handler)
+
+    handlers = [file_handler]
+    if config.get('console', True):
+        # コンソールへの出力もリスナーのスレッドで行う(discord.py の既定のハンドラーはイベントループ上で書き込むため使わない)
+        console_handler = logging.StreamHandler(sys.stderr)
+        console_handler.setFormatter(logging.Formatter(DEFAULT_FORMAT, DATE_FORMAT, style='{'))
+        handlers.append(console_handler)
+
+    listener = BatchingListener(queue_handler, handlers, batch_size=config.get('batch_size', 256), flush_interval=config.get('flush_interval', 0.5))
+    listener.sampling = sampling # 設定の再読み込みで rates を差し替えられるようにする
+    listener.start()
+    return listener
@@ -2,13 +2,28 @@ import discord
 from discord.ext import commands
 from discord import app_commands
 import os
-import yaml
 import logging
-import logging.handlers
+import atexit
 import json
+import hashlib
+import time
+import asyncio
+import signal
 from dotenv import load_dotenv
 
-from database import Database
+from database import Database, WriteBehindQueue
+from models import Guild
+from guild_cache import GuildConfigCache
+from system_metrics import SystemMetricsSampler
+from rate_limit import RateLimiter, create_backend
+from scheduler import JobScheduler
+from component_router import ComponentRouter
+from cache_policy import CachePolicy, cache_report, format_report
+from profiler import Profiler, NotOwner
+from instrumentation import REGISTRY, InstrumentedCommandTree, MetricsExporter
+from i18n import CatalogTranslator
+from config_service import SETTINGS
+from log_pipeline import setup_logging
 
 # .envファイルを読み込む
 load_dotenv()
@@ -16,16 +31,16 @@ load_dotenv()
 logger = logging.getLogger('discord')
 logger.setLevel(logging.INFO)
 
-handler = logging.handlers.RotatingFileHandler(
-    filename='logs/discord.log',
-    encoding='utf-8',
-    maxBytes=32 * 1024 * 1024,
-    backupCount=5,
+# ログはキューに入れるだけにし、ファイルへの書き込みはリスナーのスレッドでまとめて行う
+# ランチャーから起動されたワーカーはクラスタごとに別のログファイルへ書き込む
+cluster_env = os.getenv('FOLIUM_CLUSTER_ID')
+log_listener = setup_logging(
+    logger,
+    SETTINGS.config.get('logging', {}),
+    filename=f'logs/discord-cluster{cluster_env}.log' if cluster_env else 'logs/discord.log',
 )
-dt_fmt = '%Y-%m-%d %H:%M:%S'
-formatter = logging.Formatter('[{asctime}] [{levelname:<8}] {name}: {message}', dt_fmt, style='{')
-handler.setFormatter(formatter)
-logger.addHandler(handler)
+# 終了時にキューに残っているログを書き出す
+atexit.register(log_listener.stop)
 
 # auth.jsonから認証情報を読み込む
 try:
@@ -49,101 +64,304 @@ except json.JSONDecodeError:
     logger.error("Error: auth.json is not a valid JSON file.")
     TOKEN = None
 
-with open('config.yaml', 'r', encoding='utf-8') as f:
-    config = yaml.safe_load(f)
+class MyBot(commands.AutoShardedBot):
+    def __init__(self, shard_ids: list[int] | None = None, shard_count: int | None = None, cluster_id: int | None = None, health_queue=None):
+        config = SETTINGS.config
+        # Intentとキャッシュは最小限(guildsのみ、メッセージキャッシュなし、チャンクなし)で作り、
+        # Cogを読み込んだ後に各Cogの cache_needs を合わせたものを接続前に反映する
+        cache_policy = CachePolicy.from_config(config.get('cache', {}).get('policy', {}))
 
-# Function to override config with environment variables
-def override_config_with_env(cfg, prefix=""):
-    for key, value in cfg.items():
-        env_var_name = f"{prefix}{key.upper()}"
-        if isinstance(value, dict):
-            override_config_with_env(value, f"{env_var_name}_")
-        else:
-            env_value = os.getenv(env_var_name)
-            if env_value is not None:
-                # Attempt to convert env_value to the original type
-                if isinstance(value, int):
-                    try:
-                        cfg[key] = int(env_value)
-                    except ValueError:
-                        logger.warning(f"Environment variable {env_var_name} has invalid integer value: {env_value}")
-                elif isinstance(value, bool):
-                    cfg[key] = env_value.lower() in ('true', '1', 't', 'y', 'yes')
-                else:
-                    cfg[key] = env_value
-                logger.info(f"Overridden config['{key}'] with environment variable {env_var_name}: {cfg[key]}")
-
-# Apply environment variable overrides
-override_config_with_env(config)
-
-# 翻訳ファイルを読み込む
-def load_translations():
-    translations = {}
-    for lang_dir in os.listdir('locales'):
-        lang_path = os.path.join('locales', lang_dir)
-        if os.path.isdir(lang_path):
-            messages_file = os.path.join(lang_path, 'messages.json')
-            if os.path.exists(messages_file):
-                with open(messages_file, 'r', encoding='utf-8') as f:
-                    translations[lang_dir] = json.load(f)
-    return translations
-
-TRANSLATIONS = load_translations()
-
-def get_localized_name(key: str) -> dict[discord.Locale, str]:
-    localizations = {}
-    for lang_code, messages in TRANSLATIONS.items():
-        if key in messages:
-            try:
-                locale = discord.Locale(lang_code.replace('-', '_').lower()) # en-US -> en_us
-                localizations[locale] = messages[key]
-            except ValueError:
-                # DiscordのLocaleに存在しない言語コードはスキップ
-                pass
-    return localizations
-
-class MyBot(commands.Bot):
-    def __init__(self):
-        intents = discord.Intents.default()
-        intents.message_content = True
-        intents.guilds = True
-
-        super().__init__(intents=intents) # command_prefixを削除
-        self.tree = app_commands.CommandTree(self)
+        # すべてのアプリコマンドの実行時間を計測するため、CommandTreeを差し替える
+        # shard_idsを指定しない場合は、推奨シャード数のすべてをこのプロセスで受け持つ
+        super().__init__(
+            command_prefix=config['bot']['prefix'],
+            tree_cls=InstrumentedCommandTree,
+            shard_ids=shard_ids,
+            shard_count=shard_count,
+            **cache_policy.client_options(),
+        )
+        self.cache_policy = cache_policy
+        self.cluster_id = cluster_id
+        self.health_queue = health_queue
+        self._health_task = None
         self.initial_extensions = [
             "cogs.ping",
             "cogs.settings",
             "cogs.interactive_ui",
             "cogs.tasks",
             "cogs.ai_commands", # AIコマンドCogを追加
+            "cogs.diagnostics",
         ]
 
-        # データベース接続情報を取得し、Databaseインスタンスを作成
-        db_config = config['database']
-        if db_config['type'] == "sqlite":
-            db_url = f"sqlite+aiosqlite:///{db_config['path']}"
-        elif db_config['type'] == "postgresql":
-            db_url = f"postgresql+asyncpg://{db_config['user']}:{db_config['password']}@{db_config['host']}:{db_config['port']}/{db_config['dbname']}"
-        else:
-            raise ValueError("Unsupported database type in config.yaml")
-        self.db = Database(db_url)
+        # 設定と翻訳はSETTINGSのスナップショットから読む(self.config は常に最新のもの)
+        self.settings = SETTINGS
+        self.settings.add_listener(self._on_settings_reloaded)
+
+        # データベース接続情報を取得し、Databaseインスタンスを作成(プールやPRAGMAの設定もconfig.yamlから)
+        self.db = Database.from_config(config['database'])
+
+        # ギルド設定の更新はまとめてから一括で書き込む
+        writer_config = config['database'].get('write_behind', {})
+        self.guild_writer = WriteBehindQueue(
+            self.db,
+            Guild,
+            key='guild_id',
+            max_batch=writer_config.get('max_batch', 500),
+            flush_interval=writer_config.get('flush_interval', 1.0),
+        )
+
+        # ギルド設定のキャッシュ。読み込みはDBを経由しない
+        cache_config = config.get('cache', {}).get('guild', {})
+        self.guild_cache = GuildConfigCache(
+            self.db,
+            default_prefix=config['bot']['prefix'],
+            max_size=cache_config.get('max_size', 10000),
+            ttl=cache_config.get('ttl', 0),
+            writer=self.guild_writer,
+        )
+
+        # コマンドのレート制限(rate_limited() チェックから bot.rate_limiter として参照される)
+        rate_limit_config = config.get('rate_limit', {})
+        self.rate_limiter = None
+        if rate_limit_config.get('enabled', True):
+            self.rate_limiter = RateLimiter(create_backend(rate_limit_config, self.db), rate_limit_config)
+
+        # ボタン・セレクトメニュー・モーダルのハンドラー。Cogが bot.components.add() で登録し、on_interaction で振り分ける
+        self.components = ComponentRouter()
+        self.components.on_expired = self._on_component_expired
+
+        # 定期ジョブ。Cogが bot.scheduler.register() で登録し、DBのリースで全プロセスを通して1回だけ実行される
+        scheduler_config = config.get('scheduler', {})
+        self.scheduler = JobScheduler(
+            self.db,
+            cluster_id=cluster_id,
+            ready=self.is_ready,
+            poll_interval=scheduler_config.get('poll_interval', 5.0),
+            lease_seconds=scheduler_config.get('lease_seconds', 60.0),
+            max_workers=scheduler_config.get('workers', 2),
+            job_config=scheduler_config.get('jobs', {}),
+        )
+
+        # オーナー専用の /profile コマンドから使う。計測していない間は何もしない
+        profiler_config = config.get('profiler', {})
+        self.profiler = Profiler(
+            max_seconds=profiler_config.get('max_seconds', 120),
+            sample_interval=profiler_config.get('sample_interval', 0.005),
+            memory_frames=profiler_config.get('memory_frames', 10),
+            top=profiler_config.get('top', 30),
+        )
+
+        metrics_config = config.get('metrics', {})
+        self.metrics_sampler = SystemMetricsSampler(
+            self,
+            interval=metrics_config.get('sample_interval', 5),
+            history=metrics_config.get('history', 720),
+        )
+        REGISTRY.register_collector(self.guild_cache.collect)
+        REGISTRY.register_collector(self.metrics_sampler.collect)
+        REGISTRY.register_collector(self.scheduler.collect)
+        REGISTRY.register_collector(self.collect_cache_sizes)
+
+        exporter_config = metrics_config.get('exporter', {})
+        self.metrics_exporter = None
+        if exporter_config.get('enabled', False):
+            self.metrics_exporter = MetricsExporter(
+                REGISTRY,
+                host=exporter_config.get('host', '127.0.0.1'),
+                # クラスタごとにポートをずらして同じホストで複数起動できるようにする
+                port=exporter_config.get('port', 9464) + (cluster_id or 0),
+            )
+
+    @property
+    def config(self):
+        return self.settings.config
+
+    def _on_settings_reloaded(self, old, new):
+        prefix = new.config['bot']['prefix']
+        if prefix != old.config['bot']['prefix']:
+            self.command_prefix = prefix
+            self.guild_cache.default_prefix = prefix
+            logger.info(f"Default prefix changed to {prefix}")
+        if self.rate_limiter and new.config.get('rate_limit') != old.config.get('rate_limit'):
+            self.rate_limiter.configure(new.config.get('rate_limit', {}))
+            logger.info("Rate limits reconfigured")
+        profiler_config = new.config.get('profiler', {})
+        if profiler_config != old.config.get('profiler', {}):
+            self.profiler.max_seconds = profiler_config.get('max_seconds', 120)
+            self.profiler.sample_interval = profiler_config.get('sample_interval', 0.005)
+            self.profiler.memory_frames = profiler_config.get('memory_frames', 10)
+            self.profiler.top = profiler_config.get('top', 30)
+        log_config = new.config.get('logging', {})
+        if log_config.get('sampling') != old.config.get('logging', {}).get('sampling'):
+            log_listener.sampling.rates = dict(log_config.get('sampling', {}))
+
+    async def get_prefix(self, message: discord.Message):
+        if message.guild is None:
+            return self.command_prefix
+        return await self.guild_cache.get_prefix(message.guild.id)
 
     async def setup_hook(self):
+        # ランチャーはワーカーをSIGTERMで止める。既定ではそのまま終了して close() が呼ばれず、
+        # write-behindのキューに残っている設定の変更が失われるため、Ctrl+Cと同じく bot.run() のタスクを止めて終了処理を行う
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, self._on_sigterm, asyncio.current_task())
+        except (NotImplementedError, RuntimeError):
+            pass # Windows、またはメインスレッド以外
+        await self.start_services()
+        await self.load_initial_extensions()
+        self.apply_cache_policy()
+        # コマンドの同期はグローバルなので、複数プロセス構成では最初のクラスタだけが行う
+        if self.cluster_id in (None, 0):
+            await self.sync_commands()
+        if self.health_queue is not None:
+            self._health_task = asyncio.create_task(self._report_health())
+        logger.info(f"Logged in as {self.user} (ID: {self.user.id})")
+        logger.info("------")
+
+    async def start_services(self):
         await self.db.init_db()
+        await self.guild_cache.warm()
+        self.guild_writer.start()
+        self.metrics_sampler.start()
+        # enabled: false のプロセスはジョブを登録だけして実行しない(実行するプロセスを限定する場合に使う)
+        if self.config.get('scheduler', {}).get('enabled', True):
+            self.scheduler.start()
+        if self.metrics_exporter:
+            await self.metrics_exporter.start()
+        # config.yaml と翻訳ファイルの変更を監視し、再起動せずに反映する
+        reload_config = self.config.get('reload', {})
+        if reload_config.get('enabled', True):
+            self.settings.poll_interval = reload_config.get('poll_interval', 2.0)
+            self.settings.start()
+
+    async def load_initial_extensions(self):
+        # コマンド名・説明の各ロケールの訳は同期時に翻訳ファイルから付ける
+        await self.tree.set_translator(CatalogTranslator(lambda: self.settings.translations))
         for extension in self.initial_extensions:
+            start = time.perf_counter()
             await self.load_extension(extension)
+            logger.info(f"Loaded {extension} in {(time.perf_counter() - start) * 1000:.1f}ms")
+
+    def apply_cache_policy(self):
+        # 読み込んだCogが宣言した cache_needs から必要最小限のIntentとキャッシュを決める(ゲートウェイへの接続前に呼ぶ)
+        needs = [cog.cache_needs for cog in self.cogs.values() if getattr(cog, 'cache_needs', None) is not None]
+        policy = CachePolicy.from_config(self.config.get('cache', {}).get('policy', {}), needs)
+        if policy != self.cache_policy:
+            policy.apply(self._connection)
+            self.cache_policy = policy
+        logger.info(f"Cache policy: {policy.describe()}")
+
+    async def add_cog(self, cog, /, **kwargs):
+        await super().add_cog(cog, **kwargs)
+        # 接続後に読み込まれたCogが、現在のIntentでは受け取れないイベントを必要とする場合
+        needs = getattr(cog, 'cache_needs', None)
+        if needs is not None and self.is_ready() and not self.cache_policy.satisfies(needs):
+            logger.warning(f"Cog {cog.qualified_name} needs {needs!r}, which the current gateway session does not provide; restart to apply it.")
+
+    def collect_cache_sizes(self):
+        report = cache_report(self)
+        yield 'folium_discord_cache_objects', 'gauge', 'Objects held in the discord.py state caches.', [({'cache': name}, count) for name, count, _ in report]
+        yield 'folium_discord_cache_bytes', 'gauge', 'Approximate bytes held in the discord.py state caches.', [({'cache': name}, size) for name, _, size in report]
+
+    async def command_tree_digest(self) -> str:
+        # 同期される内容(訳を含む全コマンドのペイロード)とアプリケーションIDからハッシュを作る
+        translator = self.tree.translator
+        commands = self.tree.get_commands()
+        if translator:
+            payload = [await command.get_translated_payload(self.tree, translator) for command in commands]
+        else:
+            payload = [command.to_dict(self.tree) for command in commands]
+        payload.sort(key=lambda command: (command.get('type', 1), command['name']),
+        )
+        data = json.dumps({'application_id': self.application_id, 'commands': payload}, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+    async def sync_commands(self, force: bool = False) -> bool:
+        # 前回同期したときのハッシュと同じならtree.sync()を省略する
+        startup_config = self.config.get('startup', {})
+        hash_path = startup_config.get('command_hash_path', 'data/command_tree.sha256')
+        digest = await self.command_tree_digest()
+        if not force and startup_config.get('skip_unchanged_sync', True):
+            try:
+                with open(hash_path, 'r', encoding='utf-8') as f:
+                    if f.read().strip() == digest:
+                        logger.info("Command tree unchanged since last sync; skipping tree.sync().")
+                        return False
+            except FileNotFoundError:
+                pass
+
         await self.tree.sync()
-        logger.info(f"Logged in as {self.user} (ID: {self.user.id})")
-        logger.info("------")
+        os.makedirs(os.path.dirname(hash_path) or '.', exist_ok=True)
+        # 書き込み途中で落ちても壊れたハッシュが残らないように置き換える
+        temp_path = f"{hash_path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(digest)
+        os.replace(temp_path, hash_path)
+        logger.info(f"Command tree synced (hash {digest[:12]}).")
+        return True
+
+    async def _report_health(self):
+        interval = self.config.get('cluster', {}).get('health_interval', 30)
+        while True:
+            report = {
+                'cluster_id': self.cluster_id,
+                'pid': os.getpid(),
+                'timestamp': time.time(),
+                'ready': self.is_ready(),
+                'guilds': len(self.guilds),
+                'shards': {shard_id: latency for shard_id, latency in self.latencies},
+            }
+            try:
+                self.health_queue.put_nowait(report)
+            except Exception as e:
+                logger.warning(f"Failed to report cluster health: {e}")
+            await asyncio.sleep(interval)
+
+    def _on_sigterm(self, task: asyncio.Task):
+        # 別のタスクで close() を呼ぶと、bot.run() が先に戻ってループを閉じ、書き出しの途中でキャンセルされる
+        # 実行中のタスクを止めれば async with bot の終了時に close() が最後まで実行される
+        logger.info("Received SIGTERM; shutting down.")
+        task.cancel()
+
+    async def close(self):
+        if self._health_task:
+            self._health_task.cancel()
+        await self.settings.stop()
+        self.settings.remove_listener(self._on_settings_reloaded)
+        await self.scheduler.stop()
+        await self.metrics_sampler.stop()
+        if self.metrics_exporter:
+            await self.metrics_exporter.stop()
+        await super().close()
+        # コマンドの受付が止まった後に、書き込み待ちの設定をすべてDBへ書き出す
+        try:
+            await self.guild_writer.close()
+            if self.rate_limiter:
+                await self.rate_limiter.close()
+        finally:
+            await self.db.close()
+
+    async def on_interaction(self, interaction: discord.Interaction):
+        try:
+            await self.components.dispatch(interaction)
+        except Exception:
+            # ハンドラーの例外はルーターが記録する
+            if not interaction.response.is_done():
+                await interaction.response.send_message(self.settings.catalog[interaction.locale]["error_unexpected"], ephemeral=True)
+
+    async def _on_component_expired(self, interaction: discord.Interaction):
+        await interaction.response.send_message(self.settings.catalog[interaction.locale]["error_component_expired"], ephemeral=True)
 
     async def on_ready(self):
         logger.info(f"Bot is ready. Latency: {self.latency * 1000:.2f}ms")
+        logger.info(f"Guild config cache stats: {self.guild_cache.stats.as_dict()}")
+        # ホストの大きさを決める目安として、キャッシュごとのオブジェクト数と推定サイズを記録する
+        logger.info(f"Cache footprint ({self.cache_policy.describe()}):\n{format_report(cache_report(self))}")
 
         @self.tree.error
         async def on_app_command_error(interaction: discord.Interaction, error: app_commands.AppCommandError):
             # エラーメッセージもローカライズ
-            locale = interaction.locale if interaction.locale in TRANSLATIONS else discord.Locale.english_us
-            messages = TRANSLATIONS.get(str(locale).replace('_', '-'), TRANSLATIONS['en-US'])
+            messages = self.settings.catalog[interaction.locale]
 
             if isinstance(error, app_commands.CommandNotFound):
                 await interaction.response.send_message(messages["error_command_not_found"], ephemeral=True)
@@ -152,16 +370,27 @@ class MyBot(commands.Bot):
             elif isinstance(error, app_commands.BotMissingPermissions):
                 await interaction.response.send_message(messages["error_bot_missing_permissions"], ephemeral=True)
             elif isinstance(error, app_commands.CommandOnCooldown):
-                await interaction.response.send_message(messages["error_command_on_cooldown"].format(retry_after=error.retry_after), ephemeral=True)
+                await interaction.response.send_message(messages.format("error_command_on_cooldown", retry_after=error.retry_after), ephemeral=True)
+            elif isinstance(error, NotOwner):
+                await interaction.response.send_message(messages["error_owner_only"], ephemeral=True)
             elif isinstance(error, app_commands.CheckFailure):
                 await interaction.response.send_message(messages["error_unexpected"], ephemeral=True) # CheckFailureは汎用エラーメッセージ
             else:
                 logger.error(f"予期せぬスラッシュコマンドエラーが発生しました: {error}")
                 await interaction.response.send_message(messages["error_unexpected"], ephemeral=True)
 
-if TOKEN is None:
-    logger.error("Error: DISCORD_BOT_TOKEN environment variable not set.")
-    logger.error("Please set the DISCORD_BOT_TOKEN environment variable before running the bot.")
-else:
-    bot = MyBot()
-    bot.run(TOKEN)
+def run_bot(**kwargs):
+    if TOKEN is None:
+        logger.error("Error: DISCORD_BOT_TOKEN environment variable not set.")
+        logger.error("Please set the DISCORD_BOT_TOKEN environment variable before running the bot.")
+        return
+    bot = MyBot(**kwargs)
+    # ログの出力先は setup_logging で設定済み。discord.py にstderrへのハンドラーを追加させない
+    try:
+        bot.run(TOKEN, log_handler=None)
+    except asyncio.CancelledError:
+        pass # SIGTERMで止めた場合。close() は済んでいる
+
+# 単一プロセスで起動する場合。複数プロセスで起動する場合は launcher.py を使う
+if __name__ == '__main__':
+    run_bot()
@@ -0,0 +1,157 @@
+import asyncio
+import logging
+import time
+
+from sqlalchemy import BigInteger, Column, Integer, MetaData, String, Table, inspect, select, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.schema import CreateColumn
+from sqlalchemy.sql.elements import TextClause
+
+from models import Base, SchemaMigration
+
+logger = logging.getLogger('discord')
+
+# PostgreSQLで同時に起動した複数のプロセスがマイグレーションを重複して実行しないためのアドバイザリロックのキー
+ADVISORY_LOCK_KEY = 0x666f6c69
+
+
+class Migration:
+    __slots__ = ('version', 'name', 'upgrade')
+
+    def __init__(self, version: int, name: str, upgrade):
+        self.version = version
+        self.name = name
+        self.upgrade = upgrade # upgrade(conn)。同期版のConnectionを受け取る
+
+    def __repr__(self):
+        return f"<Migration(version={self.version}, name='{self.name}')>"
+
+
+MIGRATIONS: list[Migration] = []
+
+
+def migration(version: int, name: str):
+    # マイグレーションを登録するデコレーター。バージョンは1から順に増やし、一度リリースしたものは書き換えない
+    def decorator(func):
+        if MIGRATIONS and version <= MIGRATIONS[-1].version:
+            raise ValueError(f"Migration {version} must be newer than {MIGRATIONS[-1].version}")
+        MIGRATIONS.append(Migration(version, name, func))
+        return func
+
+    return decorator
+
+
+def add_column(conn, table: str, column: Column, lock_timeout: float = 5.0) -> bool:
+    # 既存の行を書き換えずに列を追加する(SQLiteのADD COLUMN、PostgreSQL 11以降の定数DEFAULT付きADD COLUMNはどちらもメタデータの変更だけで済む)
+    # NOT NULLの列には定数の server_default が必要。now() のような関数のDEFAULTはテーブルの書き換えになるので使わない
+    # 例:
+    #   @migration(2, 'guild_locale')
+    #   def _guild_locale(conn):
+    #       add_column(conn, 'guilds', Column('locale', String(16), nullable=True))
+    # 列が既にあれば何もせずに False を返す
+    if column.name in {existing['name'] for existing in inspect(conn).get_columns(table)}:
+        return False
+    if column.primary_key or column.unique or column.index:
+        raise ValueError(f"Cannot add {table}.{column.name} online: primary keys, unique columns and indexes need a table rebuild")
+    default = column.server_default.arg if column.server_default is not None else None
+    if default is not None and not isinstance(default, (str, TextClause)):
+        raise ValueError(f"Cannot add {table}.{column.name} online: server_default must be a constant")
+    if not column.nullable and default is None:
+        raise ValueError(f"Cannot add {table}.{column.name} online: NOT NULL columns need a constant server_default")
+
+    preparer = conn.dialect.identifier_preparer
+    if conn.dialect.name == 'postgresql':
+        # ロックを待っている間は後続の読み込みもすべて待たされるため、取れなければ諦めて次の起動でやり直す
+        conn.execute(text(f"SET LOCAL lock_timeout = '{int(lock_timeout * 1000)}ms'"))
+    conn.execute(text(f"ALTER TABLE {preparer.quote(table)} ADD COLUMN {CreateColumn(column).compile(dialect=conn.dialect)}"))
+    if conn.dialect.name == 'postgresql':
+        conn.execute(text("SET LOCAL lock_timeout = DEFAULT"))
+    logger.info(f"Added column {table}.{column.name}")
+    return True
+
+
+@migration(1, 'guild_snowflake_primary_key')
+def _guild_snowflake_primary_key(conn):
+    # guilds(id INTEGER主キー, guild_id 文字列UNIQUE, prefix) を guilds(guild_id 64ビット整数主キー, prefix) に作り直す
+    # 主キーは変更できないので、新しいテーブルに写してから置き換える(データはそのまま残る)
+    if conn.dialect.name == 'postgresql':
+        invalid = conn.execute(text("SELECT COUNT(*) FROM guilds WHERE guild_id !~ '^[0-9]+$'")).scalar()
+    else:
+        invalid = conn.execute(text("SELECT COUNT(*) FROM guilds WHERE guild_id = '' OR guild_id GLOB '*[^0-9]*'")).scalar()
+    if invalid:
+        raise RuntimeError(f"{invalid} rows in guilds have a non-numeric guild_id; fix them before upgrading")
+
+    # この時点の構成を明示する(後でモデルを変えてもこのマイグレーションの結果は変わらない)
+    new_table = Table(
+        'guilds__new',
+        MetaData(),
+        Column('guild_id', BigInteger().with_variant(Integer, 'sqlite'), primary_key=True, autoincrement=False),
+        Column('prefix', String),
+    )
+    new_table.create(conn)
+    copied = conn.execute(text("INSERT INTO guilds__new (guild_id, prefix) SELECT CAST(guild_id AS BIGINT), prefix FROM guilds")).rowcount
+    conn.execute(text("DROP TABLE guilds"))
+    conn.execute(text("ALTER TABLE guilds__new RENAME TO guilds"))
+    if conn.dialect.name == 'postgresql':
+        conn.execute(text("ALTER TABLE guilds RENAME CONSTRAINT guilds__new_pkey TO guilds_pkey"))
+    logger.info(f"Rebuilt guilds with integer primary keys ({copied} rows)")
+
+
+def _lock(conn):
+    if conn.dialect.name == 'sqlite':
+        # 最初から書き込みロックを取る(後から来たプロセスはここで待ち、終わった後のバージョンを読む)
+        conn.exec_driver_sql("BEGIN IMMEDIATE")
+    elif conn.dialect.name == 'postgresql':
+        conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {'key': ADVISORY_LOCK_KEY})
+
+
+def _upgrade(conn) -> list[Migration]:
+    _lock(conn)
+    tables = set(inspect(conn).get_table_names())
+    head = MIGRATIONS[-1].version if MIGRATIONS else 0
+    if SchemaMigration.__tablename__ not in tables:
+        if 'guilds' not in tables:
+            # 新しいデータベース。最新の構成で作り、すべて適用済みとして記録する
+            Base.metadata.create_all(conn)
+            _stamp(conn, MIGRATIONS)
+            logger.info(f"Created database schema at version {head}.")
+            return []
+        # マイグレーションを導入する前のデータベース(バージョン0)
+        SchemaMigration.__table__.create(conn)
+
+    current = conn.execute(select(SchemaMigration.version).order_by(SchemaMigration.version.desc()).limit(1)).scalar() or 0
+    if current > head:
+        logger.warning(f"Database schema version {current} is newer than this build ({head}); skipping migrations.")
+    pending = [m for m in MIGRATIONS if m.version > current]
+    for m in pending:
+        start = time.perf_counter()
+        m.upgrade(conn)
+        _stamp(conn, [m])
+        logger.info(f"Applied migration {m.version} ({m.name}) in {time.perf_counter() - start:.2f}s")
+    # マイグレーションを必要としない新しいテーブルを作る
+    Base.metadata.create_all(conn)
+    return pending
+
+
+def _stamp(conn, migrations: list[Migration]):
+    now = time.time()
+    for m in migrations:
+        conn.execute(SchemaMigration.__table__.insert().values(version=m.version, name=m.name, applied_at=now))
+
+
+async def migrate(engine, lock_wait: float = 300.0) -> list[Migration]:
+    # 未適用のマイグレーションを1つのトランザクションで適用する。途中で失敗した場合は何も変更されない
+    # 複数のプロセスが同時に起動しても、ロックを取れた1つだけが適用し、残りは終わるのを待つ
+    deadline = time.monotonic() + lock_wait
+    while True:
+        try:
+            async with engine.connect() as conn:
+                applied = await conn.run_sync(_upgrade)
+                await conn.commit()
+            return applied
+        except OperationalError as e:
+            # SQLiteで、他のプロセスのマイグレーションが busy_timeout より長くかかっている場合
+            if 'database is locked' not in str(e) or time.monotonic() > deadline:
+                raise
+            logger.info("Waiting for another process to finish database migrations...")
+            await asyncio.sleep(1.0)
@@ -1,14 +1,102 @@
 from sqlalchemy.orm import declarative_base
-from sqlalchemy import Column, Integer, String
+from sqlalchemy import BigInteger, Column, Float, ForeignKey, Index, Integer, String, Text, UniqueConstraint
 
 Base = declarative_base()
 
+# 構成を変えるときは migrations.py にマイグレーションを追加する(列の追加は add_column を使う)
 class Guild(Base):
     __tablename__ = 'guilds'
 
-    id = Column(Integer, primary_key=True)
-    guild_id = Column(String, unique=True, nullable=False)
+    # DiscordのID(64ビット整数)をそのまま主キーにする
+    # SQLiteでは INTEGER PRIMARY KEY(rowidの別名)になり、主キーのための別のインデックスを持たない
+    guild_id = Column(BigInteger().with_variant(Integer, 'sqlite'), primary_key=True, autoincrement=False)
     prefix = Column(String, default="!")
 
     def __repr__(self):
-        return f"<Guild(guild_id='{self.guild_id}', prefix='{self.prefix}')>"
+        return f"<Guild(guild_id={self.guild_id}, prefix='{self.prefix}')>"
+
+# 適用済みのスキーママイグレーション(migrations.py)
+class SchemaMigration(Base):
+    __tablename__ = 'schema_migrations'
+
+    version = Column(Integer, primary_key=True, autoincrement=False)
+    name = Column(String(128), nullable=False)
+    applied_at = Column(Float, nullable=False) # UNIX時刻
+
+    def __repr__(self):
+        return f"<SchemaMigration(version={self.version}, name='{self.name}')>"
+
+class AIResponseCache(Base):
+    __tablename__ = 'ai_response_cache'
+
+    key = Column(String(64), primary_key=True) # 正規化したプロンプト・モデル名・ロケールのSHA-256
+    model = Column(String, nullable=False)
+    locale = Column(String, nullable=False)
+    response = Column(Text, nullable=False)
+    created_at = Column(Float, nullable=False, index=True) # UNIX時刻
+
+    def __repr__(self):
+        return f"<AIResponseCache(key='{self.key[:12]}', model='{self.model}', locale='{self.locale}')>"
+
+# /ask の会話。ユーザーとチャンネルの組ごとに1行(DMのチャンネルもチャンネルとして扱う)
+class Conversation(Base):
+    __tablename__ = 'conversations'
+    __table_args__ = (UniqueConstraint('user_id', 'channel_id'),)
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(BigInteger, nullable=False)
+    channel_id = Column(BigInteger, nullable=False)
+    summary = Column(Text, nullable=False, default="") # 要約済みのターンをまとめた文章
+    summary_tokens = Column(Integer, nullable=False, default=0)
+    summarized_through = Column(Integer, nullable=False, default=0) # このseqまでのターンは要約に含まれている
+    next_seq = Column(Integer, nullable=False, default=1)
+    updated_at = Column(Float, nullable=False, index=True) # UNIX時刻
+
+    def __repr__(self):
+        return f"<Conversation(user_id={self.user_id}, channel_id={self.channel_id}, next_seq={self.next_seq})>"
+
+class ConversationTurn(Base):
+    __tablename__ = 'conversation_turns'
+    __table_args__ = (Index('ix_conversation_turns_conversation_seq', 'conversation_id', 'seq', unique=True),)
+
+    id = Column(Integer, primary_key=True)
+    conversation_id = Column(Integer, ForeignKey('conversations.id', ondelete='CASCADE'), nullable=False)
+    seq = Column(Integer, nullable=False)
+    role = Column(String(8), nullable=False) # 'user' または 'model'
+    text = Column(Text, nullable=False)
+    tokens = Column(Integer, nullable=False)
+    created_at = Column(Float, nullable=False)
+
+    def __repr__(self):
+        return f"<ConversationTurn(conversation_id={self.conversation_id}, seq={self.seq}, role='{self.role}')>"
+
+# レート制限のトークンバケット(複数プロセスで共有する場合のみ使う)
+class RateLimitBucket(Base):
+    __tablename__ = 'rate_limit_buckets'
+
+    key = Column(String(128), primary_key=True) # 例: "user:1234"、"guild:5678"
+    tokens = Column(Float, nullable=False)
+    updated_at = Column(Float, nullable=False, index=True) # UNIX時刻
+
+    def __repr__(self):
+        return f"<RateLimitBucket(key='{self.key}', tokens={self.tokens:.2f})>"
+
+# 定期ジョブの状態。複数のプロセスで共有し、リースを取ったプロセスだけが実行する
+class ScheduledJob(Base):
+    __tablename__ = 'scheduled_jobs'
+
+    name = Column(String(128), primary_key=True) # クラスタごとのジョブは "名前@cluster番号"
+    schedule = Column(String(64), nullable=False) # 例: "every 60"、"cron */5 * * * *"
+    next_run_at = Column(Float, nullable=False, index=True) # 次の予定時刻(ジッターを含まないUNIX時刻)
+    lease_owner = Column(String(64), nullable=True)
+    lease_expires_at = Column(Float, nullable=True)
+    last_started_at = Column(Float, nullable=True)
+    last_finished_at = Column(Float, nullable=True)
+    last_duration = Column(Float, nullable=True)
+    last_status = Column(String(16), nullable=True) # 'ok'、'error'、'timeout'
+    last_error = Column(Text, nullable=True)
+    run_count = Column(Integer, nullable=False, default=0)
+    failure_count = Column(Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f"<ScheduledJob(name='{self.name}', schedule='{self.schedule}', next_run_at={self.next_run_at})>"
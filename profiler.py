@@ -0,0 +1,377 @@
+import asyncio
+import asyncio.events
+import cProfile
+import functools
+import gzip
+import io
+import logging
+import marshal
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter, deque
+
+import discord
+from discord import app_commands
+
+from instrumentation import REGISTRY
+
+logger = logging.getLogger('discord')
+
+CAPTURES_TOTAL = REGISTRY.counter('folium_profiler_captures_total', 'On-demand profiler captures by kind.', ('kind',))
+
+# slow_callbacks で記録する遅いコールバックの件数の上限
+SLOW_CALLBACK_HISTORY = 1000
+# コールバックの実行時間のヒストグラムの境界(秒)
+CALLBACK_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)
+
+
+class ProfilerBusy(Exception):
+    pass
+
+
+class NotOwner(app_commands.CheckFailure):
+    pass
+
+
+def owner_only():
+    # アプリコマンド用のチェック。Botのオーナー(チームの場合はメンバー)以外は NotOwner になる
+    async def predicate(interaction: discord.Interaction) -> bool:
+        if not await interaction.client.is_owner(interaction.user):
+            raise NotOwner()
+        return True
+
+    return app_commands.check(predicate)
+
+
+# 1回の計測結果。files はファイル名 -> 内容(圧縮前)
+class ProfileReport:
+    __slots__ = ('kind', 'summary', 'files', 'seconds')
+
+    def __init__(self, kind: str, summary: str, files: dict[str, bytes], seconds: float = 0.0):
+        self.kind = kind
+        self.summary = summary
+        self.files = files
+        self.seconds = seconds
+
+    def compressed(self) -> dict[str, bytes]:
+        return {f"{name}.gz": gzip.compress(data) for name, data in self.files.items()}
+
+
+@functools.lru_cache(maxsize=4096)
+def _short_path(filename: str) -> str:
+    # site-packages や標準ライブラリ、カレントディレクトリの部分を省く
+    for prefix in sorted({os.getcwd(), *sys.path}, key=len, reverse=True):
+        if prefix and filename.startswith(prefix + os.sep):
+            return filename[len(prefix) + 1:]
+    return filename
+
+
+def _await_chain(coro) -> list:
+    # タスクのコルーチンから、await している先をたどって中断中のフレームを集める(外側から順)
+    frames = []
+    while coro is not None:
+        frame = getattr(coro, 'cr_frame', None) or getattr(coro, 'gi_frame', None) or getattr(coro, 'ag_frame', None)
+        if frame is None:
+            break
+        frames.append(frame)
+        coro = getattr(coro, 'cr_await', None) or getattr(coro, 'gi_yieldfrom', None) or getattr(coro, 'ag_await', None)
+    return frames
+
+
+def _frame_location(frame) -> str:
+    return f"{frame.f_code.co_qualname} ({_short_path(frame.f_code.co_filename)}:{frame.f_lineno})"
+
+
+# イベントループのスレッドのスタックを一定間隔で取得するスレッド
+# 計測対象のスレッドには何も仕掛けないので、cProfileと違って計測中もほとんど遅くならない
+class _StackSampler(threading.Thread):
+    def __init__(self, thread_id: int, interval: float):
+        super().__init__(name='profiler-sampler', daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks: Counter[tuple] = Counter()
+        self.samples = 0
+        self._labels = {}
+        self._stop_event = threading.Event()
+
+    def _label(self, code) -> str:
+        label = self._labels.get(code)
+        if label is None:
+            label = f"{code.co_qualname} ({_short_path(code.co_filename)}:{code.co_firstlineno})"
+            self._labels[code] = label
+        return label
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(self._label(frame.f_code))
+                frame = frame.f_back
+            if stack:
+                self.stacks[tuple(reversed(stack))] += 1
+                self.samples += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+def _is_idle(stack: tuple) -> bool:
+    # 一番内側がセレクタの select なら、イベントループはイベントを待っている
+    return stack[-1].startswith(('EpollSelector.select', 'KqueueSelector.select', 'SelectSelector.select', 'DefaultSelector.select', 'IocpProactor._poll'))
+
+
+def _sampler_report(sampler: _StackSampler, seconds: float, top: int) -> ProfileReport:
+    # collapsed stack形式(flamegraph.pl や speedscope でそのまま開ける)
+    collapsed = '\n'.join(f"{';'.join(stack)} {count}" for stack, count in sampler.stacks.most_common())
+    own, total = Counter(), Counter()
+    idle = 0
+    for stack, count in sampler.stacks.items():
+        if _is_idle(stack):
+            idle += count
+            continue
+        own[stack[-1]] += count
+        for label in set(stack):
+            total[label] += count
+
+    samples = max(sampler.samples, 1)
+    busy = sampler.samples - idle
+    lines = [
+        f"{sampler.samples} samples in {seconds:.1f}s (every {sampler.interval * 1000:.1f}ms), loop busy {busy / samples:.1%}",
+        '',
+        'own time (excluding idle):',
+        *(f"{count / samples:>7.1%}  {label}" for label, count in own.most_common(top)),
+        '',
+        'total time (excluding idle):',
+        *(f"{count / samples:>7.1%}  {label}" for label, count in total.most_common(top)),
+    ]
+    text = '\n'.join(lines)
+    return ProfileReport('cpu', text, {'cpu.collapsed.txt': collapsed.encode(), 'cpu.txt': text.encode()}, seconds)
+
+
+def _cprofile_report(profile: cProfile.Profile, seconds: float, top: int) -> ProfileReport:
+    stream = io.StringIO()
+    stats = pstats.Stats(profile, stream=stream)
+    stats.strip_dirs().sort_stats('cumulative').print_stats(top)
+    text = stream.getvalue().strip()
+    profile.create_stats()
+    # .prof は pstats / snakeviz で開ける(Profile.dump_stats と同じ形式)
+    return ProfileReport('cpu', text, {'cpu.prof': marshal.dumps(profile.stats), 'cpu.txt': text.encode()}, seconds)
+
+
+def _memory_report(before, after, frames: int, top: int, seconds: float) -> ProfileReport:
+    filters = (
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        tracemalloc.Filter(False, '<unknown>'),
+    )
+    before = before.filter_traces(filters)
+    after = after.filter_traces(filters)
+    # 要約は確保した行ごと、添付ファイルには(frames > 1 なら)呼び出し元までのスタックごとの差分を載せる
+    diff = after.compare_to(before, 'lineno')
+    growth = sum(stat.size_diff for stat in diff)
+
+    def describe(stat) -> str:
+        frame = stat.traceback[-1]
+        return f"{stat.size_diff / 1024:>+10.1f} KiB {stat.count_diff:>+8} blocks  {_short_path(frame.filename)}:{frame.lineno}"
+
+    summary = '\n'.join([
+        f"{len(diff)} allocation sites, net {growth / 1024:+.1f} KiB in {seconds:.1f}s",
+        '',
+        *(describe(stat) for stat in diff[:top]),
+    ])
+    details = [summary, '']
+    if frames > 1:
+        details.append('by traceback:')
+        for stat in after.compare_to(before, 'traceback'):
+            details.append(describe(stat))
+            details.extend(f"    {line}" for line in stat.traceback.format(most_recent_first=True))
+    return ProfileReport('memory', summary, {'memory.txt': '\n'.join(details).encode()}, seconds)
+
+
+def _callback_name(handle) -> tuple[str, str]:
+    # (まとめる名前, その時点で中断している場所)。タスクのステップはコルーチン名でまとめる
+    callback = handle._callback
+    owner = getattr(callback, '__self__', None)
+    if isinstance(owner, asyncio.Task):
+        coro = owner.get_coro()
+        frames = _await_chain(coro)
+        where = _frame_location(frames[-1]) if frames else 'finished'
+        return f"Task {getattr(coro, '__qualname__', repr(coro))}", where
+    name = getattr(callback, '__qualname__', None) or repr(callback)
+    module = getattr(callback, '__module__', None)
+    return (f"{module}.{name}" if module else name), ''
+
+
+# 本番環境で遅くなったときに、再起動せずに調べるためのプロファイラ
+# 計測はすべて時間を区切って行い、計測していない間は何も仕掛けない(tracemallocも計測中だけ有効にする)
+# 同時に実行できる計測は1つだけで、計測しているのはこのプロセス(クラスタ)のイベントループだけ
+class Profiler:
+    def __init__(self, max_seconds: float = 120.0, sample_interval: float = 0.005, memory_frames: int = 10, top: int = 30):
+        self.max_seconds = max_seconds
+        self.sample_interval = sample_interval
+        self.memory_frames = memory_frames
+        self.top = top
+        self._lock = asyncio.Lock()
+        self.running: str | None = None
+
+    def _seconds(self, seconds: float) -> float:
+        return min(max(float(seconds), 0.1), self.max_seconds)
+
+    async def _capture(self, kind: str, capture):
+        if self._lock.locked():
+            raise ProfilerBusy(f"{self.running} capture is already running")
+        async with self._lock:
+            self.running = kind
+            start = time.perf_counter()
+            try:
+                report = await capture()
+            finally:
+                self.running = None
+            CAPTURES_TOTAL.inc(kind=kind)
+            logger.info(f"Profiler {kind} capture finished in {time.perf_counter() - start:.1f}s")
+            return report
+
+    async def cpu(self, seconds: float, mode: str = 'sample') -> ProfileReport:
+        # sample: スタックのサンプリング(負荷が小さい) / cprofile: 全関数呼び出しの計測(正確だが遅くなる)
+        seconds = self._seconds(seconds)
+        if mode not in ('sample', 'cprofile'):
+            raise ValueError(f"Unknown CPU profile mode: {mode}")
+
+        async def capture():
+            if mode == 'cprofile':
+                # cProfileは有効にしたスレッドだけを計測する。コルーチンはすべてこのスレッドで動く
+                profile = cProfile.Profile()
+                profile.enable()
+                try:
+                    await asyncio.sleep(seconds)
+                finally:
+                    profile.disable()
+                return await asyncio.to_thread(_cprofile_report, profile, seconds, self.top)
+
+            sampler = _StackSampler(threading.get_ident(), self.sample_interval)
+            sampler.start()
+            try:
+                await asyncio.sleep(seconds)
+            finally:
+                await asyncio.to_thread(sampler.stop)
+            return await asyncio.to_thread(_sampler_report, sampler, seconds, self.top)
+
+        return await self._capture('cpu', capture)
+
+    async def memory(self, seconds: float, frames: int | None = None) -> ProfileReport:
+        # 計測中に確保されて、終了時点でまだ解放されていないメモリを確保した場所ごとに集計する
+        seconds = self._seconds(seconds)
+        frames = frames or self.memory_frames
+
+        async def capture():
+            started = not tracemalloc.is_tracing()
+            if started:
+                tracemalloc.start(frames)
+            try:
+                before = tracemalloc.take_snapshot()
+                await asyncio.sleep(seconds)
+                after = tracemalloc.take_snapshot()
+            finally:
+                if started:
+                    tracemalloc.stop()
+            return await asyncio.to_thread(_memory_report, before, after, frames, self.top, seconds)
+
+        return await self._capture('memory', capture)
+
+    async def slow_callbacks(self, seconds: float, threshold: float = 0.1) -> ProfileReport:
+        # イベントループのコールバック(タスクの1ステップを含む)の実行時間を計測し、threshold 秒を超えたものを記録する
+        # asyncio のデバッグモードと違い、コールバックを作るたびにスタックを取らないので計測中の負荷が小さい
+        seconds = self._seconds(seconds)
+
+        async def capture():
+            loop = asyncio.get_running_loop()
+            slow = deque(maxlen=SLOW_CALLBACK_HISTORY)
+            histogram = [0] * (len(CALLBACK_BUCKETS) + 1)
+            totals = {'count': 0, 'seconds': 0.0}
+            original = asyncio.events.Handle._run
+
+            def timed_run(handle):
+                if handle._loop is not loop:
+                    return original(handle)
+                start = time.perf_counter()
+                try:
+                    return original(handle)
+                finally:
+                    elapsed = time.perf_counter() - start
+                    totals['count'] += 1
+                    totals['seconds'] += elapsed
+                    index = 0
+                    while index < len(CALLBACK_BUCKETS) and elapsed > CALLBACK_BUCKETS[index]:
+                        index += 1
+                    histogram[index] += 1
+                    if elapsed >= threshold:
+                        name, where = _callback_name(handle)
+                        slow.append((time.time(), elapsed, name, where))
+
+            asyncio.events.Handle._run = timed_run
+            try:
+                await asyncio.sleep(seconds)
+            finally:
+                asyncio.events.Handle._run = original
+            return _slow_callback_report(slow, histogram, totals, threshold, seconds, self.top)
+
+        return await self._capture('slow_callbacks', capture)
+
+    def tasks(self) -> ProfileReport:
+        # 実行中のタスクを、コルーチンと中断している場所ごとに数える(その場で取得するだけ)
+        loop = asyncio.get_running_loop()
+        groups: Counter[tuple[str, str]] = Counter()
+        chains = {}
+        for task in asyncio.all_tasks(loop):
+            coro = task.get_coro()
+            frames = _await_chain(coro)
+            key = (getattr(coro, '__qualname__', repr(coro)), _frame_location(frames[-1]) if frames else 'not started')
+            groups[key] += 1
+            chains.setdefault(key, frames)
+
+        ready = len(getattr(loop, '_ready', ()))
+        scheduled = len(getattr(loop, '_scheduled', ()))
+        header = f"{sum(groups.values())} tasks, {ready} ready callbacks, {scheduled} timers, {threading.active_count()} threads"
+        summary = '\n'.join([
+            header,
+            '',
+            *(f"{count:>6}  {name}  @ {where}" for (name, where), count in groups.most_common(self.top)),
+        ])
+        details = [header]
+        for (name, where), count in groups.most_common():
+            details.append('')
+            details.append(f"{count} x {name}")
+            details.extend(f"    {_frame_location(frame)}" for frame in chains[(name, where)])
+        CAPTURES_TOTAL.inc(kind='tasks')
+        return ProfileReport('tasks', summary, {'tasks.txt': '\n'.join(details).encode()})
+
+    def stats(self) -> dict:
+        return {'running': self.running, 'tracemalloc': tracemalloc.is_tracing()}
+
+
+def _slow_callback_report(slow, histogram, totals, threshold: float, seconds: float, top: int) -> ProfileReport:
+    by_name: dict[str, list] = {}
+    for _, elapsed, name, _ in slow:
+        entry = by_name.setdefault(name, [0, 0.0, 0.0])
+        entry[0] += 1
+        entry[1] += elapsed
+        entry[2] = max(entry[2], elapsed)
+    bounds = [f"<={bound * 1000:g}ms" for bound in CALLBACK_BUCKETS] + [f">{CALLBACK_BUCKETS[-1] * 1000:g}ms"]
+    summary = '\n'.join([
+        f"{totals['count']} callbacks in {seconds:.1f}s, loop busy {totals['seconds'] / seconds:.1%}, {len(slow)} took >= {threshold * 1000:g}ms",
+        '  '.join(f"{bound}: {count}" for bound, count in zip(bounds, histogram)),
+        '',
+        *(f"{count:>5} x  total {total * 1000:>8.1f}ms  max {worst * 1000:>7.1f}ms  {name}"
+          for name, (count, total, worst) in sorted(by_name.items(), key=lambda item: item[1][1], reverse=True)[:top]),
+    ])
+    timeline = '\n'.join(
+        f"{time.strftime('%H:%M:%S', time.localtime(at))}.{int(at % 1 * 1000):03d}  {elapsed * 1000:>8.1f}ms  {name}" + (f"  -> {where}" if where else '')
+        for at, elapsed, name, where in slow
+    )
+    return ProfileReport('slow_callbacks', summary, {'slow-callbacks.txt': (summary + '\n\n' + timeline).encode()}, seconds)
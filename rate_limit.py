@@ -0,0 +1,250 @@
+import logging
+import time
+
+from discord import app_commands
+from sqlalchemy import delete, select, text
+from sqlalchemy.dialects import postgresql, sqlite
+
+from instrumentation import REGISTRY
+from models import RateLimitBucket
+
+logger = logging.getLogger('discord')
+
+DECISIONS = REGISTRY.counter('folium_rate_limit_total', 'Rate limit decisions by command and result.', ('command', 'result'))
+
+
+class BucketSpec:
+    __slots__ = ('capacity', 'per')
+
+    def __init__(self, capacity: float, per: float):
+        # per 秒で capacity トークンまで回復する
+        self.capacity = float(capacity)
+        self.per = float(per)
+
+    @property
+    def rate(self) -> float:
+        return self.capacity / self.per
+
+    def __repr__(self):
+        return f"<BucketSpec(capacity={self.capacity}, per={self.per})>"
+
+
+def refill(tokens: float, updated_at: float, now: float, spec: BucketSpec) -> float:
+    return min(spec.capacity, tokens + max(0.0, now - updated_at) * spec.rate)
+
+
+def decide(current: list[float], specs: list[BucketSpec], cost: float) -> tuple[float, BucketSpec | None]:
+    # すべてのバケットから cost を引けるなら (0, None)、引けないなら最も長い待ち時間とそのバケットを返す
+    retry_after, limiting = 0.0, None
+    for tokens, spec in zip(current, specs):
+        if tokens < cost:
+            wait = (cost - tokens) / spec.rate
+            if wait > retry_after:
+                retry_after, limiting = wait, spec
+    return retry_after, limiting
+
+
+# プロセス内だけで数える(既定)
+class MemoryBackend:
+    def __init__(self, sweep_every: int = 10000):
+        self._buckets: dict[str, tuple[float, float]] = {}
+        self._sweep_every = sweep_every
+        self._operations = 0
+        self._longest_refill = 0.0
+
+    async def acquire(self, keys: list[str], specs: list[BucketSpec], cost: float, now: float) -> tuple[float, BucketSpec | None]:
+        current = []
+        for key, spec in zip(keys, specs):
+            stored = self._buckets.get(key)
+            current.append(spec.capacity if stored is None else refill(stored[0], stored[1], now, spec))
+        retry_after, limiting = decide(current, specs, cost)
+        if limiting is None:
+            for key, tokens in zip(keys, current):
+                self._buckets[key] = (tokens - cost, now)
+        self._longest_refill = max(self._longest_refill, *(spec.per for spec in specs))
+        self._operations += 1
+        if self._operations >= self._sweep_every:
+            self._operations = 0
+            self._sweep(now)
+        return retry_after, limiting
+
+    def _sweep(self, now: float):
+        # 満タンまで回復したバケットは持っていなくても同じなので捨てる
+        cutoff = now - self._longest_refill
+        for key in [key for key, (_, updated_at) in self._buckets.items() if updated_at < cutoff]:
+            del self._buckets[key]
+
+    async def close(self):
+        pass
+
+
+# Database(SQLite/PostgreSQL)のテーブルで共有する。複数のシャードプロセスで同じ制限がかかる
+class DatabaseBackend:
+    def __init__(self, db, purge_every: int = 5000):
+        self.db = db
+        self._purge_every = purge_every
+        self._operations = 0
+        self._longest_refill = 0.0
+
+    async def acquire(self, keys: list[str], specs: list[BucketSpec], cost: float, now: float) -> tuple[float, BucketSpec | None]:
+        async with self.db.get_session() as session:
+            if self.db.is_sqlite:
+                # 最初に書き込みロックを取り、読み込みから書き込みまでを他のプロセスと直列にする
+                await session.execute(text("UPDATE rate_limit_buckets SET tokens = tokens WHERE 0"))
+            query = select(RateLimitBucket).where(RateLimitBucket.key.in_(keys))
+            if not self.db.is_sqlite:
+                query = query.with_for_update()
+            rows = {row.key: row for row in (await session.execute(query)).scalars()}
+
+            current = []
+            for key, spec in zip(keys, specs):
+                row = rows.get(key)
+                current.append(spec.capacity if row is None else refill(row.tokens, row.updated_at, now, spec))
+            retry_after, limiting = decide(current, specs, cost)
+            if limiting is None:
+                dialect_insert = sqlite.insert if self.db.is_sqlite else postgresql.insert
+                stmt = dialect_insert(RateLimitBucket).values([
+                    {'key': key, 'tokens': tokens - cost, 'updated_at': now} for key, tokens in zip(keys, current)
+                ])
+                stmt = stmt.on_conflict_do_update(index_elements=['key'], set_={'tokens': stmt.excluded.tokens, 'updated_at': stmt.excluded.updated_at})
+                await session.execute(stmt)
+            await session.commit()
+
+        self._longest_refill = max(self._longest_refill, *(spec.per for spec in specs))
+        self._operations += 1
+        if self._operations >= self._purge_every:
+            self._operations = 0
+            await self.purge(now)
+        return retry_after, limiting
+
+    async def purge(self, now: float):
+        async with self.db.get_session() as session:
+            await session.execute(delete(RateLimitBucket).where(RateLimitBucket.updated_at < now - self._longest_refill))
+            await session.commit()
+
+    async def close(self):
+        pass
+
+
+# 複数のバケットをまとめて判定・消費するLuaスクリプト(Redis上でアトミックに実行される)
+# KEYS: バケットのキー / ARGV: now, cost, (rate, capacity) × キーの数
+_REDIS_SCRIPT = """
+local now = tonumber(ARGV[1])
+local cost = tonumber(ARGV[2])
+local wait, limiting = 0, 0
+local current = {}
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[1 + i * 2])
+    local capacity = tonumber(ARGV[2 + i * 2])
+    local data = redis.call('HMGET', key, 'tokens', 'ts')
+    local tokens = tonumber(data[1]) or capacity
+    local ts = tonumber(data[2]) or now
+    tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+    current[i] = tokens
+    if tokens < cost and (cost - tokens) / rate > wait then
+        wait = (cost - tokens) / rate
+        limiting = i
+    end
+end
+if limiting > 0 then
+    return {tostring(wait), limiting}
+end
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[1 + i * 2])
+    local capacity = tonumber(ARGV[2 + i * 2])
+    redis.call('HSET', key, 'tokens', tostring(current[i] - cost), 'ts', tostring(now))
+    redis.call('PEXPIRE', key, math.ceil(capacity / rate * 1000))
+end
+return {'0', 0}
+"""
+
+
+# Redisで共有する。redisパッケージ(redis.asyncio)が必要
+class RedisBackend:
+    def __init__(self, url: str, prefix: str = 'folium:ratelimit:'):
+        try:
+            import redis.asyncio as redis
+        except ImportError as e:
+            raise RuntimeError("rate_limit.backend 'redis' requires the 'redis' package") from e
+        self.prefix = prefix
+        self._client = redis.from_url(url)
+        self._script = self._client.register_script(_REDIS_SCRIPT)
+
+    async def acquire(self, keys: list[str], specs: list[BucketSpec], cost: float, now: float) -> tuple[float, BucketSpec | None]:
+        args = [now, cost]
+        for spec in specs:
+            args.extend((spec.rate, spec.capacity))
+        wait, limiting = await self._script(keys=[self.prefix + key for key in keys], args=args)
+        if int(limiting) == 0:
+            return 0.0, None
+        return float(wait), specs[int(limiting) - 1]
+
+    async def close(self):
+        await self._client.aclose()
+
+
+def create_backend(config, db=None):
+    backend = config.get('backend', 'memory')
+    if backend == 'memory':
+        return MemoryBackend()
+    if backend == 'database':
+        return DatabaseBackend(db)
+    if backend == 'redis':
+        return RedisBackend(config.get('redis_url', 'redis://localhost:6379/0'))
+    raise ValueError(f"Unsupported rate_limit.backend: {backend}")
+
+
+# ユーザーごと・ギルドごとのトークンバケットでコマンドの実行回数を制限する
+# コマンドごとの消費量は costs で指定し、指定のないコマンドは制限しない
+class RateLimiter:
+    def __init__(self, backend, config):
+        self.backend = backend
+        self.configure(config)
+
+    def configure(self, config):
+        # 設定の再読み込み時にも呼ばれる(バックエンドの変更は再起動が必要)
+        buckets = config.get('buckets', {})
+        self.specs = {scope: BucketSpec(spec['capacity'], spec['per']) for scope, spec in buckets.items()}
+        self.costs = dict(config.get('costs', {}))
+        for command, cost in self.costs.items():
+            for scope, spec in self.specs.items():
+                if cost > spec.capacity:
+                    logger.warning(f"Rate limit cost {cost} for '{command}' exceeds the {scope} bucket capacity {spec.capacity}; it can never run.")
+
+    async def hit(self, command: str, user_id: int, guild_id: int | None) -> tuple[float, BucketSpec | None]:
+        cost = self.costs.get(command, 0)
+        if cost <= 0:
+            return 0.0, None
+        keys, specs = [], []
+        for scope, subject in (('user', user_id), ('guild', guild_id)):
+            spec = self.specs.get(scope)
+            if spec is not None and subject is not None:
+                keys.append(f"{scope}:{subject}")
+                specs.append(spec)
+        if not keys:
+            return 0.0, None
+        try:
+            retry_after, limiting = await self.backend.acquire(keys, specs, cost, time.time())
+        except Exception as e:
+            # 共有バックエンドが使えないときは制限せずに通す
+            logger.warning(f"Rate limit backend failed; allowing '{command}': {e}")
+            return 0.0, None
+        DECISIONS.inc(command=command, result='limited' if limiting else 'allowed')
+        return retry_after, limiting
+
+    async def close(self):
+        await self.backend.close()
+
+
+def rate_limited():
+    # アプリコマンドのチェック。制限にかかった場合は CommandOnCooldown を送出する
+    async def predicate(interaction) -> bool:
+        limiter = getattr(interaction.client, 'rate_limiter', None)
+        if limiter is None or interaction.command is None:
+            return True
+        retry_after, limiting = await limiter.hit(interaction.command.qualified_name, interaction.user.id, interaction.guild_id)
+        if limiting is not None:
+            raise app_commands.CommandOnCooldown(app_commands.Cooldown(limiting.capacity, limiting.per), retry_after)
+        return True
+
+    return app_commands.check(predicate)
@@ -0,0 +1,164 @@
+import asyncio
+import hashlib
+import logging
+import re
+import time
+import unicodedata
+from collections import OrderedDict
+
+from sqlalchemy import delete, func, select
+
+from models import AIResponseCache
+
+logger = logging.getLogger('discord')
+
+_WHITESPACE = re.compile(r'\s+')
+_TRAILING_PUNCTUATION = '?？!！.。、,，…~〜 '
+
+
+def normalize_prompt(prompt: str) -> str:
+    # 全角/半角・大文字/小文字・空白の違いや末尾の記号だけが異なる質問を同じものとして扱う
+    text = unicodedata.normalize('NFKC', prompt).casefold()
+    text = _WHITESPACE.sub(' ', text).strip()
+    return text.rstrip(_TRAILING_PUNCTUATION)
+
+
+def cache_key(prompt: str, model: str, locale: str) -> str:
+    payload = '\x1f'.join((model, locale, normalize_prompt(prompt)))
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class ResponseCacheStats:
+    __slots__ = ('memory_hits', 'persistent_hits', 'misses', 'evictions')
+
+    def __init__(self):
+        self.memory_hits = 0
+        self.persistent_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+# /ask の応答キャッシュ
+# メモリ上のLRU(件数・バイト数で上限)と、任意でDatabase上の永続層を持つ
+class ResponseCache:
+    def __init__(
+        self,
+        db=None,
+        max_entries: int = 1024,
+        max_bytes: int = 8 * 1024 * 1024,
+        ttl: float = 86400,
+        persistent_max_rows: int = 100000,
+        purge_every: int = 100,
+    ):
+        self.db = db
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.persistent_max_rows = persistent_max_rows
+        self.purge_every = purge_every
+        self.stats = ResponseCacheStats()
+
+        # key -> (応答テキスト, 格納時刻(UNIX時刻), サイズ)
+        self._memory: OrderedDict[str, tuple[str, float, int]] = OrderedDict()
+        self._memory_bytes = 0
+        self._writes_since_purge = 0
+        self._background: set[asyncio.Task] = set()
+
+    def _expired(self, stored_at: float) -> bool:
+        return self.ttl > 0 and time.time() - stored_at > self.ttl
+
+    def _remember(self, key: str, response: str, stored_at: float):
+        size = len(response.encode('utf-8'))
+        if size > self.max_bytes:
+            return
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._memory_bytes -= old[2]
+        self._memory[key] = (response, stored_at, size)
+        self._memory_bytes += size
+        while len(self._memory) > self.max_entries or self._memory_bytes > self.max_bytes:
+            _, (_, _, evicted_size) = self._memory.popitem(last=False)
+            self._memory_bytes -= evicted_size
+            self.stats.evictions += 1
+
+    def get_memory(self, key: str) -> str | None:
+        entry = self._memory.get(key)
+        if entry is None:
+            return None
+        response, stored_at, size = entry
+        if self._expired(stored_at):
+            del self._memory[key]
+            self._memory_bytes -= size
+            return None
+        self._memory.move_to_end(key)
+        self.stats.memory_hits += 1
+        return response
+
+    async def get(self, key: str) -> str | None:
+        response = self.get_memory(key)
+        if response is not None:
+            return response
+
+        if self.db is not None:
+            try:
+                async with self.db.read_session() as session:
+                    row = await session.get(AIResponseCache, key)
+            except Exception as e:
+                # 永続層が読めなくても、キャッシュなしで答えればよい
+                logger.warning(f"Failed to read AI response cache entry: {e}")
+                row = None
+            if row is not None and not self._expired(row.created_at):
+                self.stats.persistent_hits += 1
+                self._remember(key, row.response, row.created_at)
+                return row.response
+
+        self.stats.misses += 1
+        return None
+
+    def put(self, key: str, response: str, model: str, locale: str):
+        now = time.time()
+        self._remember(key, response, now)
+        if self.db is not None:
+            # 永続層への書き込みは応答を返した後にバックグラウンドで行う
+            task = asyncio.create_task(self._persist(key, response, model, locale, now))
+            self._background.add(task)
+            task.add_done_callback(self._background.discard)
+
+    async def _persist(self, key: str, response: str, model: str, locale: str, created_at: float):
+        try:
+            async with self.db.get_session() as session:
+                await session.merge(AIResponseCache(key=key, model=model, locale=locale, response=response, created_at=created_at))
+                await session.commit()
+            self._writes_since_purge += 1
+            if self._writes_since_purge >= self.purge_every:
+                self._writes_since_purge = 0
+                await self.purge()
+        except Exception as e:
+            logger.warning(f"Failed to persist AI response cache entry: {e}")
+
+    async def purge(self):
+        if self.db is None:
+            return
+        async with self.db.get_session() as session:
+            if self.ttl > 0:
+                await session.execute(delete(AIResponseCache).where(AIResponseCache.created_at < time.time() - self.ttl))
+            count = (await session.execute(select(func.count()).select_from(AIResponseCache))).scalar_one()
+            excess = count - self.persistent_max_rows
+            if excess > 0:
+                oldest = select(AIResponseCache.key).order_by(AIResponseCache.created_at).limit(excess)
+                await session.execute(delete(AIResponseCache).where(AIResponseCache.key.in_(oldest.scalar_subquery())))
+            await session.commit()
+
+    async def close(self):
+        if self._background:
+            await asyncio.gather(*self._background, return_exceptions=True)
+
+    def collect(self):
+        labels = {'cache': 'ai_response'}
+        yield 'folium_response_cache_hits_total', 'counter', 'AI response cache hits by tier.', [
+            ({**labels, 'tier': 'memory'}, self.stats.memory_hits),
+            ({**labels, 'tier': 'persistent'}, self.stats.persistent_hits),
+        ]
+        yield 'folium_response_cache_misses_total', 'counter', 'AI response cache misses.', [(labels, self.stats.misses)]
+        yield 'folium_response_cache_evictions_total', 'counter', 'AI response cache memory evictions.', [(labels, self.stats.evictions)]
+        yield 'folium_response_cache_bytes', 'gauge', 'Bytes held by the in-memory AI response cache.', [(labels, self._memory_bytes)]
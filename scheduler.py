@@ -0,0 +1,473 @@
+import asyncio
+import hashlib
+import logging
+import multiprocessing
+import os
+import socket
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import or_, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+
+from instrumentation import DEFAULT_BUCKETS, REGISTRY
+from models import ScheduledJob
+
+logger = logging.getLogger('discord')
+
+JOB_SECONDS = REGISTRY.histogram('folium_job_duration_seconds', 'Scheduled job run time.', ('job',), buckets=DEFAULT_BUCKETS + (120.0, 300.0, 600.0))
+JOB_LAG = REGISTRY.histogram('folium_job_start_lag_seconds', 'Delay between a job becoming due and starting.', ('job',))
+JOB_RUNS = REGISTRY.counter('folium_job_runs_total', 'Scheduled job runs by result.', ('job', 'status'))
+
+CATCH_UP_POLICIES = ('all', 'once', 'skip')
+
+
+# 一定間隔のスケジュール。UNIX時刻0からの倍数に揃えるので、どのプロセスが計算しても同じ時刻になる
+class IntervalSpec:
+    __slots__ = ('seconds',)
+
+    def __init__(self, seconds: float):
+        if seconds <= 0:
+            raise ValueError(f"Job interval must be positive: {seconds}")
+        self.seconds = float(seconds)
+
+    def next_after(self, ts: float) -> float:
+        return (ts // self.seconds + 1) * self.seconds
+
+    def __str__(self):
+        return f"every {self.seconds:g}"
+
+
+_CRON_FIELDS = (('minute', 0, 59), ('hour', 0, 23), ('day', 1, 31), ('month', 1, 12), ('weekday', 0, 7))
+
+
+def _parse_cron_field(text: str, low: int, high: int) -> frozenset[int]:
+    values = set()
+    for part in text.split(','):
+        step = 1
+        if '/' in part:
+            part, step_text = part.split('/', 1)
+            step = int(step_text)
+        if part == '*':
+            start, end = low, high
+        elif '-' in part:
+            start, end = (int(value) for value in part.split('-', 1))
+        else:
+            start = int(part)
+            end = high if step != 1 else start
+        if step < 1 or start < low or end > high or start > end:
+            raise ValueError(f"Invalid cron field '{text}' (allowed {low}-{high})")
+        values.update(range(start, end + 1, step))
+    return frozenset(values)
+
+
+# 5項目(分 時 日 月 曜日)のcron式。時刻はUTCで解釈する
+# 日と曜日の両方を指定した場合は、一般的なcronと同じくどちらかに一致すれば実行する
+class CronSpec:
+    __slots__ = ('expression', 'minutes', 'hours', 'days', 'months', 'weekdays', 'day_or_weekday')
+
+    def __init__(self, expression: str):
+        fields = expression.split()
+        if len(fields) != len(_CRON_FIELDS):
+            raise ValueError(f"Cron expression must have 5 fields: '{expression}'")
+        self.expression = ' '.join(fields)
+        parsed = [_parse_cron_field(text, low, high) for text, (_, low, high) in zip(fields, _CRON_FIELDS)]
+        self.minutes, self.hours, self.days, self.months, weekdays = parsed
+        self.weekdays = frozenset(day % 7 for day in weekdays) # 7も日曜日として扱う
+        self.day_or_weekday = fields[2] != '*' and fields[4] != '*'
+        # 2月31日のように一度も来ない式は登録時に弾く
+        self.next_after(0)
+
+    def _day_matches(self, dt: datetime) -> bool:
+        day = dt.day in self.days
+        weekday = (dt.weekday() + 1) % 7 in self.weekdays # cronでは日曜日が0
+        return (day or weekday) if self.day_or_weekday else (day and weekday)
+
+    def next_after(self, ts: float) -> float:
+        dt = datetime.fromtimestamp(ts, timezone.utc).replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = dt.year + 5
+        # 合わない単位(月・日・時・分)ごとに読み飛ばす
+        while dt.year <= limit:
+            if dt.month not in self.months:
+                dt = (dt.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(dt):
+                dt = (dt + timedelta(days=1)).replace(hour=0, minute=0)
+            elif dt.hour not in self.hours:
+                dt = (dt + timedelta(hours=1)).replace(minute=0)
+            elif dt.minute not in self.minutes:
+                dt += timedelta(minutes=1)
+            else:
+                return dt.timestamp()
+        raise ValueError(f"Cron expression never matches: '{self.expression}'")
+
+    def __str__(self):
+        return f"cron {self.expression}"
+
+
+def jitter_offset(key: str, scheduled: float, jitter: float) -> float:
+    # ジョブ名と予定時刻から決まる 0〜jitter 秒の遅延。全プロセスで同じ値になる
+    if jitter <= 0:
+        return 0.0
+    digest = hashlib.blake2b(f"{key}:{scheduled!r}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') / 2 ** 64 * jitter
+
+
+class Job:
+    __slots__ = ('name', 'key', 'func', 'spec', 'jitter', 'catch_up', 'max_catch_up', 'cpu_bound', 'needs_ready', 'timeout', 'synced', 'last_status', 'last_duration', 'last_success_at')
+
+    def __init__(self, name, key, func, spec, jitter, catch_up, max_catch_up, cpu_bound, needs_ready, timeout):
+        self.name = name
+        self.key = key
+        self.func = func
+        self.spec = spec
+        self.jitter = jitter
+        self.catch_up = catch_up
+        self.max_catch_up = max_catch_up
+        self.cpu_bound = cpu_bound
+        self.needs_ready = needs_ready
+        self.timeout = timeout
+        self.synced = False
+        # このプロセスで最後に実行したときの結果(全プロセス分は stats() でDBから読む)
+        self.last_status: str | None = None
+        self.last_duration: float | None = None
+        self.last_success_at: float | None = None
+
+    def __repr__(self):
+        return f"<Job(key='{self.key}', spec='{self.spec}')>"
+
+
+# Databaseに状態を置く定期ジョブのスケジューラー
+# - 予定時刻を過ぎたジョブは、リース(scheduled_jobs の lease_owner)を取れた1プロセスだけが実行する
+# - 実行が終わると次回の予定を書き込んでリースを外す。実行中のプロセスが落ちた場合はリースの期限切れ後に他のプロセスが引き継ぐ
+# - 停止していた間に過ぎた予定は catch_up で扱いを決める
+#   'all': 過ぎた回数だけ実行する(1回の起動につき max_catch_up 回まで) / 'once': 1回だけ実行する / 'skip': 実行せずに次の予定へ進める
+# ジョブの関数は予定時刻(UNIX時刻)を1つ受け取る。cpu_bound のジョブはプロセスプールで実行するので、モジュールレベルの関数にする
+class JobScheduler:
+    def __init__(
+        self,
+        db,
+        cluster_id: int | None = None,
+        ready=None,
+        poll_interval: float = 5.0,
+        lease_seconds: float = 60.0,
+        max_workers: int = 2,
+        job_config=None,
+    ):
+        self.db = db
+        self.cluster_id = cluster_id
+        self.ready = ready or (lambda: True)
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self.max_workers = max_workers
+        self.job_config = job_config or {}
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"[:64]
+        self.jobs: dict[str, Job] = {}
+        self._running: dict[str, asyncio.Task] = {}
+        self._executor: ProcessPoolExecutor | None = None
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    def register(
+        self,
+        name: str,
+        func,
+        every: float | None = None,
+        cron: str | None = None,
+        jitter: float = 0.0,
+        catch_up: str = 'once',
+        max_catch_up: int = 10,
+        cpu_bound: bool = False,
+        per_cluster: bool = False,
+        needs_ready: bool = False,
+        timeout: float | None = None,
+    ) -> Job | None:
+        # config.yaml の scheduler.jobs.<name> がコード側の既定値より優先される
+        overrides = self.job_config.get(name, {})
+        if not overrides.get('enabled', True):
+            logger.info(f"Scheduled job '{name}' is disabled in config.")
+            return None
+        if 'every' in overrides or 'cron' in overrides:
+            every, cron = overrides.get('every'), overrides.get('cron')
+        jitter = overrides.get('jitter', jitter)
+        catch_up = overrides.get('catch_up', catch_up)
+        max_catch_up = overrides.get('max_catch_up', max_catch_up)
+        timeout = overrides.get('timeout', timeout)
+
+        if (every is None) == (cron is None):
+            raise ValueError(f"Scheduled job '{name}' needs exactly one of every or cron")
+        if catch_up not in CATCH_UP_POLICIES:
+            raise ValueError(f"Unknown catch_up policy for '{name}': {catch_up}")
+        spec = IntervalSpec(every) if every is not None else CronSpec(cron)
+        # per_cluster のジョブはクラスタごとに1回ずつ実行する(例: そのクラスタのシャードのギルドだけを対象にする処理)
+        key = f"{name}@cluster{self.cluster_id}" if per_cluster and self.cluster_id is not None else name
+        if key in self.jobs:
+            raise ValueError(f"Scheduled job '{key}' is already registered")
+
+        job = Job(name, key, func, spec, jitter, catch_up, max_catch_up, cpu_bound, needs_ready, timeout)
+        self.jobs[key] = job
+        self._wakeup.set()
+        return job
+
+    def unregister(self, job: Job):
+        # 実行中ならキャンセルし、予定は変えずにリースだけ外す
+        self.jobs.pop(job.key, None)
+        task = self._running.get(job.key)
+        if task is not None:
+            task.cancel()
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(), name='job-scheduler')
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        running = list(self._running.values())
+        for task in running:
+            task.cancel()
+        if running:
+            await asyncio.gather(*running, return_exceptions=True)
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        # 最初に cpu_bound のジョブが実行されるまでワーカーは起動しない
+        # 他のスレッドが動いている状態でforkすると子プロセスがロックを持ったまま固まることがあるため、spawnで起動する
+        # (cpu_bound のジョブの関数はモジュールの最上位に定義し、子プロセスから import できるようにする)
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context('spawn'))
+        return self._executor
+
+    async def _run(self):
+        while True:
+            try:
+                delay = await self._tick()
+            except Exception as e:
+                logger.error(f"Job scheduler tick failed: {e}")
+                delay = self.poll_interval
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _tick(self) -> float:
+        # 期限の来たジョブを起動し、次に確認するまでの秒数を返す
+        await self._sync_rows()
+        if not self.jobs:
+            return self.poll_interval
+        async with self.db.read_session() as session:
+            rows = (await session.execute(
+                select(ScheduledJob.name, ScheduledJob.next_run_at, ScheduledJob.lease_owner, ScheduledJob.lease_expires_at)
+                .where(ScheduledJob.name.in_(list(self.jobs)))
+            )).all()
+
+        now = time.time()
+        delay = self.poll_interval
+        for row in rows:
+            job = self.jobs.get(row.name)
+            if job is None or job.key in self._running:
+                continue
+            due = row.next_run_at + jitter_offset(job.key, row.next_run_at, job.jitter)
+            if due > now:
+                delay = min(delay, due - now)
+                continue
+            if row.lease_owner is not None and row.lease_expires_at > now:
+                continue
+            if job.needs_ready and not self.ready():
+                continue
+            if await self._claim(job, row.next_run_at, now):
+                task = asyncio.create_task(self._execute(job, row.next_run_at, due), name=f'job-{job.key}')
+                self._running[job.key] = task
+                task.add_done_callback(lambda _, key=job.key: self._running.pop(key, None))
+        return max(delay, 0.05)
+
+    async def _sync_rows(self):
+        # 新しく登録されたジョブの行を作る。スケジュールが変わっていれば次回の予定を計算し直す
+        pending = [job for job in self.jobs.values() if not job.synced]
+        if not pending:
+            return
+        now = time.time()
+        dialect_insert = sqlite.insert if self.db.is_sqlite else postgresql.insert
+        async with self.db.get_session() as session:
+            stmt = dialect_insert(ScheduledJob).values([
+                {'name': job.key, 'schedule': str(job.spec), 'next_run_at': job.spec.next_after(now), 'run_count': 0, 'failure_count': 0}
+                for job in pending
+            ])
+            await session.execute(stmt.on_conflict_do_nothing(index_elements=['name']))
+            for job in pending:
+                await session.execute(
+                    update(ScheduledJob)
+                    .where(ScheduledJob.name == job.key, ScheduledJob.schedule != str(job.spec))
+                    .values(schedule=str(job.spec), next_run_at=job.spec.next_after(now))
+                )
+            await session.commit()
+        for job in pending:
+            job.synced = True
+
+    async def _claim(self, job: Job, scheduled: float, now: float) -> bool:
+        # 予定時刻が読んだときのままで、リースが空いている場合だけ取れる(条件付きUPDATEなので取れるのは1プロセスだけ)
+        async with self.db.get_session() as session:
+            result = await session.execute(
+                update(ScheduledJob)
+                .where(
+                    ScheduledJob.name == job.key,
+                    ScheduledJob.next_run_at == scheduled,
+                    or_(ScheduledJob.lease_owner.is_(None), ScheduledJob.lease_expires_at <= now),
+                )
+                .values(lease_owner=self.owner, lease_expires_at=now + self.lease_seconds, last_started_at=now)
+            )
+            await session.commit()
+        return result.rowcount == 1
+
+    async def _renew(self, job: Job, runner: asyncio.Task) -> bool:
+        # 長いジョブの実行中は、期限の1/3ごとにリースを延長する
+        # 延長できないうちに期限が切れて他のプロセスが引き継いだ場合は、実行中のジョブを止めてTrueを返す
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            try:
+                async with self.db.get_session() as session:
+                    result = await session.execute(
+                        update(ScheduledJob)
+                        .where(ScheduledJob.name == job.key, ScheduledJob.lease_owner == self.owner)
+                        .values(lease_expires_at=time.time() + self.lease_seconds)
+                    )
+                    await session.commit()
+                if result.rowcount != 1:
+                    logger.warning(f"Lost the lease on scheduled job '{job.key}' while it was running; cancelling it.")
+                    runner.cancel()
+                    return True
+            except Exception as e:
+                logger.warning(f"Failed to renew the lease on scheduled job '{job.key}': {e}")
+
+    def _occurrences(self, job: Job, scheduled: float, now: float) -> list[float]:
+        # 今回実行する予定時刻の一覧。停止中に過ぎた予定の扱いは catch_up による
+        missed = [scheduled]
+        limit = job.max_catch_up if job.catch_up == 'all' else 2
+        while len(missed) < limit:
+            following = job.spec.next_after(missed[-1])
+            if following > now:
+                break
+            missed.append(following)
+        if job.catch_up == 'all':
+            return missed
+        if job.catch_up == 'skip' and len(missed) > 1:
+            logger.info(f"Skipping missed runs of scheduled job '{job.key}'.")
+            return []
+        return [scheduled]
+
+    async def _call(self, job: Job, scheduled_at: float):
+        if job.cpu_bound:
+            # プロセスプールで実行中の処理は途中で止められないため、タイムアウト時は結果を待たないだけになる
+            awaitable = asyncio.get_running_loop().run_in_executor(self._get_executor(), job.func, scheduled_at)
+        else:
+            awaitable = job.func(scheduled_at)
+        if job.timeout:
+            await asyncio.wait_for(awaitable, job.timeout)
+        else:
+            await awaitable
+
+    async def _execute(self, job: Job, scheduled: float, due: float):
+        started = time.time()
+        JOB_LAG.observe(max(0.0, started - due), job=job.name)
+        occurrences = self._occurrences(job, scheduled, started)
+        if not occurrences:
+            await self._release(job, {'next_run_at': job.spec.next_after(started)})
+            return
+        renew = asyncio.create_task(self._renew(job, asyncio.current_task()))
+        status, error = 'ok', None
+        start = time.perf_counter()
+        try:
+            for scheduled_at in occurrences:
+                await self._call(job, scheduled_at)
+        except asyncio.CancelledError:
+            if renew.done() and not renew.cancelled() and renew.result():
+                # リースを失った。引き継いだプロセスの予定や実行回数を上書きしないよう、行には何も書かない
+                asyncio.current_task().uncancel()
+                JOB_RUNS.inc(job=job.name, status='lease_lost')
+                job.last_status = 'lease_lost'
+                return
+            # 停止時は予定を進めずにリースだけ外し、次に起動したプロセスで実行し直す
+            renew.cancel()
+            await self._release(job, {})
+            raise
+        except asyncio.TimeoutError:
+            status, error = 'timeout', f"Timed out after {job.timeout}s"
+            logger.error(f"Scheduled job '{job.key}' timed out after {job.timeout}s.")
+        except Exception as e:
+            status, error = 'error', traceback.format_exc(limit=5)
+            logger.error(f"Scheduled job '{job.key}' failed: {e}")
+        renew.cancel()
+
+        duration = time.perf_counter() - start
+        JOB_SECONDS.observe(duration, job=job.name)
+        JOB_RUNS.inc(job=job.name, status=status)
+        job.last_status, job.last_duration = status, duration
+        if status == 'ok':
+            job.last_success_at = time.time()
+
+        # 'all' は処理した最後の予定の次へ(まだ過ぎた予定が残っていれば続けて実行される)、それ以外は現在時刻の次へ進める
+        if job.catch_up == 'all':
+            next_run_at = job.spec.next_after(occurrences[-1])
+        else:
+            next_run_at = job.spec.next_after(max(time.time(), scheduled))
+        await self._release(job, {
+            'next_run_at': next_run_at,
+            'last_finished_at': time.time(),
+            'last_duration': duration,
+            'last_status': status,
+            'last_error': error,
+            'run_count': ScheduledJob.run_count + 1,
+            'failure_count': ScheduledJob.failure_count + (0 if status == 'ok' else 1),
+        })
+        self._wakeup.set()
+
+    async def _release(self, job: Job, values: dict):
+        # ここで失敗した場合はリースの期限切れ後に再実行される(その場合だけ2回実行されうる)
+        try:
+            async with self.db.get_session() as session:
+                await session.execute(
+                    update(ScheduledJob)
+                    .where(ScheduledJob.name == job.key, ScheduledJob.lease_owner == self.owner)
+                    .values(lease_owner=None, lease_expires_at=None, **values)
+                )
+                await session.commit()
+        except Exception as e:
+            logger.error(f"Failed to release scheduled job '{job.key}': {e}")
+
+    async def stats(self) -> list[dict]:
+        # 登録されているジョブの、全プロセスを通した実行状況
+        if not self.jobs:
+            return []
+        async with self.db.read_session() as session:
+            rows = (await session.execute(select(ScheduledJob).where(ScheduledJob.name.in_(list(self.jobs))))).scalars().all()
+        return [
+            {
+                'name': row.name,
+                'schedule': row.schedule,
+                'next_run_at': row.next_run_at,
+                'running_on': row.lease_owner,
+                'last_status': row.last_status,
+                'last_duration': row.last_duration,
+                'last_finished_at': row.last_finished_at,
+                'run_count': row.run_count,
+                'failure_count': row.failure_count,
+            }
+            for row in rows
+        ]
+
+    def collect(self):
+        yield 'folium_jobs_registered', 'gauge', 'Scheduled jobs registered in this process.', [({}, len(self.jobs))]
+        yield 'folium_jobs_running', 'gauge', 'Scheduled jobs currently running in this process.', [({}, len(self._running))]
+        yield (
+            'folium_job_last_success_timestamp_seconds', 'gauge', 'When this process last finished each job successfully.',
+            [({'job': job.key}, job.last_success_at) for job in self.jobs.values() if job.last_success_at is not None],
+        )
@@ -0,0 +1,95 @@
+import logging
+import time
+
+import discord
+
+from config_service import SETTINGS
+from instrumentation import record_phase
+
+logger = logging.getLogger('discord')
+
+DISCORD_MESSAGE_LIMIT = 2000
+
+
+def split_message(text: str, limit: int = DISCORD_MESSAGE_LIMIT) -> list[str]:
+    # 可能なら改行、次に空白の位置で区切り、どちらもなければ文字数で切る
+    pages = []
+    while len(text) > limit:
+        cut = text.rfind('\n', 0, limit + 1)
+        if cut <= limit // 2:
+            cut = text.rfind(' ', 0, limit + 1)
+        if cut <= limit // 2:
+            cut = limit
+        pages.append(text[:cut])
+        text = text[cut:]
+        if text[:1] in ('\n', ' '):
+            text = text[1:]
+    pages.append(text)
+    return pages
+
+
+async def send_paginated(interaction: discord.Interaction, text: str, *, ephemeral: bool = False):
+    # 2000文字を超える応答は続きのメッセージに分けて送る
+    # 空白だけのメッセージはDiscordに拒否される(400)ので、代わりに空の応答だったことを知らせる
+    if not text.strip():
+        text = SETTINGS.catalog[interaction.locale]["ai_empty_response"]
+    pages = split_message(text)
+    first, rest = pages[0], pages[1:]
+    if interaction.response.is_done():
+        await interaction.followup.send(first, ephemeral=ephemeral)
+    else:
+        await interaction.response.send_message(first, ephemeral=ephemeral)
+    for page in rest:
+        await interaction.followup.send(page, ephemeral=ephemeral)
+
+
+# モデルのストリーミング出力を受け取り、フォローアップメッセージを少しずつ編集して表示する
+# 編集はedit_interval秒に1回までに抑え、上限を超えた分は続きのメッセージとして送る
+class MessageStreamer:
+    def __init__(self, followup: discord.Webhook, *, ephemeral: bool = False, edit_interval: float = 1.0, limit: int = DISCORD_MESSAGE_LIMIT):
+        self.followup = followup
+        self.ephemeral = ephemeral
+        self.edit_interval = edit_interval
+        self.limit = limit
+        self.text = ''
+        self._messages: list[discord.WebhookMessage] = []
+        self._shown: list[str] = []
+        self._last_flush = 0.0
+        self._created = time.perf_counter()
+
+    @property
+    def started(self) -> bool:
+        return bool(self._messages)
+
+    async def feed(self, delta: str):
+        if not delta:
+            return
+        self.text += delta
+        # 最初のチャンクはすぐに送り、以降は一定間隔でまとめて編集する
+        # 空白だけのチャンクは送れないので、最初の空白以外の文字が来るまで待つ(first_token もそこで1回だけ記録する)
+        if not self._messages:
+            if not self.text.strip():
+                return
+            record_phase('first_token', time.perf_counter() - self._created)
+            await self._flush()
+        elif time.perf_counter() - self._last_flush >= self.edit_interval:
+            await self._flush()
+
+    async def finish(self) -> str:
+        await self._flush()
+        return self.text
+
+    async def _flush(self):
+        if not self.text.strip():
+            return
+        pages = split_message(self.text, self.limit)
+        for index, page in enumerate(pages):
+            if index < len(self._messages):
+                if self._shown[index] != page:
+                    await self._messages[index].edit(content=page)
+                    self._shown[index] = page
+            else:
+                message = await self.followup.send(page, ephemeral=self.ephemeral, wait=True)
+                self._messages.append(message)
+                self._shown.append(page)
+        self._last_flush = time.perf_counter()
@@ -0,0 +1,131 @@
+import asyncio
+import logging
+import math
+import time
+from collections import deque
+
+import psutil
+
+logger = logging.getLogger('discord')
+
+
+class MetricsSample:
+    __slots__ = (
+        'timestamp', 'cpu_percent', 'memory_total', 'memory_used', 'memory_percent',
+        'process_rss', 'loop_lag', 'gateway_latency',
+    )
+
+    def __init__(self, timestamp, cpu_percent, memory_total, memory_used, memory_percent, process_rss, loop_lag, gateway_latency):
+        self.timestamp = timestamp
+        self.cpu_percent = cpu_percent
+        self.memory_total = memory_total
+        self.memory_used = memory_used
+        self.memory_percent = memory_percent
+        self.process_rss = process_rss
+        self.loop_lag = loop_lag
+        self.gateway_latency = gateway_latency
+
+
+def percentile(sorted_values: list[float], p: float) -> float:
+    # nearest-rank 法
+    if not sorted_values:
+        return math.nan
+    rank = max(1, math.ceil(p / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+# CPU・メモリ・イベントループ遅延・ゲートウェイレイテンシを一定間隔でリングバッファに記録する
+# コマンド側は最新のスナップショットを読むだけなので、イベントループをブロックしない
+class SystemMetricsSampler:
+    def __init__(self, bot, interval: float = 5.0, history: int = 720):
+        self.bot = bot
+        self.interval = interval
+        self.samples: deque[MetricsSample] = deque(maxlen=history)
+        self._process = psutil.Process()
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        if self._task is not None and not self._task.done():
+            return
+        # cpu_percent(interval=None) は前回呼び出しからの差分を返すため、ここで基準点を作っておく
+        psutil.cpu_percent(interval=None)
+        self._task = asyncio.create_task(self._run(), name='system-metrics-sampler')
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        expected = loop.time()
+        while True:
+            expected += self.interval
+            await asyncio.sleep(max(0.0, expected - loop.time()))
+            now = loop.time()
+            # 予定より遅れて起床した分がイベントループの遅延
+            lag = max(0.0, now - expected)
+            if lag > self.interval:
+                expected = now
+            try:
+                self.samples.append(self._take_sample(lag))
+            except Exception as e:
+                logger.warning(f"Failed to sample system metrics: {e}")
+
+    def _take_sample(self, loop_lag: float) -> MetricsSample:
+        memory = psutil.virtual_memory()
+        latency = self.bot.latency
+        return MetricsSample(
+            timestamp=time.time(),
+            cpu_percent=psutil.cpu_percent(interval=None),
+            memory_total=memory.total,
+            memory_used=memory.used,
+            memory_percent=memory.percent,
+            process_rss=self._process.memory_info().rss,
+            loop_lag=loop_lag,
+            gateway_latency=latency if math.isfinite(latency) else math.nan,
+        )
+
+    @property
+    def latest(self) -> MetricsSample:
+        if self.samples:
+            return self.samples[-1]
+        # 起動直後でまだサンプルがない場合だけその場で取得する(ブロックしない呼び出しのみ)
+        return self._take_sample(0.0)
+
+    def window(self, seconds: float | None = None) -> list[MetricsSample]:
+        if seconds is None:
+            return list(self.samples)
+        since = time.time() - seconds
+        return [sample for sample in self.samples if sample.timestamp >= since]
+
+    def percentiles(self, attribute: str, seconds: float | None = None, points=(50, 95, 99)) -> dict[int, float]:
+        values = sorted(
+            value for value in (getattr(sample, attribute) for sample in self.window(seconds))
+            if not math.isnan(value)
+        )
+        return {p: percentile(values, p) for p in points}
+
+    def latency_percentiles(self, seconds: float | None = 300) -> dict[int, float]:
+        return self.percentiles('gateway_latency', seconds)
+
+    def loop_lag_percentiles(self, seconds: float | None = 300) -> dict[int, float]:
+        return self.percentiles('loop_lag', seconds)
+
+    def collect(self):
+        if not self.samples:
+            return
+        sample = self.samples[-1]
+        yield 'folium_event_loop_lag_seconds', 'gauge', 'Most recent event loop lag sample.', [({}, sample.loop_lag)]
+        yield 'folium_gateway_latency_seconds', 'gauge', 'Most recent gateway heartbeat latency.', [({}, sample.gateway_latency)]
+        yield 'folium_cpu_percent', 'gauge', 'System CPU utilisation.', [({}, sample.cpu_percent)]
+        yield 'folium_process_resident_memory_bytes', 'gauge', 'Resident memory of the bot process.', [({}, sample.process_rss)]
+        lag = self.loop_lag_percentiles()
+        yield 'folium_event_loop_lag_quantile_seconds', 'gauge', 'Event loop lag percentiles over the last five minutes.', [
+            ({'quantile': f'{p / 100:g}'}, value) for p, value in lag.items()
+        ]